@@ -11,7 +11,9 @@ gettext.bindtextdomain(PACKAGE)
 gettext.textdomain(PACKAGE)
 
 from gi.repository import GLib, GObject, GtkClutter, Gtk, Gdk, Gio
-from os.path import basename, abspath
+from concurrent.futures import ThreadPoolExecutor, wait
+from collections import Counter
+from os.path import basename, abspath, isdir, join
 from gettext import gettext as _
 
 # If I have seen a little further it is by standing on the shoulders of Giants.
@@ -21,16 +23,24 @@ if not GLib.get_application_name():
     GLib.set_application_name(APPNAME)
     GObject.set_prgname(PACKAGE)
 
+GObject.threads_init()
 GtkClutter.init([])
 
 from gg.camera import Camera
 from gg.xmlfiles import TrackFile
+from gg.filetypes import walk_files, TRACK_FORMATS
 from gg.gpsmath import Coordinates
 from gg.widgets import Widgets, MapView
 from gg.actor import CoordLabel, animate_in
-from gg.photos import Photograph, fetch_thumbnail
+from gg.photos import Photograph, fetch_thumbnail, load_visible
+from gg.core import Fix, inspect_file
+from gg.export import export, export_format
+from gg.metadata import save_metadata, metadata_index
+from gg.metadata import METADATA_WORKERS, SAVE_WORKERS
 from gg.navigation import go_back, move_by_arrow_keys
-from gg.common import Gst, Binding, selected, modified
+from gg.session import Session, pack, unpack
+from gg.trace import enabled as tracing, stall_detector, STALL_INTERVAL
+from gg.common import Gst, Binding, selected, modified, parallel_map
 
 from gg.drag import DragController
 from gg.search import SearchController
@@ -38,6 +48,13 @@ from gg.search import SearchController
 # Handy names for GtkListStore column numbers.
 PATH, SUMMARY, THUMB, TIMESTAMP = range(4)
 
+# The response of the quit dialog's button that keeps the session for later.
+KEEP_FOR_LATER = 1
+
+# How often to check whether the session needs to be saved, in seconds.
+SESSION_INTERVAL = 10
+
+
 # Just pretend these functions are actually GottenGeography() instance methods.
 # The 'self' argument gets passed in by GtkApplication instead of Python.
 
@@ -57,6 +74,16 @@ def startup(self):
     """Display the primary window and connect some signals."""
     self.quit_message = Widgets.quit.get_property('secondary-text')
 
+    metadata_index.open(
+        join(GLib.get_user_cache_dir(), PACKAGE, 'metadata.sqlite'))
+
+    self.session = Session(
+        join(GLib.get_user_data_dir(), PACKAGE, 'session.json'))
+    GLib.idle_add(self.restore_session)
+    GLib.timeout_add_seconds(SESSION_INTERVAL, self.autosave_session)
+    if tracing():
+        GLib.timeout_add(STALL_INTERVAL, stall_detector())
+
     self.drag   = DragController(self.open_files)
     self.search = SearchController()
 
@@ -74,8 +101,12 @@ def startup(self):
     click_handlers = {
         'open':
             self.add_files_dialog,
+        'open_folder':
+            self.add_folder_dialog,
         'save':
             self.save_all_files,
+        'export':
+            self.export_dialog,
         'close':
             lambda btn: [p.destroy() for p in selected.copy()],
         'revert':
@@ -125,6 +156,9 @@ def startup(self):
     Widgets.button_sensitivity()
 
     Gst.connect('changed::thumbnail-size', Photograph.resize_all_photos)
+    adjustment = Widgets.photos_view.get_vadjustment()
+    adjustment.connect('value-changed', load_visible)
+    adjustment.connect('changed', load_visible)
 
     Widgets.launch()
     animate_in(self.do_fade_in)
@@ -152,6 +186,9 @@ class GottenGeography(Gtk.Application):
     def open_files(self, files):
         """Attempt to load all of the specified files.
 
+        Any folders are walked recursively, and the files in them are loaded
+        as they are found, so photos start showing up before the walk is done.
+
         >>> len(Photograph.instances)
         0
         >>> GottenGeography().open_files(
@@ -160,25 +197,47 @@ class GottenGeography(Gtk.Application):
         2
         """
         Widgets.progressbar.show()
-        invalid, total = [], len(files)
-        for i, name in enumerate(files, 1):
-            Widgets.redraw_interface(i / total, basename(name))
+        invalid, loaded = [], Counter()
+        # There's no telling how many files are in a folder until it's done.
+        total = None if any(isdir(path) for path in files) else len(files)
+        # Identify files and read photo metadata in the background, so that
+        # waiting on slow disks overlaps, while only the main thread touches
+        # the widgets.
+        results = parallel_map(
+            inspect_file, walk_files(files), METADATA_WORKERS)
+        i = 0
+        for i, (name, result) in enumerate(results, 1):
+            if total is None:
+                Widgets.progressbar.pulse()
+            Widgets.redraw_interface(total and i / total, basename(name))
             try:
-                try:
-                    Photograph.load_from_file(name)
-                except OSError:
-                    TrackFile.load_from_file(name)
+                kind, metadata = result.result()
+                if kind in TRACK_FORMATS:
+                    TrackFile.load_from_file(name, kind)
+                else:
+                    Photograph.load_from_file(name, metadata)
+                loaded[kind or _('other')] += 1
             except OSError:
                 invalid.append(basename(name))
+            if i % 100 == 0:
+                load_visible()
+        load_visible()
+        metadata_index.commit()
+        summary = ', '.join('{} {}'.format(count, kind)
+                            for kind, count in sorted(loaded.items()))
         if invalid:
-            Widgets.status_message(_('Could not open: ') + ', '.join(invalid))
+            Widgets.status_message(
+                (_('Opened: ') + summary + '. ' if loaded else '') +
+                _('Could not open: ') + ', '.join(invalid))
+        elif i > 1:
+            Widgets.status_message(_('Opened: ') + summary, True)
 
         # Ensure camera has found correct timezone regardless of the order
         # that the GPX/KML files were loaded in.
         likely_zone = TrackFile.query_all_timezones()
         if likely_zone:
             Camera.set_all_found_timezone(likely_zone)
-        Camera.timezone_handler_all()
+        Camera.refresh_all()
         Widgets.progressbar.hide()
         Widgets.button_sensitivity()
 
@@ -191,18 +250,81 @@ class GottenGeography(Gtk.Application):
         Widgets.button_sensitivity()
 
     def save_all_files(self, *ignore):
-        """Ensure all loaded files are saved."""
+        """Ensure all loaded files are saved.
+
+        Photos are saved on a pool of worker threads while the progressbar
+        keeps the interface alive. Photos whose files already have the same
+        location aren't rewritten at all. The cancel button stops any photos
+        that haven't started saving yet, and every failure is listed at the
+        end.
+        """
+        photos = list(modified)
+        total, saved, failures = len(photos), 0, []
+        cancel = Widgets.progress_cancel_button
+        Widgets.save_button.set_sensitive(False)
         Widgets.progressbar.show()
-        total = len(modified)
-        for i, photo in enumerate(list(modified), 1):
-            Widgets.redraw_interface(i / total, basename(photo.filename))
-            try:
-                photo.write()
-            except Exception as inst:
-                Widgets.status_message(str(inst))
+        cancel.show()
+
+        with ThreadPoolExecutor(SAVE_WORKERS) as pool:
+            jobs = {}
+            for photo in photos:
+                snapshot = photo.prepare_write()
+                if snapshot is not None:
+                    jobs[pool.submit(save_metadata, *snapshot)] = \
+                        (photo, snapshot)
+            unchanged = total - len(jobs)
+            total = len(jobs)
+            handler = cancel.connect(
+                'clicked', lambda *ignore: [job.cancel() for job in jobs])
+            pending = set(jobs)
+            while pending:
+                done, pending = wait(pending, timeout=0.1)
+                for job in done:
+                    if job.cancelled():
+                        continue
+                    photo, (filename, exif, location, names, sidecar) = \
+                        jobs[job]
+                    try:
+                        photo.saved(job.result(), location, names)
+                        saved += 1
+                    except Exception as inst:
+                        failures.append((filename, str(inst)))
+                    Widgets.redraw_interface(
+                        (saved + len(failures)) / total, basename(filename))
+                Widgets.redraw_interface()
+            cancel.disconnect(handler)
+
+        cancel.hide()
         Widgets.progressbar.hide()
+        cancelled = total - saved - len(failures)
+        if failures:
+            self.show_save_report(failures, cancelled, unchanged)
+        elif cancelled:
+            Widgets.status_message(
+                _('Saving cancelled, {} photos were not saved.').format(
+                    cancelled), True)
+        elif unchanged:
+            Widgets.status_message(
+                _('Saved {} photos, {} were already up to date.').format(
+                    saved, unchanged), True)
         Widgets.button_sensitivity()
 
+    def show_save_report(self, failures, cancelled, unchanged=0):
+        """List every photo that couldn't be saved, and why."""
+        Widgets.save_failures.clear()
+        for filename, error in failures:
+            Widgets.save_failures.append([basename(filename), error])
+        summary = _('{} of your photos could not be saved.').format(
+            len(failures))
+        if cancelled:
+            summary += ' ' + _('Another {} were cancelled.').format(cancelled)
+        if unchanged:
+            summary += ' ' + _('{} were already up to date.').format(unchanged)
+        Widgets.save_report.format_secondary_text(summary)
+        Widgets.save_report.run()
+        Widgets.save_report.hide()
+        Widgets.redraw_interface()
+
     def jump_to_photo(self, button):
         """Center on the first selected photo."""
         photo = selected.copy().pop()
@@ -227,17 +349,112 @@ class GottenGeography(Gtk.Application):
         if response == Gtk.ResponseType.OK:
             self.open_files(Widgets.open.get_filenames())
 
+    def add_folder_dialog(self, *ignore):
+        """Display a folder chooser, and load everything in chosen folders."""
+        response = Widgets.open_folder.run()
+        Widgets.open_folder.hide()
+        Widgets.redraw_interface()
+        if response == Gtk.ResponseType.OK:
+            self.open_files(Widgets.open_folder.get_filenames())
+
+    def export_dialog(self, *ignore):
+        """Export the location of every loaded photo to a chosen file.
+
+        The format is chosen by the file's extension. Photos are exported in
+        the order they were taken, without writing anything to them.
+        """
+        Widgets.export.set_current_name(_('photos.geojson'))
+        response = Widgets.export.run()
+        Widgets.export.hide()
+        Widgets.redraw_interface()
+        if response != Gtk.ResponseType.OK:
+            return
+        filename = Widgets.export.get_filename()
+        try:
+            kind = export_format(filename)
+        except ValueError:
+            Widgets.status_message(
+                _('Choose a file ending in .geojson, .kml, .gpx, or .csv.'))
+            return
+        photos = sorted(Photograph.instances,
+                        key=lambda photo: (photo.timestamp, photo.filename))
+        try:
+            export((Fix(photo.filename, photo.timestamp, photo.latitude,
+                        photo.longitude, photo.altitude, photo.names,
+                        photo.geotimezone) for photo in photos),
+                   filename, kind)
+        except OSError as error:
+            Widgets.status_message(str(error))
+            return
+        Widgets.status_message(
+            _('Exported {} photos to {}.').format(
+                len(photos), basename(filename)), True)
+
     def confirm_quit_dialog(self, *ignore):
-        """Teardown method, inform user of unsaved files, if any."""
+        """Teardown method, inform user of unsaved files, if any.
+
+        Unsaved work can also be kept for later, in which case the session
+        is restored the next time the app starts. Closing the dialog itself
+        is the same as cancelling.
+        """
         if not modified:
+            self.session.discard()
             self.quit()
             return True
         Widgets.quit.format_secondary_markup(self.quit_message % len(modified))
         response = Widgets.quit.run()
         Widgets.quit.hide()
         Widgets.redraw_interface()
+        if response in (Gtk.ResponseType.CANCEL,
+                        Gtk.ResponseType.DELETE_EVENT):
+            return True
         if response == Gtk.ResponseType.ACCEPT:
             self.save_all_files()
-        if response != Gtk.ResponseType.CANCEL:
-            self.quit()
+        if response == KEEP_FOR_LATER:
+            self.session.save(self.session_state(), background=False)
+        else:
+            self.session.discard()
+        self.quit()
         return True
+
+    def session_state(self):
+        """Describe the open files and unsaved locations for the session."""
+        return pack(
+            sorted(trackfile.filename for trackfile in TrackFile.instances),
+            [photo.filename for photo in Photograph.instances],
+            {photo.filename: (photo.latitude, photo.longitude,
+                              photo.altitude, photo.manual)
+             for photo in modified})
+
+    def autosave_session(self):
+        """Save the session in the background, if there is unsaved work.
+
+        Without any, there's nothing worth restoring after a crash, so the
+        session is forgotten instead. Unchanged sessions aren't rewritten.
+        """
+        if modified:
+            self.session.save(self.session_state())
+        elif self.session.written is not None:
+            self.session.discard()
+        return True
+
+    def restore_session(self):
+        """Reopen the files from the last session and reapply moves.
+
+        Sessions without any unsaved moves aren't worth the wait.
+        """
+        state = self.session.load()
+        if state is None:
+            return False
+        tracks, photos, positions = unpack(state)
+        if not positions:
+            self.session.discard()
+            return False
+        self.open_files(tracks + photos)
+        for filename, (lat, lon, alt, manual) in positions.items():
+            photo = Photograph.cache.get(filename)
+            if photo is not None:
+                photo.manual = manual
+                photo.set_location(lat, lon, alt)
+        Widgets.button_sensitivity()
+        return False
@@ -0,0 +1,356 @@
+# Author: Robert Park <robru@gottengeography.ca>, (C) 2015
+# Copyright: See COPYING file included with this distribution.
+
+"""Geotag whole folders of photos from the command line.
+
+This is what runs when GottenGeography is started as
+
+    gottengeography batch --track day1.gpx --offset 12 ~/Pictures/today
+
+It doesn't open any windows, and doesn't even import Gtk, so it can run from
+cron on a machine without a desktop session. Photos are read, located,
+geocoded, and saved on a pool of worker processes, each of which loads the
+GPS tracks just once. Photos that already have a location are left alone
+unless --overwrite is given, and photos taken outside of the time covered by
+the tracks are never guessed at, so it's safe to run over the same folder
+again and again as new photos and tracks arrive.
+
+The exit status is EXIT_OK if every photo was dealt with, EXIT_FAILED if some
+photos couldn't be read or saved, and EXIT_USAGE if the arguments were wrong
+or none of the tracks could be read.
+"""
+
+
+from gg.version import APPNAME, PACKAGE
+
+import gettext
+gettext.bindtextdomain(PACKAGE)
+gettext.textdomain(PACKAGE)
+
+from concurrent.futures import ProcessPoolExecutor
+from argparse import ArgumentParser, ArgumentTypeError
+from collections import Counter, namedtuple
+from gettext import gettext as _
+from os.path import basename
+from time import perf_counter
+from os import cpu_count
+import sys
+
+from gg.core import inspect_file, load_tracks, locate, geotag
+from gg.core import is_new_location
+from gg.correlate import find_tzinfo, fixed_tzinfo
+from gg.export import export, export_format
+from gg.trace import enable as enable_tracing
+from gg.filetypes import sniff, walk_files, TRACK_FORMATS
+from gg.geocode import lookup_geodata
+
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+
+# What happened to each photo.
+TAGGED = 'tagged'
+UNCHANGED = 'unchanged'
+SKIPPED = 'skipped'
+UNTRACKED = 'untracked'
+IGNORED = 'ignored'
+FAILED = 'failed'
+
+# Look up the camera's timezone from where the GPS tracks begin.
+AUTO_TIMEZONE = 'auto'
+
+# Hand photos to the worker processes in chunks of at most this many, to
+# keep the overhead of talking to them down without starving any of them.
+MAX_CHUNK = 64
+
+Result = namedtuple('Result', 'filename status fix error')
+
+
+def parse_timezone(value):
+    """Interpret the --timezone option.
+
+    >>> parse_timezone('America/Edmonton')
+    zoneinfo.ZoneInfo(key='America/Edmonton')
+    >>> parse_timezone('-6.5')
+    datetime.timezone(datetime.timedelta(days=-1, seconds=63000))
+    >>> parse_timezone('auto')
+    'auto'
+    """
+    if value == AUTO_TIMEZONE:
+        return value
+    tzinfo = find_tzinfo(value)
+    if tzinfo is not None:
+        return tzinfo
+    try:
+        return fixed_tzinfo(float(value))
+    except (ValueError, OverflowError):
+        raise ArgumentTypeError(_('unknown timezone: {}').format(value))
+
+
+def export_file(filename):
+    """Interpret the --export option, refusing unknown formats early."""
+    try:
+        export_format(filename)
+    except ValueError as error:
+        raise ArgumentTypeError(str(error))
+    return filename
+
+
+def add_geotag_arguments(parser):
+    """Describe the options that control how photos are geotagged."""
+    parser.add_argument(
+        '-o', '--offset', type=int, default=0, metavar='SECONDS',
+        help=_('the error in the camera\'s clock, in seconds'))
+    parser.add_argument(
+        '-z', '--timezone', type=parse_timezone, default=None,
+        metavar='ZONE', help=_('the timezone the camera\'s clock is set to, '
+                               'like America/Edmonton or -7, or "auto" to '
+                               'use the timezone where the tracks begin '
+                               '(default: this computer\'s timezone)'))
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=cpu_count() or 1, metavar='N',
+        help=_('how many photos to work on at once'))
+    parser.add_argument(
+        '-n', '--dry-run', action='store_true',
+        help=_('report what would be done without saving anything'))
+    parser.add_argument(
+        '--sidecar', action='store_true',
+        help=_('save locations to XMP sidecar files instead of the photos'))
+    parser.add_argument(
+        '--overwrite', action='store_true',
+        help=_('replace locations that photos already have'))
+    parser.add_argument(
+        '--no-geocode', dest='geocode', action='store_false',
+        help=_('don\'t save city, state, and country names'))
+    parser.add_argument(
+        '-v', '--verbose', action='store_true',
+        help=_('report where each photo was placed'))
+    parser.add_argument(
+        '-q', '--quiet', action='store_true',
+        help=_('only report errors'))
+    parser.add_argument(
+        '--trace', metavar='FILE',
+        help=_('record how long everything takes, and write it to FILE in '
+               'Chrome\'s trace format when done (use -j 1 to include the '
+               'work done for each photo)'))
+
+
+def make_parser():
+    """Describe the command line arguments."""
+    parser = ArgumentParser(
+        prog=PACKAGE + ' batch',
+        description=_('Geotag photos using GPS tracks, without a display.'))
+    parser.add_argument(
+        'photos', nargs='+', metavar='PHOTO',
+        help=_('photos, or folders to search for photos'))
+    parser.add_argument(
+        '-t', '--track', action='append', required=True, dest='tracks',
+        metavar='TRACK', help=_('a GPX, TCX, KML, or CSV file, or a folder '
+                                'of them (may be given more than once)'))
+    parser.add_argument(
+        '--export', type=export_file, metavar='FILE',
+        help=_('also write where each photo was placed to a .geojson, '
+               '.kml, .gpx, or .csv file'))
+    add_geotag_arguments(parser)
+    return parser
+
+
+class Job:
+    """Everything a worker process needs to know to geotag a photo."""
+
+    def __init__(self, timeline, offset=0, tzinfo=None, geocode=True,
+                 sidecar=False, overwrite=False, dry_run=False):
+        self.timeline = timeline
+        self.offset = offset
+        self.tzinfo = tzinfo
+        self.geocode = geocode
+        self.sidecar = sidecar
+        self.overwrite = overwrite
+        self.dry_run = dry_run
+
+    def covers(self, timestamp):
+        """Determine whether the tracks say anything about this time."""
+        stamps = self.timeline.stamps
+        return stamps[0] <= timestamp <= stamps[-1]
+
+    def geotag(self, filename):
+        """Locate and save one photo, returning a Result.
+
+        This never raises, so that one bad photo doesn't stop the others.
+        """
+        try:
+            kind, metadata = inspect_file(filename)
+            if metadata is None:
+                return Result(filename, IGNORED, None, '')
+            if any(metadata.gps[:2]) and not self.overwrite:
+                return Result(filename, SKIPPED, None, '')
+
+            fix, = locate(self.timeline, [(filename, metadata)],
+                          self.offset, self.tzinfo, geocode=False)
+            if not self.covers(fix.timestamp):
+                return Result(filename, UNTRACKED, fix, '')
+            if self.geocode:
+                names, timezone = lookup_geodata(fix.lat, fix.lon)
+                fix = fix._replace(names=names, timezone=timezone)
+
+            if self.dry_run:
+                changed = is_new_location(fix, metadata)
+            else:
+                changed = geotag(fix, metadata, self.sidecar)
+            return Result(filename, TAGGED if changed else UNCHANGED, fix, '')
+        except Exception as error:
+            return Result(filename, FAILED, None, str(error))
+
+
+# The Job that this worker process is doing, see start_worker().
+current_job = None
+
+
+def start_worker(job):
+    """Remember the job, once per worker process instead of once per photo."""
+    global current_job
+    current_job = job
+
+
+def run_job(filename):
+    """Geotag one photo in a worker process."""
+    return current_job.geotag(filename)
+
+
+def track_timezone(timeline):
+    """Find the timezone where the GPS tracks begin, for --timezone=auto."""
+    lats, lons = timeline.arrays[1:3]
+    return find_tzinfo(lookup_geodata(lats[0], lons[0])[1])
+
+
+def find_tracks(paths):
+    """List the GPS tracks among some files and folders.
+
+    Files that are named explicitly are always included, so that reading
+    them reports a useful error if they aren't tracks after all.
+    """
+    tracks = []
+    for filename in walk_files(paths):
+        if filename in paths:
+            tracks.append(filename)
+            continue
+        try:
+            if sniff(filename) in TRACK_FORMATS:
+                tracks.append(filename)
+        except OSError:
+            pass
+    return tracks
+
+
+def make_pool(job, jobs):
+    """Start worker processes that each remember the job."""
+    return ProcessPoolExecutor(jobs, initializer=start_worker, initargs=(job,))
+
+
+def run(job, filenames, jobs=1, pool=None):
+    """Geotag the photos, yielding a Result for each one in order.
+
+    A pool from make_pool() may be passed in to be reused, as long as it was
+    made for this same job. Otherwise a new one is started, and shut down
+    once all the photos are done.
+    """
+    if jobs <= 1 or len(filenames) <= 1:
+        yield from map(job.geotag, filenames)
+        return
+
+    chunk = max(1, min(MAX_CHUNK, len(filenames) // (jobs * 4)))
+    if pool is not None:
+        yield from pool.map(run_job, filenames, chunksize=chunk)
+        return
+    with make_pool(job, jobs) as pool:
+        yield from pool.map(run_job, filenames, chunksize=chunk)
+
+
+def describe(result):
+    """Summarize one result in a line of text, for --verbose."""
+    name = basename(result.filename)
+    if result.status == FAILED:
+        return '{}: {}'.format(name, result.error)
+    if result.fix is None or result.status == UNTRACKED:
+        return '{}: {}'.format(name, result.status)
+    place = ', '.join(part for part in result.fix.names if part)
+    return '{}: {} {:.5f}, {:.5f}{}'.format(
+        name, result.status, result.fix.lat, result.fix.lon,
+        ' ({})'.format(place) if place else '')
+
+
+def summarize(counts, seconds, dry_run=False):
+    """Describe what happened to all of the photos."""
+    total = sum(counts.values()) - counts[IGNORED]
+    lines = [(_('Would geotag {} of {} photos in {:.1f}s.') if dry_run else
+              _('Geotagged {} of {} photos in {:.1f}s.')).format(
+                  counts[TAGGED], total, seconds)]
+    for status, message in (
+            (UNCHANGED, _('{} already had this location.')),
+            (SKIPPED, _('{} already had a location, see --overwrite.')),
+            (UNTRACKED, _('{} were taken outside of the GPS tracks.')),
+            (FAILED, _('{} could not be geotagged.'))):
+        if counts[status]:
+            lines.append('  ' + message.format(counts[status]))
+    return '\n'.join(lines)
+
+
+def main(argv, out=sys.stdout, err=sys.stderr):
+    """Geotag photos as described by the command line arguments.
+
+    Returns the exit status.
+    """
+    parser = make_parser()
+    try:
+        args = parser.parse_args(argv)
+    except SystemExit as done:
+        return done.code
+    if args.trace:
+        enable_tracing(args.trace)
+
+    start = perf_counter()
+    try:
+        timeline = load_tracks(find_tracks(args.tracks))
+    except OSError as error:
+        print('{}: {}'.format(APPNAME, error), file=err)
+        return EXIT_USAGE
+    if len(timeline) < 2:
+        print(_('{}: No GPS track points found.').format(APPNAME), file=err)
+        return EXIT_USAGE
+
+    tzinfo = args.timezone
+    if tzinfo == AUTO_TIMEZONE:
+        tzinfo = track_timezone(timeline)
+
+    job = Job(timeline, args.offset, tzinfo, args.geocode, args.sidecar,
+              args.overwrite, args.dry_run)
+    counts = Counter()
+
+    def tally(results):
+        """Count and report results, yielding the fix of each placed photo."""
+        for result in results:
+            counts[result.status] += 1
+            if result.status == FAILED:
+                print(describe(result), file=err)
+            elif args.verbose and result.status != IGNORED:
+                print(describe(result), file=out)
+            if result.status in (TAGGED, UNCHANGED):
+                yield result.fix
+
+    fixes = tally(run(job, list(walk_files(args.photos)), args.jobs))
+    if args.export is None:
+        for fix in fixes:
+            pass
+    else:
+        # Photos are exported as they're geotagged, never all at once.
+        try:
+            export(fixes, args.export)
+        except OSError as error:
+            print('{}: {}'.format(APPNAME, error), file=err)
+            return EXIT_FAILED
+
+    if not args.quiet:
+        print(summarize(counts, perf_counter() - start, args.dry_run),
+              file=out)
+    return EXIT_FAILED if counts[FAILED] else EXIT_OK
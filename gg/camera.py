@@ -20,15 +20,15 @@ taken by that camera.
 from gi.repository import GtkClutter
 GtkClutter.init([])
 
-from gi.repository import GObject, Gtk
+from gi.repository import GLib, GObject, Gtk
 from math import modf as split_float
 from gettext import gettext as _
-from time import tzset
-from os import environ
+from threading import Thread
 
 from gg.common import staticmethod
 from gg.widgets import Builder, Widgets
-from gg.common import GSettings, Binding, memoize
+from gg.common import GSettings, Binding, memoize, timeline
+from gg.correlate import estimate_offset, find_tzinfo, fixed_tzinfo
 from gg.territories import tz_regions, get_timezone
 
 
@@ -58,10 +58,10 @@ class Camera(GObject.GObject):
 
     >>> cam = Camera('canon_canon_powershot_a590_is')
     >>> cam.timezone_method = 'lookup'
-    >>> environ['TZ']
+    >>> str(cam.tzinfo)
     'America/Edmonton'
     >>> cam.timezone_method = 'offset'
-    >>> environ['TZ'].startswith('UTC')
+    >>> cam.tzinfo.tzname(None).startswith('UTC')
     True
     """
     offset = GObject.property(type=int, minimum=-3600, maximum=3600)
@@ -97,46 +97,75 @@ class Camera(GObject.GObject):
             camera.found_timezone = timezone
 
     @staticmethod
-    def timezone_handler_all():
-        """Update all of the photos from all of the cameras."""
+    def refresh_all():
+        """Bring the photos from all of the cameras up to date."""
         for camera in Camera.instances:
-            camera.timezone_handler()
+            camera.refresh()
 
     def __init__(self, camera_id):
         GObject.GObject.__init__(self)
         self.id = camera_id
         self.photos = set()
 
+        # Photos that were added since the timezone was last applied.
+        self.unsynced = set()
+
+        # Used for cancelling recalculations that have been superseded.
+        self.offset_timeout = None
+        self.generation = 0
+
         # Bind properties to settings
         self.gst = GSettings('camera', camera_id)
         for prop in self.gst.list_keys():
             self.gst.bind(prop, self)
 
         # Get notifications when properties are changed
-        self.connect('notify::offset', self.offset_handler)
+        self.connect('notify::offset', self.offset_changed)
         self.connect('notify::timezone-method', self.timezone_handler)
         self.connect('notify::timezone-city', self.timezone_handler)
         self.connect('notify::utc-offset', self.timezone_handler)
 
-    def timezone_handler(self, *ignore):
-        """Set the timezone to the chosen zone and update all photos."""
-        environ['TZ'] = ''
+        self.tzinfo = self.get_tzinfo()
+
+    def get_tzinfo(self):
+        """Determine which timezone this camera's clock is set to.
+
+        Returns None to indicate that the system timezone should be used.
+        """
         if self.timezone_method == 'lookup':
             # Note that this will gracefully fallback on system timezone
             # if no timezone has actually been found yet.
-            environ['TZ'] = self.found_timezone
+            return find_tzinfo(self.found_timezone)
         elif self.timezone_method == 'offset':
-            minutes, hours = split_float(-float(self.utc_offset))
-            environ['TZ'] = 'UTC{:+}:{:02}'.format(
-                int(hours), int(abs(minutes) * 60))
+            return fixed_tzinfo(float(self.utc_offset))
         elif self.timezone_method == 'custom' and \
              self.timezone_region and self.timezone_city:
-            environ['TZ'] = '/'.join(
-                [self.timezone_region, self.timezone_city])
+            return find_tzinfo(
+                '/'.join([self.timezone_region, self.timezone_city]))
+        return None
 
-        tzset()
+    def timezone_handler(self, *ignore):
+        """Set the timezone to the chosen zone and update all photos."""
+        self.tzinfo = self.get_tzinfo()
+        self.unsynced.clear()
         self.offset_handler()
 
+    def refresh(self):
+        """Update photos after loading files, doing as little as possible.
+
+        Everything has to be recalculated if the timezone has changed since it
+        was last applied (eg, a GPS track revealed where the camera was), but
+        otherwise only the photos that were just added need any attention.
+        """
+        if self.get_tzinfo() != self.tzinfo:
+            self.timezone_handler()
+        elif self.unsynced:
+            photos = list(self.unsynced)
+            self.unsynced.clear()
+            for photo in photos:
+                photo.calculate_timestamp(self.offset, correlate=False)
+            timeline.correlate(photos)
+
     def get_offset_from_clock_photo(self, btn, orig, tz):
         """Subtract the camera's clock from the photographed clock."""
         delta_s = Widgets.clock_photo_seconds.get_value_as_int() - orig.tm_sec
@@ -150,23 +179,109 @@ class Camera(GObject.GObject):
         self.utc_offset = str(utc_offset + delta_h)
         self.timezone_method = 'offset'
 
+    def estimate_offset(self, *ignore):
+        """Guess the clock offset from photos that were already geotagged.
+
+        This compares the positions that photos had when they were loaded
+        (eg, from a phone's GPS) with where the GPS tracks would put them,
+        and picks the offset where the two agree best.
+        """
+        samples = [(photo.timestamp_at(0),) + photo.orig_gps[:2]
+                   for photo in self.photos if photo.orig_gps]
+        offset = estimate_offset(timeline, samples)
+        if offset is None:
+            Widgets.status_message(
+                _('Need GPS tracks and geotagged photos to guess the offset.'))
+        else:
+            self.offset = offset
+
     def offset_handler(self, *ignore):
         """When the offset is changed, update the loaded photos."""
-        for i, photo in enumerate(self.photos):
-            if not i % 10:
-                Widgets.redraw_interface()
-            photo.calculate_timestamp(self.offset)
+        self.cancel_correlation()
+        for photo in self.photos:
+            photo.calculate_timestamp(self.offset, correlate=False)
+        timeline.correlate(self.photos)
+
+    def offset_changed(self, *ignore):
+        """Wait for the offset slider to settle before updating any photos.
+
+        Every movement of the slider cancels whatever work is in progress and
+        restarts the timer, so only the final value ever gets applied.
+        """
+        self.cancel_correlation()
+        self.offset_timeout = GLib.timeout_add(250, self.start_correlation)
+
+    def cancel_correlation(self):
+        """Forget about any recalculation that is pending or in progress."""
+        self.generation += 1
+        if self.offset_timeout is not None:
+            GLib.source_remove(self.offset_timeout)
+            self.offset_timeout = None
+
+    def start_correlation(self):
+        """Recalculate this camera's photos in a background thread."""
+        self.offset_timeout = None
+        Thread(target=self.background_correlation, daemon=True,
+               args=(self.generation, list(self.photos), self.offset)).start()
+        return False
+
+    def background_correlation(self, generation, photos, offset):
+        """Calculate new timestamps and positions without touching photos."""
+        stamps = []
+        for photo in photos:
+            if generation != self.generation:
+                return
+            stamps.append(photo.timestamp_at(offset))
+
+        # Tracks can be unloaded at any moment, so only look at them once.
+        arrays = timeline.arrays
+        positions = None
+        try:
+            if len(arrays[0]) > 1:
+                positions = timeline.interpolate(stamps, arrays)
+        finally:
+            GLib.idle_add(self.finish_correlation,
+                          generation, photos, stamps, arrays, positions)
+
+    def finish_correlation(self, generation, photos, stamps, arrays,
+                           positions):
+        """Apply the results from the background thread to the photos.
+
+        Nothing happens if the offset has moved again in the meantime, and
+        only photos whose timestamps or positions differ are updated.
+        """
+        if generation != self.generation:
+            return False
+
+        # Photos may have been moved to another camera in the meantime.
+        mine = [photo.camera is self for photo in photos]
+        for photo, stamp, keep in zip(photos, stamps, mine):
+            if keep and photo.timestamp != stamp:
+                photo.timestamp = stamp
+        current = [photo for photo, keep in zip(photos, mine) if keep]
+
+        if positions is None or arrays is not timeline.arrays:
+            # There was no GPS data, or it was loaded or unloaded while we
+            # were busy, so the positions have to be calculated again.
+            timeline.correlate(current)
+            return False
+
+        timeline.apply(current, [position for position, keep
+                                 in zip(positions, mine) if keep])
+        return False
 
     def add_photo(self, photo):
         """Adds photo to the list of photos taken by this camera."""
         photo.camera = self
         self.photos.add(photo)
+        self.unsynced.add(photo)
         self.notify('num_photos')
 
     def remove_photo(self, photo):
         """Removes photo from the list of photos taken by this camera."""
         photo.camera = None
         self.photos.discard(photo)
+        self.unsynced.discard(photo)
         self.notify('num_photos')
 
 
@@ -236,6 +351,8 @@ class CameraView(Gtk.Box):
 
         Binding(scale.get_adjustment(), 'value', camera, 'offset')
 
+        self.widgets.estimate_button.connect('clicked', camera.estimate_offset)
+
         # These two ComboBoxTexts are used for choosing the timezone manually.
         # They're hidden to reduce clutter when not needed.
         region_combo = self.widgets.timezone_region
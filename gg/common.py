@@ -8,19 +8,29 @@ are frequently used for iteration and membership testing throughout the app.
 
 The `points` dict maps epoch seconds to ChamplainCoordinate() instances. This
 is used to place photos on the map by looking up their timestamps.
+
+The `timeline` is a sorted copy of `points`, which is rebuilt whenever GPS
+tracks are loaded or unloaded, and is used to position many photos at once.
+The `photo_index` finds the Photograph() instances taken during a given span
+of time, so that loading GPS data only needs to update the affected photos.
 """
 
 
 from gi.repository import GObject, Gio, GLib
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 from functools import wraps
 
 from gg.version import PACKAGE
+from gg.correlate import Timeline, PhotoIndex
 
 
 # These variables are used for sharing data between classes
 selected = set()
 modified = set()
 points   = {}
+timeline = Timeline()
+photo_index = PhotoIndex()
 
 
 try:
@@ -46,6 +56,30 @@ except ImportError:
             pass
 
 
+def parallel_map(function, items, workers=4):
+    """Call function on every item using a pool of threads.
+
+    Yields (item, future) pairs in the original order, so that the caller can
+    deal with each result (or exception) as it becomes ready. Only a few items
+    are started ahead of the caller, so results don't pile up in memory if the
+    caller is slower than the workers.
+
+    >>> for item, future in parallel_map(lambda x: x * 2, [1, 2, 3]):
+    ...     print(item, future.result())
+    1 2
+    2 4
+    3 6
+    """
+    with ThreadPoolExecutor(workers) as pool:
+        started = deque()
+        for item in items:
+            if len(started) >= workers * 4:
+                yield started.popleft()
+            started.append((item, pool.submit(function, item)))
+        while started:
+            yield started.popleft()
+
+
 def singleton(cls):
     """Decorate a class with @singleton when There Can Be Only One.
 
@@ -0,0 +1,123 @@
+# Author: Robert Park <robru@gottengeography.ca>, (C) 2015
+# Copyright: See COPYING file included with this distribution.
+
+"""Geotag photos from start to finish, without any user interface.
+
+This ties together the track readers, the timeline, the reverse geocoder, and
+the metadata reader and writer, so that photos can be geotagged by scripts
+and batch jobs that don't have a display. None of this imports Gtk or
+Clutter, so it starts instantly. The GUI does the very same things, it just
+shows its work on the map as it goes.
+
+>>> timeline = load_tracks(['demo/2010 10 16.gpx'])
+>>> len(timeline)
+374
+"""
+
+
+from collections import namedtuple
+from os import stat
+
+from gg.correlate import Timeline, local_timestamp
+from gg.filetypes import sniff, TRACK_FORMATS, UNSUPPORTED_FORMATS
+from gg.geocode import lookup_geodata
+from gg.metadata import read_metadata, save_metadata, quantize
+from gg.trace import span
+from gg.tracks import read_track
+
+
+# Where and when a photo was taken, as calculated by locate().
+Fix = namedtuple('Fix', 'filename timestamp lat lon ele names timezone')
+
+
+def inspect_file(filename):
+    """Identify a file, and read its metadata if it's a photo.
+
+    Returns the format name and the metadata, which is None for GPS tracks.
+    This is safe to call from a worker thread. Raises OSError if the file
+    can't be read or isn't any kind of file that can be opened.
+    """
+    kind = sniff(filename)
+    if kind in UNSUPPORTED_FORMATS:
+        raise OSError('{}: Unsupported file type.'.format(filename))
+    if kind in TRACK_FORMATS:
+        return kind, None
+    return kind, read_metadata(filename)
+
+
+def load_tracks(filenames):
+    """Read every track point from some GPS tracks into a single Timeline.
+
+    Raises OSError if any of the files can't be read.
+    """
+    points = {}
+    for filename in filenames:
+        points.update(read_track(filename))
+    return Timeline(points)
+
+
+def photo_timestamp(filename, orig_time, offset=0, tzinfo=None):
+    """Determine when a photo was taken, in epoch seconds.
+
+    The camera's clock is assumed to be in the given timezone, or the local
+    timezone if None. Photos without a timestamp fall back to the time that
+    the file was last modified.
+
+    >>> from gg.correlate import fixed_tzinfo
+    >>> photo_timestamp('demo/IMG_2411.JPG', (2010, 10, 16, 14, 12, 28, 5, 289,
+    ...                 -1), 60, fixed_tzinfo(-6))
+    1287260008
+    """
+    try:
+        timestamp = local_timestamp(orig_time, tzinfo)
+    except TypeError:
+        timestamp = int(stat(filename).st_mtime)
+    return timestamp + offset
+
+
+def locate(timeline, photos, offset=0, tzinfo=None, geocode=True):
+    """Calculate where each photo was taken.
+
+    `photos` is a sequence of (filename, metadata) pairs, as returned by
+    read_metadata(). Returns a Fix for each photo in the same order, or an
+    empty list if there isn't enough GPS data to go on. The names and
+    timezone are only looked up if `geocode` is true.
+    """
+    if len(timeline) < 2:
+        return []
+
+    stamps = [photo_timestamp(filename, metadata.orig_time, offset, tzinfo)
+              for filename, metadata in photos]
+    with span('correlate', photos=len(photos)):
+        positions = timeline.interpolate(stamps)
+    fixes = []
+    for (filename, metadata), stamp, (lat, lon, ele) in zip(
+            photos, stamps, positions):
+        names, timezone = ((None, None, None), '')
+        if geocode:
+            names, timezone = lookup_geodata(lat, lon)
+        fixes.append(Fix(filename, stamp, lat, lon, ele, names, timezone))
+    return fixes
+
+
+def is_new_location(fix, metadata):
+    """Determine whether a photo needs saving to record a calculated location.
+
+    Locations are compared the same way the GUI compares them.
+    """
+    return quantize((fix.lon, fix.lat, fix.ele), fix.names) != \
+        quantize(metadata.gps, metadata.names)
+
+
+def geotag(fix, metadata, sidecar=False):
+    """Save a calculated location into a photo.
+
+    Returns False without touching the file if it already has this location.
+    If sidecar is true, the location is written into the photo's XMP sidecar
+    instead.
+    """
+    if not is_new_location(fix, metadata):
+        return False
+    save_metadata(fix.filename, metadata.exif, (fix.lon, fix.lat, fix.ele),
+                  fix.names, sidecar)
+    return True
@@ -0,0 +1,324 @@
+# Author: Robert Park <robru@gottengeography.ca>, (C) 2015
+# Copyright: See COPYING file included with this distribution.
+
+"""Correlate photo timestamps with GPS track points in bulk.
+
+The Timeline keeps every loaded track point in sorted, parallel lists so that
+the position at any given time can be found with a binary search instead of
+scanning the whole `points` dict once per photo. Nothing in here knows about
+Gtk or Clutter, it only needs objects with `lat`, `lon`, and `ele` attributes.
+
+>>> class Point:
+...     def __init__(self, lat, lon, ele):
+...         self.lat, self.lon, self.ele = lat, lon, ele
+>>> timeline = Timeline({10: Point(0, 0, 0), 20: Point(10, 20, 30)})
+>>> timeline.interpolate([5, 10, 15, 25])
+[(0, 0, 0), (0, 0, 0), (5.0, 10.0, 15.0), (10, 20, 30)]
+"""
+
+
+from datetime import datetime, timedelta, timezone
+from bisect import bisect_left, bisect_right
+from math import cos, hypot, radians
+from time import mktime
+
+try:
+    # This is in the stdlib as of 3.9.
+    from zoneinfo import ZoneInfo
+except ImportError:
+    from dateutil.tz import gettz as ZoneInfo
+
+from gg.trace import span, traced
+
+
+# How many photos to consider while searching coarsely for a clock offset.
+COARSE_SAMPLES = 250
+
+
+def find_tzinfo(name):
+    """Look up a timezone by name, eg, 'America/Edmonton'.
+
+    Returns None (meaning the system timezone) if the name is not known.
+
+    >>> find_tzinfo('America/Edmonton').utcoffset(datetime(2015, 1, 1))
+    datetime.timedelta(days=-1, seconds=61200)
+    >>> find_tzinfo('Atlantis/Lost_City') is None
+    True
+    """
+    if not name:
+        return None
+    try:
+        return ZoneInfo(name)
+    except (KeyError, ValueError, OSError):
+        return None
+
+
+def fixed_tzinfo(hours):
+    """Create a timezone that is always the given number of hours from UTC.
+
+    >>> fixed_tzinfo(5.75)
+    datetime.timezone(datetime.timedelta(seconds=20700))
+    """
+    return timezone(timedelta(hours=hours))
+
+
+def local_timestamp(orig_time, tzinfo=None):
+    """Convert a time_struct from a camera's clock into epoch seconds.
+
+    Unlike time.mktime(), this doesn't depend on the TZ environment variable
+    unless no tzinfo is given, so different cameras can be calculated at the
+    same time without stepping on each other.
+
+    >>> local_timestamp((2015, 1, 3, 12, 13, 14, 5, 3, -1), fixed_tzinfo(-7))
+    1420312394
+    """
+    if tzinfo is None:
+        return int(mktime(orig_time))
+    return int(datetime(*orig_time[:6], tzinfo=tzinfo).timestamp())
+
+
+class Timeline:
+    """Sorted track point data, suitable for fast interpolation."""
+
+    def __init__(self, points=None):
+        self.arrays = ([], [], [], [])
+        if points:
+            self.load(points)
+
+    def __len__(self):
+        return len(self.stamps)
+
+    @property
+    def stamps(self):
+        """The sorted epoch seconds of every loaded track point."""
+        return self.arrays[0]
+
+    def load(self, points):
+        """(Re)build from a dict mapping epoch seconds to track points.
+
+        The new data is swapped in with a single assignment, so that a
+        background thread that is in the middle of an interpolation never
+        sees a half-loaded timeline.
+        """
+        stamps = sorted(points)
+        nodes = [points[stamp] for stamp in stamps]
+        self.arrays = (stamps,
+                       [node.lat for node in nodes],
+                       [node.lon for node in nodes],
+                       [node.ele for node in nodes])
+
+    def affected(self, alpha, omega):
+        """Determine which photo timestamps depend on the given time range.
+
+        When track points between alpha and omega are loaded or unloaded, the
+        only photos that can move are the ones between the nearest remaining
+        points on either side of that range. If there aren't any points on one
+        side, then photos on that side were clamped to the end of the track
+        and might move too. Call this after loading, or before unloading.
+
+        >>> class Point: lat = lon = ele = 0
+        >>> Timeline({t: Point for t in (10, 20, 30, 40)}).affected(20, 30)
+        (10, 40)
+        >>> Timeline({t: Point for t in (10, 20, 30, 40)}).affected(5, 30)
+        (-inf, 40)
+        """
+        stamps = self.stamps
+        before = bisect_left(stamps, alpha)
+        after = bisect_right(stamps, omega)
+        return (stamps[before - 1] if before else float('-inf'),
+                stamps[after] if after < len(stamps) else float('inf'))
+
+    # This method is the embodiment of my applications core logic.
+    # Everything else is just implementation details.
+    def interpolate(self, stamps, arrays=None):
+        """Calculate the coordinates and elevation at each of the given times.
+
+        Times outside of the range of the loaded tracks are clamped to the
+        nearest end of the track. Returns a list of (lat, lon, ele) tuples in
+        the same order as the given timestamps. Background threads should pass
+        in the arrays that they already checked, since tracks may be loaded or
+        unloaded at any moment.
+        """
+        times, lats, lons, eles = arrays or self.arrays
+        last = len(times) - 1
+        first, final = times[0], times[last]
+        positions = []
+        append = positions.append
+
+        for stamp in stamps:
+            if stamp <= first:
+                append((lats[0], lons[0], eles[0]))
+                continue
+            if stamp >= final:
+                append((lats[last], lons[last], eles[last]))
+                continue
+
+            hi = bisect_left(times, stamp)
+            if times[hi] == stamp:
+                # Exact matches are more likely than you think. 50%
+                # of the included demo data matches here.
+                append((lats[hi], lons[hi], eles[hi]))
+                continue
+
+            # Proportional amount of time between each point & the photo.
+            lo = hi - 1
+            span = times[hi] - times[lo]
+            hi_ratio = (stamp - times[lo]) / span
+            lo_ratio = (times[hi] - stamp) / span
+            append(((lats[lo] * lo_ratio) + (lats[hi] * hi_ratio),
+                    (lons[lo] * lo_ratio) + (lons[hi] * hi_ratio),
+                    (eles[lo] * lo_ratio) + (eles[hi] * hi_ratio)))
+
+        return positions
+
+    def correlate(self, photos):
+        """Place all of the automatically positioned photos along the track.
+
+        All the positions are calculated in one pass before any photo is
+        touched. Returns the list of photos that actually moved.
+        """
+        if len(self) < 2:
+            return []
+
+        photos = [photo for photo in photos if not photo.manual]
+        with span('correlate', photos=len(photos)):
+            return self.apply(photos, self.interpolate(
+                [photo.timestamp for photo in photos]))
+
+    @staticmethod
+    def apply(photos, positions):
+        """Move photos to positions that were calculated earlier.
+
+        Each photo's property notifications are frozen while its location is
+        updated, so that it only announces its new position once. Photos that
+        are manually positioned or already in the right place are not touched
+        at all. Returns the list of photos that actually moved.
+        """
+        moved = []
+
+        for photo, (lat, lon, ele) in zip(photos, positions):
+            if photo.manual or \
+               (photo.latitude, photo.longitude, photo.altitude) == \
+               (lat, lon, ele):
+                continue
+            photo.freeze_notify()
+            try:
+                photo.set_location(lat, lon, ele)
+            finally:
+                photo.thaw_notify()
+            moved.append(photo)
+
+        return moved
+
+
+class PhotoIndex:
+    """Find the photos that were taken within a given span of time.
+
+    The index is only sorted when it's actually queried after timestamps have
+    changed, so it's cheap to invalidate it over and over again while many
+    photos are being loaded or recalculated.
+
+    >>> class Photo:
+    ...     def __init__(self, timestamp): self.timestamp = timestamp
+    ...     def __repr__(self): return str(self.timestamp)
+    >>> index = PhotoIndex()
+    >>> for stamp in (50, 10, 40, 20, 30): index.add(Photo(stamp))
+    >>> index.between(15, 40)
+    [20, 30, 40]
+    """
+
+    def __init__(self):
+        self.photos = set()
+        self.stamps = []
+        self.order = []
+        self.stale = False
+
+    def __len__(self):
+        return len(self.photos)
+
+    def add(self, photo):
+        """Start tracking a photo."""
+        self.photos.add(photo)
+        self.stale = True
+
+    def discard(self, photo):
+        """Stop tracking a photo."""
+        self.photos.discard(photo)
+        self.stale = True
+
+    def invalidate(self, *ignore):
+        """Make note that some timestamp has changed."""
+        self.stale = True
+
+    def between(self, lo, hi):
+        """Return the photos with timestamps from lo to hi, inclusive."""
+        if self.stale:
+            self.order = sorted(self.photos, key=lambda photo: photo.timestamp)
+            self.stamps = [photo.timestamp for photo in self.order]
+            self.stale = False
+        return self.order[bisect_left(self.stamps, lo):
+                          bisect_right(self.stamps, hi)]
+
+
+def offset_error(timeline, samples, offset):
+    """Measure how far the photos would be from their known positions.
+
+    `samples` must be (timestamp, lat, lon, cos(lat)) tuples. The result is
+    the sum of the (roughly planar) distances in degrees, which is a lot less
+    sensitive to the occasional bad GPS fix than summing squares would be.
+    """
+    positions = timeline.interpolate(
+        [sample[0] + offset for sample in samples])
+    return sum(hypot((lon2 - lon) * scale, lat2 - lat)
+               for (stamp, lat, lon, scale), (lat2, lon2, ele)
+               in zip(samples, positions))
+
+
+@traced('correlate.offset')
+def estimate_offset(timeline, samples, limit=3600, step=60):
+    """Find the camera clock offset that best agrees with known positions.
+
+    `samples` is a sequence of (timestamp, lat, lon) tuples describing photos
+    that were geotagged by some other device, and the timestamps must not
+    include any clock offset already. Returns the offset in seconds, or None
+    if there is no GPS data to compare against.
+
+    Rather than trying every possible second, candidates are swept coarsely
+    using a subset of the photos, and then the few most promising candidates
+    are refined with progressively smaller steps using every photo.
+
+    >>> class Point:
+    ...     def __init__(self, stamp):
+    ...         self.lat, self.lon, self.ele = stamp / 1000, stamp / 500, 0
+    >>> timeline = Timeline({t: Point(t) for t in range(0, 10000, 10)})
+    >>> samples = [(t - 1234, t / 1000, t / 500) for t in range(3000, 6000, 7)]
+    >>> estimate_offset(timeline, samples)
+    1234
+    >>> estimate_offset(Timeline(), samples) is None
+    True
+    """
+    if len(timeline) < 2 or not samples:
+        return None
+
+    samples = [(stamp, lat, lon, cos(radians(lat)))
+               for stamp, lat, lon in samples]
+    coarse = samples[::max(1, len(samples) // COARSE_SAMPLES)]
+
+    def score(candidates, subset):
+        """Rank the candidate offsets, preferring small ones in a tie."""
+        return sorted((offset_error(timeline, subset, offset), abs(offset),
+                       offset) for offset in candidates)
+
+    ranked = score(range(-limit, limit + 1, step), coarse)
+    best = []
+    for error, size, center in ranked[:3]:
+        span = step
+        while span > 1:
+            fine = max(1, span // 12)
+            candidates = range(max(-limit, center - span),
+                               min(limit, center + span) + 1, fine)
+            error, size, center = score(candidates, samples)[0]
+            span = fine
+        best.append((error, size, center))
+
+    return min(best)[2]
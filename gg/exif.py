@@ -0,0 +1,376 @@
+# Author: Robert Park <robru@gottengeography.ca>, (C) 2015
+# Copyright: See COPYING file included with this distribution.
+
+"""Read just the EXIF tags that are needed for geotagging.
+
+Opening a photo with GExiv2 parses every bit of metadata in the file, but in
+order to geotag a photo we only need to know when it was taken, where it was
+taken (if anywhere), which camera took it, and which location names were
+saved with it. This module finds those few tags by walking the TIFF and IPTC
+structures at the start of a JPEG (or any TIFF-based RAW) file through an
+mmap, so only the pages that actually hold the metadata are ever read from
+disk.
+
+Anything this doesn't understand raises ValueError, so that the caller can
+fall back to GExiv2, which reads many more formats.
+
+This also knows where to find the XMP sidecar files that other photo managers
+keep next to photos, and how to start a new one.
+"""
+
+
+from glob import escape, glob
+from mmap import mmap, ACCESS_READ
+from os.path import exists, splitext
+from struct import calcsize, unpack_from, error as struct_error
+
+
+# Never look further into a file than this for the EXIF data.
+MAX_HEADER = 512 * 1024
+
+# The byte size of each TIFF field type that we know how to read.
+TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8, 13: 4}
+TYPE_FORMATS = {1: 'B', 3: 'H', 4: 'I', 5: 'II', 7: 'B', 9: 'i', 10: 'ii',
+                13: 'I'}
+ASCII = 2
+LONG = 4
+IFD = 13
+
+# Tags pointing at the Exif and GPS sub-IFDs, and at embedded IPTC data.
+EXIF_POINTER = 0x8769
+GPS_POINTER = 0x8825
+IPTC_POINTER = 0x83BB
+
+# The Photoshop image resource that holds the IPTC data in a JPEG.
+IPTC_RESOURCE = 0x0404
+
+# An XMP packet with nothing in it, for GExiv2 to fill in.
+EMPTY_XMP = """<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>
+<x:xmpmeta xmlns:x="adobe:ns:meta/">
+ <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+ </rdf:RDF>
+</x:xmpmeta>
+<?xpacket end="w"?>
+"""
+
+# The tags that we want, named the same way GExiv2 names them.
+IMAGE_TAGS = {
+    0x010F: 'Exif.Image.Make',
+    0x0110: 'Exif.Image.Model',
+    0x0132: 'Exif.Image.DateTime',
+    0x9003: 'Exif.Image.DateTimeOriginal',
+    0xC62F: 'Exif.Image.CameraSerialNumber',
+}
+PHOTO_TAGS = {
+    0x9003: 'Exif.Photo.DateTimeOriginal',
+    0xA431: 'Exif.Photo.BodySerialNumber',
+}
+IPTC_TAGS = {
+    90: 'Iptc.Application2.City',
+    95: 'Iptc.Application2.ProvinceState',
+    101: 'Iptc.Application2.CountryName',
+}
+
+
+class ExifHeader(dict):
+    """The tags found by read_header(), with a GExiv2-like interface.
+
+    >>> header = ExifHeader({'Exif.Image.Make': 'Canon'})
+    >>> header['Exif.Image.Make']
+    'Canon'
+    >>> header.get('Exif.Image.Model') is None
+    True
+    >>> header.get_gps_info()
+    (0.0, 0.0, 0.0)
+    """
+    gps = (0.0, 0.0, 0.0)
+
+    def get_gps_info(self):
+        """Return the (longitude, latitude, altitude) of the photo."""
+        return self.gps
+
+
+class TiffReader:
+    """Read values out of a TIFF structure embedded in a larger buffer."""
+
+    def __init__(self, data, start, end):
+        self.data = data
+        self.start = start
+        self.end = min(end, len(data), MAX_HEADER)
+        self.order = {b'II': '<', b'MM': '>'}.get(data[start:start + 2])
+        if self.order is None or self.unpack('H', 2) != (42,):
+            raise ValueError('Not a TIFF structure.')
+
+    def unpack(self, fmt, offset):
+        """Unpack values at an offset relative to the start of the TIFF."""
+        position = self.start + offset
+        if offset < 0 or position + calcsize(fmt) > self.end:
+            raise ValueError('EXIF data is out of bounds.')
+        return unpack_from(self.order + fmt, self.data, position)
+
+    def entries(self, offset):
+        """Yield (tag, type, count, offset of value) for each IFD entry."""
+        count, = self.unpack('H', offset)
+        for entry in range(offset + 2, offset + 2 + count * 12, 12):
+            tag, kind, count = self.unpack('HHI', entry)
+            size = TYPE_SIZES.get(kind)
+            if size is None:
+                continue
+            value = entry + 8
+            if size * count > 4:
+                value, = self.unpack('I', value)
+            yield tag, kind, count, value
+
+    def value(self, kind, count, offset):
+        """Read an ASCII field as a string, or anything else as a tuple."""
+        if kind == ASCII:
+            raw = self.unpack('{}s'.format(count), offset)[0]
+            return raw.split(b'\0', 1)[0].decode('utf-8', 'replace')
+        values = self.unpack(TYPE_FORMATS[kind] * count, offset)
+        if kind in (5, 10):
+            return tuple(num / den if den else 0.0
+                         for num, den in zip(values[::2], values[1::2]))
+        return values
+
+    def text(self, kind, count, offset):
+        """Read a field the way GExiv2 would show it as a string."""
+        value = self.value(kind, count, offset)
+        if kind == ASCII:
+            return value
+        return ' '.join(str(item) for item in value)
+
+    def tags(self, offset, wanted):
+        """Collect the wanted tags from one IFD, as strings."""
+        return {wanted[tag]: self.text(kind, count, value)
+                for tag, kind, count, value in self.entries(offset)
+                if tag in wanted}
+
+    def pointer(self, offset, pointer):
+        """Find the offset of a sub-IFD, if there is one.
+
+        Pointers that aren't stored as an offset are ignored.
+        """
+        for tag, kind, count, value in self.entries(offset):
+            if tag == pointer:
+                if kind not in (LONG, IFD) or count < 1:
+                    return None
+                return self.value(kind, count, value)[0]
+        return None
+
+    def block(self, offset, tag):
+        """Find the (start, end) of a tag's raw bytes within the buffer."""
+        for entry, kind, count, value in self.entries(offset):
+            if entry == tag:
+                start = self.start + value
+                return start, start + TYPE_SIZES[kind] * count
+        return None
+
+    def gps(self, offset):
+        """Read the (longitude, latitude, altitude) from the GPS IFD.
+
+        Just like GExiv2, any part that is missing is 0.0.
+        """
+        fields = {tag: self.value(kind, count, value)
+                  for tag, kind, count, value in self.entries(offset)
+                  if 1 <= tag <= 6}
+
+        def degrees(ref, tag, negative):
+            """Combine degrees, minutes, and seconds."""
+            parts = fields.get(tag, ())
+            total = sum(part / 60 ** i for i, part in enumerate(parts[:3]))
+            return -total if fields.get(ref) == negative else float(total)
+
+        altitude = float(fields.get(6, (0.0,))[0])
+        if fields.get(5, (0,))[0] == 1:
+            altitude = -altitude
+        return degrees(3, 4, 'W'), degrees(1, 2, 'S'), altitude
+
+
+def find_segments(data):
+    """Find the EXIF and IPTC data in a JPEG's APP1 and APP13 segments.
+
+    Returns the (start, end) of the TIFF structure and of the Photoshop image
+    resources, either of which is None if it isn't before the image data.
+    """
+    exif = iptc = None
+    position, limit = 2, min(len(data), MAX_HEADER)
+    while position + 4 <= limit:
+        if data[position] != 0xFF:
+            raise ValueError('Corrupt JPEG segment.')
+        marker = data[position + 1]
+        if marker == 0xFF:
+            position += 1
+            continue
+        if marker in (0xDA, 0xD9):
+            break
+        length, = unpack_from('>H', data, position + 2)
+        end = position + 2 + length
+        if marker == 0xE1 and exif is None and \
+           data[position + 4:position + 10] == b'Exif\0\0':
+            exif = position + 10, end
+        elif marker == 0xED and \
+             data[position + 4:position + 18] == b'Photoshop 3.0\0':
+            iptc = position + 18, end
+        position = end
+    return exif, iptc
+
+
+def find_iptc(data, start, end):
+    """Find the IPTC data among the Photoshop image resources of a JPEG."""
+    end = min(end, len(data), MAX_HEADER)
+    while start + 12 <= end and data[start:start + 4] == b'8BIM':
+        resource, = unpack_from('>H', data, start + 4)
+        # The name is a padded Pascal string, and the data is padded too.
+        name = data[start + 6] + 1
+        start += 6 + name + name % 2
+        if start + 4 > end:
+            break
+        size, = unpack_from('>I', data, start)
+        start += 4
+        if resource == IPTC_RESOURCE:
+            return start, min(start + size, end)
+        start += size + size % 2
+    return None
+
+
+def parse_iptc(data, start, end):
+    """Read the location names from a block of IPTC datasets."""
+    end = min(end, len(data), MAX_HEADER)
+    encoding = 'latin-1'
+    fields = {}
+    while start + 5 <= end and data[start] == 0x1C:
+        record, dataset = data[start + 1], data[start + 2]
+        size, = unpack_from('>H', data, start + 3)
+        if size & 0x8000:
+            # Extended datasets are never used for short text.
+            break
+        value = bytes(data[start + 5:min(start + 5 + size, end)])
+        if (record, dataset) == (1, 90) and value == b'\x1b%G':
+            encoding = 'utf-8'
+        elif record == 2 and dataset in IPTC_TAGS:
+            fields[IPTC_TAGS[dataset]] = value
+        start += 5 + size
+    return {key: value.decode(encoding, 'replace')
+            for key, value in fields.items()}
+
+
+def parse_header(data):
+    """Find the interesting EXIF and IPTC tags in the raw bytes of a photo.
+
+    Raises ValueError if the photo isn't a JPEG or TIFF, or if its EXIF data
+    is too badly damaged to make any sense of.
+    """
+    try:
+        return find_tags(data)
+    except (IndexError, KeyError, TypeError, ZeroDivisionError, struct_error):
+        raise ValueError('Corrupt EXIF data.')
+
+
+def find_tags(data):
+    """Collect the tags for parse_header(), which handles any errors."""
+    iptc = None
+    if data[:2] == b'\xff\xd8':
+        exif, resources = find_segments(data)
+        if resources is not None:
+            iptc = find_iptc(data, *resources)
+        if exif is None:
+            header = ExifHeader()
+            if iptc is not None:
+                header.update(parse_iptc(data, *iptc))
+            return header
+        tiff = TiffReader(data, *exif)
+    elif data[:4] in (b'II*\0', b'MM\0*'):
+        tiff = TiffReader(data, 0, len(data))
+    else:
+        raise ValueError('Unsupported file format.')
+
+    ifd0, = tiff.unpack('I', 4)
+    header = ExifHeader(tiff.tags(ifd0, IMAGE_TAGS))
+
+    exif = tiff.pointer(ifd0, EXIF_POINTER)
+    if exif is not None:
+        header.update(tiff.tags(exif, PHOTO_TAGS))
+
+    gps = tiff.pointer(ifd0, GPS_POINTER)
+    if gps is not None:
+        header.gps = tiff.gps(gps)
+
+    iptc = iptc or tiff.block(ifd0, IPTC_POINTER)
+    if iptc is not None:
+        header.update(parse_iptc(data, *iptc))
+
+    return header
+
+
+def read_header(filename):
+    """Read the interesting EXIF tags from the start of a file.
+
+    Raises OSError if the file can't be opened, or ValueError if the file
+    isn't in a format that can be read this way.
+
+    >>> header = read_header('demo/IMG_2411.JPG')
+    >>> header['Exif.Image.Make'], header['Exif.Image.Model']
+    ('Canon', 'Canon PowerShot A590 IS')
+    >>> header['Exif.Photo.DateTimeOriginal']
+    '2010:10:16 14:12:28'
+    >>> read_header('gg/exif.py')
+    Traceback (most recent call last):
+    ValueError: Unsupported file format.
+    """
+    with open(filename, 'rb') as photo:
+        try:
+            data = mmap(photo.fileno(), 0, access=ACCESS_READ)
+        except ValueError:
+            raise ValueError('Empty file.')
+    with data:
+        return parse_header(data)
+
+
+def sidecar_candidates(filename):
+    """List the names that a photo's XMP sidecar might have, preferred first.
+
+    Some programs append to the photo's extension, and others replace it.
+
+    >>> sidecar_candidates('/photos/IMG_2411.CR2')
+    ['/photos/IMG_2411.CR2.xmp', '/photos/IMG_2411.xmp']
+    """
+    return [filename + '.xmp', splitext(filename)[0] + '.xmp']
+
+
+def has_siblings(filename):
+    """Determine whether other files share the photo's name.
+
+    RAW+JPEG pairs such as IMG_1.CR2 and IMG_1.JPG can't tell whose sidecar
+    IMG_1.xmp is, so neither of them should read or write it.
+    """
+    for sibling in glob(escape(splitext(filename)[0]) + '.*'):
+        if sibling != filename and not sibling.lower().endswith('.xmp'):
+            return True
+    return False
+
+
+def find_sidecar(filename):
+    """Return the name of an existing XMP sidecar, or None."""
+    appended, replaced = sidecar_candidates(filename)
+    if exists(appended):
+        return appended
+    if exists(replaced) and not has_siblings(filename):
+        return replaced
+    return None
+
+
+def create_sidecar(filename):
+    """Find the photo's XMP sidecar, creating an empty one if necessary.
+
+    New sidecars always keep the photo's extension, so that every photo in a
+    RAW+JPEG pair gets its own.
+    """
+    sidecar = find_sidecar(filename)
+    if sidecar is None:
+        sidecar = sidecar_candidates(filename)[0]
+        try:
+            with open(sidecar, 'x', encoding='utf-8') as xmp:
+                xmp.write(EMPTY_XMP)
+        except FileExistsError:
+            pass
+    return sidecar
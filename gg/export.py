@@ -0,0 +1,235 @@
+# Author: Robert Park <robru@gottengeography.ca>, (C) 2015
+# Copyright: See COPYING file included with this distribution.
+
+"""Export where photos were taken, for use in other mapping software.
+
+Each photo is described by its filename, timestamp, coordinates, altitude,
+and the names of the place it was taken, as GeoJSON features, KML placemarks,
+GPX waypoints, or CSV rows. Photos can be anything with the same attributes
+as a gg.core.Fix. Every format is written by a generator that yields the
+file one small piece at a time, and the pieces are written out a few hundred
+at a time, so that exporting a hundred thousand photos never holds more than
+a few hundred of them in memory at once.
+
+>>> from io import StringIO
+>>> from collections import namedtuple
+>>> Fix = namedtuple('Fix', 'filename timestamp lat lon ele names timezone')
+>>> out = StringIO()
+>>> write_export([Fix('/dcim/IMG_1.JPG', 1287259751, 53.52263, -113.448979,
+...               671.666, ('Edmonton', 'Alberta', 'Canada'),
+...               'America/Edmonton')], out, 'CSV')
+>>> print(out.getvalue(), end='')
+filename,timestamp,latitude,longitude,altitude,city,state,country,timezone
+/dcim/IMG_1.JPG,2010-10-16T20:09:11Z,53.522630,-113.448979,671.7,Edmonton,\
+Alberta,Canada,America/Edmonton
+"""
+
+
+from xml.sax.saxutils import escape, quoteattr
+from os.path import basename, splitext
+from io import StringIO
+from time import gmtime, strftime
+import json
+import csv
+
+from gg.version import APPNAME
+
+
+# How many pieces of the file to collect before writing them out.
+EXPORT_CHUNK = 256
+
+# The format to use for each file extension.
+EXPORT_EXTENSIONS = {
+    '.geojson': 'GeoJSON',
+    '.json': 'GeoJSON',
+    '.kml': 'KML',
+    '.gpx': 'GPX',
+    '.csv': 'CSV',
+}
+
+CSV_COLUMNS = ('filename', 'timestamp', 'latitude', 'longitude', 'altitude',
+               'city', 'state', 'country', 'timezone')
+
+
+def export_format(filename):
+    """Determine the format to export to from the name of the file.
+
+    >>> export_format('photos.GeoJSON'), export_format('photos.kml')
+    ('GeoJSON', 'KML')
+
+    Raises ValueError for extensions that aren't any known format.
+    """
+    try:
+        return EXPORT_EXTENSIONS[splitext(filename)[1].lower()]
+    except KeyError:
+        raise ValueError('Unknown export format: {}'.format(filename))
+
+
+def located(fix):
+    """Determine whether a photo has a location at all.
+
+    Photos at exactly 0, 0 are considered to have no location, just like
+    everywhere else that reads GPS data from photos.
+    """
+    return bool(fix.lat or fix.lon)
+
+
+def iso_time(timestamp):
+    """Format epoch seconds in UTC, the way that every format here wants.
+
+    >>> iso_time(1287259751)
+    '2010-10-16T20:09:11Z'
+    """
+    return strftime('%Y-%m-%dT%H:%M:%SZ', gmtime(timestamp))
+
+
+def place_name(names):
+    """Join the city, state, and country names that are known.
+
+    >>> place_name(('Edmonton', None, 'Canada'))
+    'Edmonton, Canada'
+    """
+    return ', '.join(name for name in names if name)
+
+
+def geojson_pieces(fixes):
+    """Yield a GeoJSON FeatureCollection with a Point for each photo.
+
+    Photos without a location have a null geometry.
+    """
+    yield '{"type": "FeatureCollection", "features": [\n'
+    separator = ''
+    for fix in fixes:
+        city, state, country = fix.names
+        feature = {
+            'type': 'Feature',
+            'geometry': {
+                'type': 'Point',
+                'coordinates': [round(fix.lon, 6), round(fix.lat, 6),
+                                round(fix.ele, 1)],
+            } if located(fix) else None,
+            'properties': {
+                'filename': fix.filename,
+                'timestamp': iso_time(fix.timestamp),
+                'city': city,
+                'state': state,
+                'country': country,
+                'timezone': fix.timezone or None,
+            },
+        }
+        yield separator + json.dumps(feature, sort_keys=True)
+        separator = ',\n'
+    yield '\n]}\n'
+
+
+def kml_pieces(fixes):
+    """Yield a KML Document with a Placemark for each photo.
+
+    Photos without a location have no Point.
+    """
+    yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+           '<kml xmlns="http://www.opengis.net/kml/2.2">\n'
+           '<Document>\n'
+           '<name>{}</name>\n').format(escape(APPNAME))
+    for fix in fixes:
+        placemark = [
+            '<Placemark>\n',
+            '  <name>{}</name>\n'.format(escape(basename(fix.filename))),
+            '  <description>{}</description>\n'.format(
+                escape(place_name(fix.names))),
+            '  <TimeStamp><when>{}</when></TimeStamp>\n'.format(
+                iso_time(fix.timestamp)),
+            '  <ExtendedData><Data name="filename"><value>{}</value>'
+            '</Data></ExtendedData>\n'.format(escape(fix.filename)),
+        ]
+        if located(fix):
+            placemark.append(
+                '  <Point><altitudeMode>absolute</altitudeMode>'
+                '<coordinates>{:.6f},{:.6f},{:.1f}</coordinates></Point>\n'
+                .format(fix.lon, fix.lat, fix.ele))
+        placemark.append('</Placemark>\n')
+        yield ''.join(placemark)
+    yield '</Document>\n</kml>\n'
+
+
+def gpx_pieces(fixes):
+    """Yield a GPX file with a waypoint for each photo.
+
+    Photos without a location are left out, because GPX can't describe them.
+    """
+    yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+           '<gpx version="1.1" creator={} '
+           'xmlns="http://www.topografix.com/GPX/1/1">\n').format(
+               quoteattr(APPNAME))
+    for fix in fixes:
+        if not located(fix):
+            continue
+        yield ('<wpt lat="{:.6f}" lon="{:.6f}">'
+               '<ele>{:.1f}</ele>'
+               '<time>{}</time>'
+               '<name>{}</name>'
+               '<desc>{}</desc>'
+               '<src>{}</src>'
+               '</wpt>\n').format(
+                   fix.lat, fix.lon, fix.ele, iso_time(fix.timestamp),
+                   escape(basename(fix.filename)),
+                   escape(place_name(fix.names)), escape(fix.filename))
+    yield '</gpx>\n'
+
+
+def csv_pieces(fixes):
+    """Yield a CSV header and then one row for each photo.
+
+    Photos without a location have empty coordinates.
+    """
+    buffer = StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+
+    def row(values):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(values)
+        return buffer.getvalue()
+
+    yield row(CSV_COLUMNS)
+    for fix in fixes:
+        coords = (('{:.6f}'.format(fix.lat), '{:.6f}'.format(fix.lon),
+                   '{:.1f}'.format(fix.ele))
+                  if located(fix) else ('', '', ''))
+        yield row((fix.filename, iso_time(fix.timestamp)) + coords +
+                  tuple(name or '' for name in fix.names) +
+                  (fix.timezone or '',))
+
+
+WRITERS = {
+    'GeoJSON': geojson_pieces,
+    'KML': kml_pieces,
+    'GPX': gpx_pieces,
+    'CSV': csv_pieces,
+}
+
+
+def write_export(fixes, stream, kind):
+    """Write photos to an open text stream in the given format.
+
+    `fixes` may be any iterable, including a generator, and is only iterated
+    over once.
+    """
+    pieces = []
+    for piece in WRITERS[kind](fixes):
+        pieces.append(piece)
+        if len(pieces) >= EXPORT_CHUNK:
+            stream.write(''.join(pieces))
+            pieces.clear()
+    stream.write(''.join(pieces))
+
+
+def export(fixes, filename, kind=None):
+    """Write photos to a file, in the format its extension suggests.
+
+    Raises ValueError if the format is unknown, or OSError if the file
+    can't be written.
+    """
+    kind = kind or export_format(filename)
+    with open(filename, 'w', encoding='utf-8', newline='') as stream:
+        write_export(fixes, stream, kind)
@@ -0,0 +1,190 @@
+# Author: Robert Park <robru@gottengeography.ca>, (C) 2015
+# Copyright: See COPYING file included with this distribution.
+
+"""Figure out what kind of file something is by looking inside of it.
+
+Photos are recognized by the magic bytes at the start of the file, and GPS
+tracks by the root element of their XML, so that each file can be handed
+straight to the right loader instead of trying every loader in turn. Only
+the first few kilobytes of each file are ever read.
+
+Whole folders can also be imported, in which case they're walked lazily and
+only files that look like photos or tracks by their name and size are opened.
+
+>>> sniff('demo/IMG_2411.JPG')
+'JPEG'
+>>> sniff('demo/2010 10 16.gpx')
+'GPX'
+"""
+
+
+from re import compile as re_compile, DOTALL
+from os.path import isdir, splitext
+from os import scandir
+
+
+# How much of the start of a file to look at.
+SNIFF_BYTES = 4096
+
+# The formats that are loaded by a TrackFile subclass of the same name.
+TRACK_FORMATS = ('GPX', 'TCX', 'KML', 'CSV')
+
+# Formats that aren't photos or tracks, and so can't be opened at all.
+UNSUPPORTED_FORMATS = ('XML', 'TEXT')
+
+# Files in imported folders are skipped unless they have one of these
+# extensions. Explicitly chosen files are always opened.
+IMPORT_EXTENSIONS = frozenset((
+    '.jpg', '.jpeg', '.jpe', '.tif', '.tiff', '.png', '.webp',
+    '.heic', '.heif', '.dng', '.cr2', '.cr3', '.crw', '.nef', '.nrw',
+    '.arw', '.sr2', '.srf', '.orf', '.rw2', '.raf', '.pef', '.srw',
+    '.x3f', '.mrw', '.3fr', '.erf', '.kdc', '.rwl',
+    '.gpx', '.tcx', '.kml', '.csv',
+))
+
+# Files in imported folders that are smaller than this can't possibly hold
+# a photo or a GPS track, so they aren't even opened.
+MIN_IMPORT_SIZE = 100
+
+# (offset, magic bytes, format), checked in order.
+MAGIC = (
+    (0, b'\xff\xd8\xff', 'JPEG'),
+    (0, b'II*\0\x10\0\0\0CR', 'RAW'),
+    (0, b'II*\0', 'TIFF'),
+    (0, b'MM\0*', 'TIFF'),
+    (0, b'IIRO', 'RAW'),
+    (0, b'IIRS', 'RAW'),
+    (0, b'IIU\0', 'RAW'),
+    (0, b'II\x1a\0\0\0HEAPCCDR', 'RAW'),
+    (0, b'FUJIFILMCCD-RAW', 'RAW'),
+    (0, b'\0MRM', 'RAW'),
+    (0, b'FOVb', 'RAW'),
+    (4, b'ftypcrx', 'RAW'),
+    (4, b'ftyphei', 'HEIF'),
+    (4, b'ftypmif1', 'HEIF'),
+    (0, b'\x89PNG\r\n\x1a\n', 'PNG'),
+    (8, b'WEBP', 'WebP'),
+)
+
+# The track format that each kind of XML document is.
+ROOT_ELEMENTS = {
+    'gpx': 'GPX',
+    'TrainingCenterDatabase': 'TCX',
+    'kml': 'KML',
+}
+
+COMMENT = re_compile(rb'<!--.*?-->', DOTALL)
+ELEMENT = re_compile(rb'<(?![?!/])(?:[\w.-]+:)?([\w.-]+)')
+CSV_HEADER = b'"Latitude (deg)"'
+
+
+def root_element(data):
+    """Find the name of the first element in some XML, without any prefix.
+
+    >>> root_element(b'<?xml version="1.0"?><!-- <no> --><kml:kml>')
+    'kml'
+    >>> root_element(b'Time,Latitude') is None
+    True
+    """
+    match = ELEMENT.search(COMMENT.sub(b'', data))
+    return match.group(1).decode('utf-8', 'replace') if match else None
+
+
+def sniff_bytes(data, filename=''):
+    """Identify a file from the first few kilobytes of it.
+
+    Returns the name of the format, or None if it's binary data of some sort
+    that isn't recognized, which might still be a photo that GExiv2 can read.
+
+    >>> sniff_bytes(b'\\xef\\xbb\\xbf<?xml version="1.0"?>\\n'
+    ...             b'<gpx version="1.1">')
+    'GPX'
+    >>> sniff_bytes(b'<html>')
+    'XML'
+    >>> sniff_bytes(b'"Segment","Latitude (deg)","Longitude (deg)"')
+    'CSV'
+    >>> sniff_bytes(b'Dear diary,')
+    'TEXT'
+    >>> sniff_bytes(b'\\x00\\x01\\x02') is None
+    True
+    """
+    for offset, magic, kind in MAGIC:
+        if data[offset:offset + len(magic)] == magic:
+            return kind
+
+    if data[:2] in (b'\xff\xfe', b'\xfe\xff'):
+        data = data.decode('utf-16', 'ignore').encode('utf-8')
+    elif data[:3] == b'\xef\xbb\xbf':
+        data = data[3:]
+
+    if data.lstrip().startswith(b'<'):
+        return ROOT_ELEMENTS.get(root_element(data), 'XML')
+    if b'\0' in data:
+        return None
+    if CSV_HEADER in data or splitext(filename)[1].lower() == '.csv':
+        return 'CSV'
+    return 'TEXT'
+
+
+def sniff(filename):
+    """Identify a file by its contents. Raises OSError if it can't be read."""
+    with open(filename, 'rb') as unknown:
+        return sniff_bytes(unknown.read(SNIFF_BYTES), filename)
+
+
+def importable(name):
+    """Determine whether a file in an imported folder might be importable.
+
+    >>> importable('IMG_2411.JPG'), importable('.IMG_2411.JPG.part')
+    (True, False)
+    """
+    return not name.startswith('.') and \
+        splitext(name)[1].lower() in IMPORT_EXTENSIONS
+
+
+def walk_folder(folder):
+    """Yield the files in a folder and its subfolders that might be importable.
+
+    Files are filtered by extension and size using only what os.scandir()
+    already knows, and are yielded as soon as they're found so that they
+    can be loaded while the rest of the folder is still being walked. Hidden
+    files and folders are skipped, and symlinks to folders aren't followed.
+    Folders that can't be read are silently skipped.
+    """
+    pending = [folder]
+    while pending:
+        try:
+            with scandir(pending.pop()) as listing:
+                entries = sorted(listing, key=lambda entry: entry.name)
+        except OSError:
+            continue
+        subfolders = []
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subfolders.append(entry.path)
+                elif importable(entry.name) \
+                        and entry.stat().st_size >= MIN_IMPORT_SIZE:
+                    yield entry.path
+            except OSError:
+                continue
+        pending.extend(reversed(subfolders))
+
+
+def walk_files(paths):
+    """Yield the given files, with any folders replaced by their contents.
+
+    >>> for filename in walk_files(['demo', 'README.md']):
+    ...     print(filename)
+    demo/2010 10 16.gpx
+    demo/IMG_2411.JPG
+    demo/IMG_2421.JPG
+    README.md
+    """
+    for path in paths:
+        if isdir(path):
+            yield from walk_folder(path)
+        else:
+            yield path
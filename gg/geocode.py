@@ -0,0 +1,123 @@
+# Author: Robert Park <robru@gottengeography.ca>, (C) 2015
+# Copyright: See COPYING file included with this distribution.
+
+"""Find the nearest city to a point, without any user interface.
+
+The names of the city, province/state, and country, along with the timezone,
+are looked up from the geonames.org data that ships with GottenGeography.
+Lookups are cached with a precision of about a kilometer, since photos taken
+on the same walk all end up in the same city anyway.
+
+>>> lookup_geodata(53.5, -113.5)
+(('Edmonton', 'Alberta', 'Canada'), 'America/Edmonton')
+"""
+
+
+from functools import lru_cache
+from os.path import abspath, dirname, isfile, join
+
+from gg.territories import get_state, get_country
+from gg.trace import count, traced
+
+
+def valid_coords(lat, lon):
+    """Determine the validity of coordinates.
+
+    >>> valid_coords(200, 300)
+    False
+    >>> valid_coords(40.689167, -74.044678)
+    True
+    >>> valid_coords(50, [])
+    False
+    """
+    if type(lat) not in (float, int): return False
+    if type(lon) not in (float, int): return False
+    return abs(lat) <= 90 and abs(lon) <= 180
+
+
+@lru_cache(maxsize=None)
+def cities_file():
+    """Find the geonames.org data, without any of the GUI's setup.
+
+    The source tree's copy of gg.build_info compiles the GSettings schemas and
+    asks git for the version, neither of which geotagging without a display
+    needs, so the data folder next to gg is looked for first. Installed
+    copies of gg.build_info are only constants, and are safe to import.
+
+    >>> cities_file().endswith('cities.txt')
+    True
+    """
+    source = join(dirname(dirname(abspath(__file__))), 'data', 'cities.txt')
+    if isfile(source):
+        return source
+    from gg.build_info import PKG_DATA_DIR
+    return join(PKG_DATA_DIR, 'cities.txt')
+
+
+@lru_cache(maxsize=None)
+@traced('geocode.scan')
+def do_cached_lookup(key):
+    """Scan cities.txt for the nearest town.
+
+    >>> do_cached_lookup(GeoCacheKey(43.646424, -79.333426))
+    ('Toronto', '08', 'CA', 'America/Toronto\\n')
+    >>> do_cached_lookup(GeoCacheKey(48.440257, -89.204443))
+    ('Thunder Bay', '08', 'CA', 'America/Thunder_Bay\\n')
+    """
+    near, dist = None, float('inf')
+    lat1, lon1 = key.lat, key.lon
+    with open(cities_file()) as cities:
+        for city in cities:
+            name, lat2, lon2, country, state, tz = city.split('\t')
+            x = (float(lon2) - lon1)
+            y = (float(lat2) - lat1)
+            delta = x * x + y * y
+            if delta < dist:
+                dist = delta
+                near = (name, state, country, tz)
+    return near
+
+
+def lookup_geodata(lat, lon):
+    """Return ((city, state, country), timezone) for the nearest town."""
+    count('geocode.lookups')
+    city, state, code, tz = do_cached_lookup(GeoCacheKey(lat, lon))
+    return (city, get_state(code, state), get_country(code)), tz.strip()
+
+
+class GeoCacheKey:
+    """This class allows fuzzy geodata cache lookups."""
+
+    def __init__(self, lat, lon):
+        self.key = '{:.2f},{:.2f}'.format(lat, lon)
+        self.lat = lat
+        self.lon = lon
+
+    def __str__(self):
+        """Show the key being used.
+
+        >>> print(GeoCacheKey(53.564, -113.564))
+        53.56,-113.56
+        """
+        return self.key
+
+    def __hash__(self):
+        """Different instances can be used to fetch dictionary values.
+
+        >>> cache = { GeoCacheKey(53.564, -113.564): 'example' }
+        >>> cache.get(GeoCacheKey(53.559, -113.560))
+        'example'
+        >>> cache.get(GeoCacheKey(0, 0), 'Missing')
+        'Missing'
+        """
+        return hash(self.key)
+
+    def __eq__(self, other):
+        """Different instances can compare equally.
+
+        >>> GeoCacheKey(10.004, 10.004) == GeoCacheKey(9.996, 9.996)
+        True
+        >>> GeoCacheKey(10.004, 10.004) == GeoCacheKey(0, 0)
+        False
+        """
+        return self.key == other.key
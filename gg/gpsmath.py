@@ -1,93 +1,18 @@
 # Author: Robert Park <robru@gottengeography.ca>, (C) 2010
 # Copyright: See COPYING file included with this distribution.
 
-"""Reverse geocoding and other mathematical calculations."""
+"""Coordinates that notify the user interface when they change.
+
+The reverse geocoding itself is done by gg.geocode.
+"""
 
 
 from gi.repository import GLib, GObject
 from time import strftime, localtime
+from datetime import datetime
 from gettext import gettext as _
-from os.path import join
-
-from gg.territories import get_state, get_country
-from gg.build_info import PKG_DATA_DIR
-from gg.common import memoize
-
-
-def valid_coords(lat, lon):
-    """Determine the validity of coordinates.
-
-    >>> valid_coords(200, 300)
-    False
-    >>> valid_coords(40.689167, -74.044678)
-    True
-    >>> valid_coords(50, [])
-    False
-    """
-    if type(lat) not in (float, int): return False
-    if type(lon) not in (float, int): return False
-    return abs(lat) <= 90 and abs(lon) <= 180
 
-
-@memoize
-def do_cached_lookup(key):
-    """Scan cities.txt for the nearest town.
-
-    >>> do_cached_lookup(GeoCacheKey(43.646424, -79.333426))
-    ('Toronto', '08', 'CA', 'America/Toronto\\n')
-    >>> do_cached_lookup(GeoCacheKey(48.440257, -89.204443))
-    ('Thunder Bay', '08', 'CA', 'America/Thunder_Bay\\n')
-    """
-    near, dist = None, float('inf')
-    lat1, lon1 = key.lat, key.lon
-    with open(join(PKG_DATA_DIR, 'cities.txt')) as cities:
-        for city in cities:
-            name, lat2, lon2, country, state, tz = city.split('\t')
-            x = (float(lon2) - lon1)
-            y = (float(lat2) - lat1)
-            delta = x * x + y * y
-            if delta < dist:
-                dist = delta
-                near = (name, state, country, tz)
-    return near
-
-
-class GeoCacheKey:
-    """This class allows fuzzy geodata cache lookups."""
-
-    def __init__(self, lat, lon):
-        self.key = '{:.2f},{:.2f}'.format(lat, lon)
-        self.lat = lat
-        self.lon = lon
-
-    def __str__(self):
-        """Show the key being used.
-
-        >>> print(GeoCacheKey(53.564, -113.564))
-        53.56,-113.56
-        """
-        return self.key
-
-    def __hash__(self):
-        """Different instances can be used to fetch dictionary values.
-
-        >>> cache = { GeoCacheKey(53.564, -113.564): 'example' }
-        >>> cache.get(GeoCacheKey(53.559, -113.560))
-        'example'
-        >>> cache.get(GeoCacheKey(0, 0), 'Missing')
-        'Missing'
-        """
-        return hash(self.key)
-
-    def __eq__(self, other):
-        """Different instances can compare equally.
-
-        >>> GeoCacheKey(10.004, 10.004) == GeoCacheKey(9.996, 9.996)
-        True
-        >>> GeoCacheKey(10.004, 10.004) == GeoCacheKey(0, 0)
-        False
-        """
-        return self.key == other.key
+from gg.geocode import lookup_geodata
 
 
 class Coordinates(GObject.GObject):
@@ -128,6 +53,7 @@ class Coordinates(GObject.GObject):
     """
     modified_timeout = None
     timeout_seconds = 0
+    tzinfo = None
     geotimezone = ''
     names = (None, None, None)
 
@@ -154,6 +80,9 @@ class Coordinates(GObject.GObject):
     @GObject.property(type=str)
     def date(self):
         """Convert epoch seconds to a human-readable date."""
+        if self.timestamp and self.tzinfo is not None:
+            return datetime.fromtimestamp(
+                self.timestamp, self.tzinfo).strftime('%Y-%m-%d %X')
         if self.timestamp:
             return strftime('%Y-%m-%d %X', localtime(self.timestamp))
 
@@ -219,10 +148,8 @@ class Coordinates(GObject.GObject):
             return
 
         old_geoname = self.geoname
-        city, state, code, tz = do_cached_lookup(
-            GeoCacheKey(self.latitude, self.longitude))
-        self.names = (city, get_state(code, state), get_country(code))
-        self.geotimezone = tz.strip()
+        self.names, self.geotimezone = lookup_geodata(
+            self.latitude, self.longitude)
         if self.geoname != old_geoname:
             self.notify('geoname')
 
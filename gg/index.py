@@ -0,0 +1,136 @@
+# Author: Robert Park <robru@gottengeography.ca>, (C) 2015
+# Copyright: See COPYING file included with this distribution.
+
+"""Remember what was read from each photo, so it needn't be read again.
+
+The index is a small SQLite database that maps each photo's path to the
+metadata that was read from it, along with a signature of the file's size and
+timestamps. As long as the signature still matches, the photo hasn't changed
+and the stored metadata can be used without opening the photo at all.
+
+The inode change time is part of the signature because saving a photo
+deliberately preserves its modification time, and so do other tools. The
+sidecar's modification time is included too, since a location saved there
+takes precedence over the photo's own.
+
+The index does nothing until it's opened, and if it can't be opened then it
+quietly stays that way, because it's only ever an optimization.
+
+>>> index = MetadataIndex()
+>>> index.open(':memory:')
+>>> signature = index.signature('demo/IMG_2411.JPG')
+>>> index.get('demo/IMG_2411.JPG', signature) is None
+True
+>>> index.put('demo/IMG_2411.JPG', signature, {'Make': 'Canon'})
+>>> index.get('demo/IMG_2411.JPG', signature)
+{'Make': 'Canon'}
+>>> index.get('demo/IMG_2411.JPG', 'some other signature') is None
+True
+"""
+
+
+from os import makedirs, stat
+from os.path import dirname
+from threading import Lock
+from json import dumps, loads
+import sqlite3
+
+from gg.exif import find_sidecar
+
+
+# Bump this whenever the stored values change shape, to start over.
+SCHEMA_VERSION = 1
+
+# Commit after this many new rows, so a crash doesn't lose everything.
+COMMIT_EVERY = 500
+
+
+class MetadataIndex:
+    """A thread-safe store of JSON values, keyed by path and signature."""
+
+    def __init__(self):
+        self.db = None
+        self.lock = Lock()
+        self.pending = 0
+
+    def open(self, path):
+        """Open (or create) the index database at the given path."""
+        try:
+            if path != ':memory:':
+                makedirs(dirname(path), exist_ok=True)
+            db = sqlite3.connect(path, check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            version, = db.execute('PRAGMA user_version').fetchone()
+            if version != SCHEMA_VERSION:
+                db.execute('DROP TABLE IF EXISTS photos')
+                db.execute('PRAGMA user_version={}'.format(SCHEMA_VERSION))
+            db.execute('CREATE TABLE IF NOT EXISTS photos ('
+                       'path TEXT PRIMARY KEY, '
+                       'signature TEXT NOT NULL, '
+                       'metadata TEXT NOT NULL)')
+            db.commit()
+        except (OSError, sqlite3.Error):
+            return
+        self.close()
+        self.db = db
+
+    def close(self):
+        """Save any pending changes and stop using the database."""
+        if self.db is not None:
+            self.commit()
+            self.db.close()
+            self.db = None
+
+    @staticmethod
+    def signature(filename):
+        """Describe the current state of a file and its sidecar.
+
+        Raises OSError if the file doesn't exist.
+        """
+        info = stat(filename)
+        sidecar = find_sidecar(filename)
+        return '{} {} {} {}'.format(
+            info.st_size, info.st_mtime_ns, info.st_ctime_ns,
+            stat(sidecar).st_mtime_ns if sidecar else '-')
+
+    def get(self, filename, signature):
+        """Return what was stored for the file, if it hasn't changed since."""
+        if self.db is None:
+            return None
+        with self.lock:
+            try:
+                row = self.db.execute(
+                    'SELECT metadata FROM photos '
+                    'WHERE path = ? AND signature = ?',
+                    (filename, signature)).fetchone()
+            except sqlite3.Error:
+                return None
+        return None if row is None else loads(row[0])
+
+    def put(self, filename, signature, metadata):
+        """Store some JSON-compatible metadata for the file."""
+        if self.db is None:
+            return
+        with self.lock:
+            try:
+                self.db.execute(
+                    'INSERT OR REPLACE INTO photos VALUES (?, ?, ?)',
+                    (filename, signature, dumps(metadata)))
+            except sqlite3.Error:
+                return
+            self.pending += 1
+        if self.pending >= COMMIT_EVERY:
+            self.commit()
+
+    def commit(self):
+        """Write any new rows to disk."""
+        if self.db is None:
+            return
+        with self.lock:
+            if self.pending:
+                try:
+                    self.db.commit()
+                except sqlite3.Error:
+                    pass
+                self.pending = 0
@@ -0,0 +1,176 @@
+# Author: Robert Park <robru@gottengeography.ca>, (C) 2015
+# Copyright: See COPYING file included with this distribution.
+
+"""Read and write the metadata that geotagging cares about.
+
+This is everything that happens to a photo's file, as opposed to what happens
+to it on screen. Nothing in here touches the user interface or any shared
+state other than the metadata index, so all of it is safe to call from worker
+threads, or from a program without any windows at all. GExiv2 is still needed
+for writing, and for reading anything more exotic than JPEG or TIFF.
+
+>>> metadata = read_metadata('demo/IMG_2411.JPG')
+>>> metadata.camera_info['Model']
+'Canon PowerShot A590 IS'
+>>> metadata.gps
+(0.0, 0.0, 0.0)
+"""
+
+
+from gi.repository import GExiv2, GObject
+from collections import namedtuple
+from contextlib import suppress
+from datetime import datetime
+from time import struct_time
+from os import stat, utime
+
+from gg.exif import read_header, find_sidecar, create_sidecar
+from gg.index import MetadataIndex
+from gg.trace import count, traced
+
+
+# Prefixes for common EXIF keys.
+IPTC = 'Iptc.Application2.'
+
+# How many files to read metadata from at once. This is mostly waiting on disk
+# or network latency rather than CPU, so it can be more than the CPU count.
+METADATA_WORKERS = 8
+
+# How many photos to save at once. Saving rewrites the whole file, so this is
+# mostly waiting on the disk too, but too many at once just thrash it.
+SAVE_WORKERS = 4
+
+# Everything that Photograph.read() needs to know about a file.
+Metadata = namedtuple('Metadata', 'exif orig_time gps names camera_info')
+
+# Remembers the metadata of photos that have been read before.
+metadata_index = MetadataIndex()
+
+
+def quantize(location, names):
+    """Reduce a location and its names to what is worth saving.
+
+    Coordinates are rounded to about a metre, and altitude to a decimetre,
+    which is finer than any consumer GPS and coarser than the rounding that
+    happens when they're stored as EXIF rationals. Locations that only differ
+    by that much are considered to be the same place.
+
+    >>> quantize((-113.4700001, 53.5333333, 668.04), ('Edmonton', None, ''))
+    ((-113.47, 53.53333, 668.0), ('Edmonton', '', ''))
+    """
+    lon, lat, alt = location
+    return ((round(lon, 5), round(lat, 5), round(alt, 1)),
+            tuple(name or '' for name in names))
+
+
+def read_names(exif):
+    """Read the (city, province, country) names saved in IPTC data."""
+    names = []
+    for key in ('City', 'ProvinceState', 'CountryName'):
+        try:
+            names.append(exif[IPTC + key] or None)
+        except KeyError:
+            names.append(None)
+    return tuple(names)
+
+
+def read_metadata(filename):
+    """Find the metadata that is needed for geotagging a photo.
+
+    Photos that haven't changed since they were last read are loaded from the
+    metadata index without being opened at all, in which case the GExiv2
+    handle in the result is None. This is safe to call from a worker thread.
+    Raises OSError if the file isn't a photo.
+    """
+    signature = metadata_index.signature(filename)
+    cached = metadata_index.get(filename, signature)
+    if cached is not None:
+        count('exif.index_hits')
+        orig_time, gps, names, camera_info = cached
+        return Metadata(None, orig_time and struct_time(orig_time),
+                        tuple(gps), tuple(names), camera_info)
+
+    metadata = parse_metadata(filename)
+    orig_time = metadata.orig_time
+    metadata_index.put(filename, signature, [
+        orig_time and list(orig_time), metadata.gps, metadata.names,
+        metadata.camera_info])
+    return metadata
+
+
+@traced('exif.read')
+def parse_metadata(filename):
+    """Parse the EXIF data that is needed for geotagging a photo.
+
+    This doesn't touch any shared state, so it's safe to call from a worker
+    thread. Raises OSError if the file isn't a photo.
+
+    Most photos are read with the lightweight header parser, in which case
+    the GExiv2 handle in the result is None, and it's only opened when the
+    photo is saved. Anything more exotic than JPEG or TIFF goes to GExiv2.
+    """
+    try:
+        exif = header = read_header(filename)
+    except ValueError:
+        try:
+            exif = header = GExiv2.Metadata(filename)
+        except GObject.GError:
+            raise OSError('{}: Not a photo.'.format(filename))
+    else:
+        exif = None
+
+    orig_time = None
+    for tag in ('Exif.Photo.DateTimeOriginal',
+                'Exif.Image.DateTimeOriginal',
+                'Exif.Photo.DateTime',
+                'Exif.Image.DateTime'):
+        with suppress(TypeError, AttributeError, ValueError):
+            orig_time = datetime.strptime(
+                header.get(tag), '%Y:%m:%d %H:%M:%S').timetuple()
+            break
+
+    camera_info = {'Make': '', 'Model': ''}
+    keys = ['Exif.Image.' + key for key in list(camera_info.keys())
+            + ['CameraSerialNumber']] + ['Exif.Photo.BodySerialNumber']
+    for key in keys:
+        with suppress(KeyError):
+            camera_info.update({key.split('.')[-1]: header[key]})
+
+    # Locations saved to a sidecar take precedence over the photo's own.
+    gps, names = header.get_gps_info(), read_names(header)
+    sidecar = find_sidecar(filename)
+    if sidecar is not None:
+        with suppress(GObject.GError):
+            xmp = GExiv2.Metadata(sidecar)
+            if any(xmp.get_gps_info()[:2]):
+                gps, names = xmp.get_gps_info(), read_names(xmp)
+
+    return Metadata(exif, orig_time, gps, names, camera_info)
+
+
+@traced('exif.write')
+def save_metadata(filename, exif, location, names, sidecar=False):
+    """Write a location into a photo's EXIF data, preserving its mtime.
+
+    If sidecar is true, then the photo is left alone and the location is
+    written to its XMP sidecar instead, which is created if necessary. GExiv2
+    converts the EXIF and IPTC tags to their XMP equivalents when saving it.
+
+    This doesn't touch any shared state, so it's safe to call from a worker
+    thread. Returns the GExiv2 handle for the photo, which is opened if exif
+    is None and the photo is being written to.
+    """
+    if sidecar:
+        target = GExiv2.Metadata(create_sidecar(filename))
+    else:
+        times = stat(filename)
+        target = exif = exif or GExiv2.Metadata(filename)
+    target.set_gps_info(*location)
+    target[IPTC + 'City'] = names[0] or ''
+    target[IPTC + 'ProvinceState'] = names[1] or ''
+    target[IPTC + 'CountryName'] = names[2] or ''
+    target['Iptc.Envelope.CharacterSet'] = '\x1b%G'
+    target.save_file()
+    if not sidecar:
+        utime(filename, (times.st_atime, times.st_mtime))
+    return exif
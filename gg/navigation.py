@@ -10,7 +10,7 @@ GtkClutter.init([])
 from gi.repository import Gdk
 
 from gg.common import Gst
-from gg.gpsmath import valid_coords
+from gg.geocode import valid_coords
 from gg.widgets import Widgets, MapView
 
 
@@ -9,21 +9,28 @@ GtkClutter.init([])
 
 from gi.repository import Gdk, GdkPixbuf, GExiv2
 from gi.repository import Gio, GObject
-from datetime import datetime
 from os.path import basename
-from time import mktime
-from os import stat, utime
 
 from gg.label import Label
 from gg.widgets import Widgets
-from gg.xmlfiles import TrackFile
 from gg.gpsmath import Coordinates
+from gg.core import photo_timestamp
+from gg.metadata import quantize, read_metadata, save_metadata
+from gg.thumbnails import get_flavor, load_thumbnail, save_thumbnail
+from gg.thumbnails import get_placeholder, scale_to_fit
+from gg.thumbnails import ThumbnailQueue, ThumbnailMemory, PixbufCache
 from gg.camera import Camera, CameraView
-from gg.common import Gst, memoize, staticmethod, ignored, points, modified
+from gg.common import Gst, memoize, staticmethod, ignored, modified
+from gg.common import timeline, photo_index
+from gg.trace import span, count
 
 
-# Prefixes for common EXIF keys.
-IPTC = 'Iptc.Application2.'
+# How many rows beyond the visible ones to load thumbnails for.
+PREFETCH_ROWS = 20
+
+# How many large previews to keep in memory. This must be at least 3, to hold
+# the current photo and the ones on either side of it.
+LARGE_PREVIEWS = 5
 
 
 # This defines the transformations used by the Exif.Image.Orientation tag.
@@ -51,45 +58,45 @@ ROTATIONS = {
 }
 
 
-# This function is the embodiment of my applications core logic.
-# Everything else is just implementation details.
 def auto_timestamp_comparison(photo):
     """Use GPX data to calculate photo coordinates and elevation."""
-    if photo.manual or len(TrackFile.range) < 2:
-        return
+    timeline.correlate([photo])
 
-    # Clamp the timestamp within the range of available GPX points.
-    # The result is in epoch seconds, just like the keys of the 'points' dict.
-    stamp = sorted(TrackFile.range + [photo.timestamp])[1]
 
-    try:
-        point = points[stamp]  # Try to use an exact match,
-        lat = point.lat        # if such a thing were to exist.
-        lon = point.lon        # It's more likely than you think. 50%
-        ele = point.ele        # of the included demo data matches here.
+def fetch_preview(exif, size, smaller=False):
+    """Decode the smallest embedded preview that is at least size pixels.
+
+    Most cameras embed a small EXIF thumbnail and one or more larger JPEG
+    previews in every photo, and decoding one of those is much faster than
+    decoding a 24 megapixel JPEG or RAW file just to shrink it down again.
+    Returns None if there is no preview that is big enough, unless smaller
+    is True, in which case the largest preview is used instead (without
+    upscaling it). That's for files that can't be decoded any other way.
+    """
+    previews = exif.get_preview_properties()
+    if not previews:
+        return None
 
-    except KeyError:
-        # Find the two points that are nearest (in time) to the photo.
-        hi = min([p for p in points if p > stamp])
-        lo = max([p for p in points if p < stamp])
-        hi_point = points[hi]
-        lo_point = points[lo]
-        hi_ratio = (stamp - lo) / (hi - lo)  # Proportional amount of time
-        lo_ratio = (hi - stamp) / (hi - lo)  # between each point & the photo.
+    def pixels(preview):
+        return max(preview.get_width(), preview.get_height())
 
-        # Find intermediate values using the proportional ratios.
-        lat = ((lo_point.lat * lo_ratio) +
-               (hi_point.lat * hi_ratio))
-        lon = ((lo_point.lon * lo_ratio) +
-               (hi_point.lon * hi_ratio))
-        ele = ((lo_point.ele * lo_ratio) +
-               (hi_point.ele * hi_ratio))
+    big = [preview for preview in previews if pixels(preview) >= size]
+    if big:
+        preview = min(big, key=lambda p: p.get_width() * p.get_height())
+    elif smaller:
+        preview = max(previews, key=lambda p: p.get_width() * p.get_height())
+        size = pixels(preview)
+    else:
+        return None
 
-    photo.set_location(lat, lon, ele)
+    return GdkPixbuf.Pixbuf.new_from_stream_at_scale(
+        Gio.MemoryInputStream.new_from_data(
+            exif.get_preview_image(preview).get_data(), None),
+        size, size, True, None)
 
 
 def fetch_thumbnail(filename, size=Gst.get_int('thumbnail-size'), orient=1):
-    """Load a photo's thumbnail from disk
+    """Load a photo's thumbnail, from the shared thumbnail cache if possible.
 
     >>> fetch_thumbnail('gg/widgets.py')
     Traceback (most recent call last):
@@ -97,28 +104,142 @@ def fetch_thumbnail(filename, size=Gst.get_int('thumbnail-size'), orient=1):
     >>> type(fetch_thumbnail('demo/IMG_2411.JPG'))
     <class 'gi.repository.GdkPixbuf.Pixbuf'>
     """
-    try:
-        exif = GExiv2.Metadata(filename)
-    except GObject.GError:
-        raise OSError('{}: No thumbnail found.'.format(filename))
+    thumb = load_thumbnail(filename, size)
+    if thumb is not None:
+        count('thumbnail.cache_hits')
+        return thumb
 
-    with ignored(KeyError, ValueError):
-        orient = int(exif['Exif.Image.Orientation'])
+    # Generate the standard size so that it can be cached & shared.
+    flavor = get_flavor(size)
+    pixels = size if flavor is None else flavor[1]
 
-    try:
-        thumb = GdkPixbuf.Pixbuf.new_from_file_at_size(filename, size, size)
-    except GObject.GError:
+    with span('thumbnail.decode', file=filename):
         try:
-            preview = exif.get_preview_properties()
-            data = exif.get_preview_image(preview[0]).get_data()
-        except (IndexError, GObject.GError):
+            exif = GExiv2.Metadata(filename)
+        except GObject.GError:
             raise OSError('{}: No thumbnail found.'.format(filename))
 
-        return GdkPixbuf.Pixbuf.new_from_stream_at_scale(
-            Gio.MemoryInputStream.new_from_data(data, None),
-            size, size, True, None)
+        with ignored(KeyError, ValueError):
+            orient = int(exif['Exif.Image.Orientation'])
+
+        thumb = None
+        with ignored(GObject.GError):
+            thumb = fetch_preview(exif, pixels)
+
+        if thumb is None:
+            try:
+                thumb = GdkPixbuf.Pixbuf.new_from_file_at_size(
+                    filename, pixels, pixels)
+            except GObject.GError:
+                # RAW files usually can't be decoded, but a small preview is
+                # better than no thumbnail at all.
+                with ignored(GObject.GError):
+                    thumb = fetch_preview(exif, pixels, smaller=True)
+
+        if thumb is None:
+            raise OSError('{}: No thumbnail found.'.format(filename))
+
+        # Embedded previews are stored sideways just like the full image is.
+        thumb = ROTATIONS.get(orient, lambda x: x)(thumb)
+
+    if flavor is not None:
+        save_thumbnail(filename, thumb, flavor[0])
+
+    return scale_to_fit(thumb, size)
+
+
+def fetch_pyramid(filename, size):
+    """Load a thumbnail at the nearest standard size, and scale it down.
+
+    That's the size most likely to be in the shared thumbnail cache already.
+    The standard sized copy is kept around so that the thumbnail size can be
+    changed later without touching the disk again, at least until it grows
+    beyond that standard size.
+    """
+    flavor = get_flavor(size)
+    source = fetch_thumbnail(filename, size if flavor is None else flavor[1])
+    return source, scale_to_fit(source, size)
 
-    return ROTATIONS.get(orient, lambda x: x)(thumb)
+
+def rescale_pyramid(source, size):
+    """Scale an already loaded thumbnail to a new size."""
+    return source, scale_to_fit(source, size)
+
+
+def swap_thumbnail(photo, thumbs):
+    """Replace a placeholder icon with the freshly decoded thumbnail."""
+    photo.source, photo.thumb = thumbs
+    if photo.iter is not None:
+        Widgets.loaded_photos.set_value(photo.iter, 2, photo.thumb)
+    thumbnail_memory.add(photo, photo.source, photo.thumb)
+    evict_thumbnails()
+
+
+def evict_thumbnails():
+    """Forget the thumbnails that haven't been seen lately, to save memory."""
+    budget = Gst.get_int('thumbnail-memory') * 1024 * 1024
+    evicted = thumbnail_memory.evict(budget)
+    if not evicted:
+        return
+    placeholder = get_placeholder(Gst.get_int('thumbnail-size'))
+    for photo in evicted:
+        resize_queue.cancel(photo)
+        photo.source = None
+        photo.thumb = placeholder
+        if photo.iter is not None:
+            Widgets.loaded_photos.set_value(photo.iter, 2, placeholder)
+
+
+thumbnail_queue = ThumbnailQueue(fetch_pyramid, swap_thumbnail)
+resize_queue = ThumbnailQueue(rescale_pyramid, swap_thumbnail, workers=1)
+thumbnail_memory = ThumbnailMemory()
+
+
+def fetch_large_preview(filename, size):
+    """Load a large preview, remembering what size it was loaded at."""
+    return size, fetch_thumbnail(filename, size)
+
+
+large_previews = PixbufCache(LARGE_PREVIEWS)
+preview_queue = ThumbnailQueue(fetch_large_preview, large_previews.add, 2)
+
+
+def load_visible(*ignore):
+    """Load the thumbnails of the rows that the user can currently see.
+
+    Rows just outside of the visible range are loaded too, closest first, so
+    that they're ready before they're scrolled into view. Anything further
+    away that hasn't been decoded yet is dropped from the queue. Photos that
+    couldn't be decoded keep their placeholder and aren't tried again.
+    """
+    visible = Widgets.photos_view.get_visible_range()
+    if not visible:
+        return
+    start, end = [path.get_indices()[0] for path in visible]
+    model = Widgets.photos_view.get_model()
+    first = max(0, start - PREFETCH_ROWS)
+    treeiter = model.iter_nth_child(None, first)
+    rows = []
+    for index in range(first, end + PREFETCH_ROWS + 1):
+        if treeiter is None:
+            break
+        with ignored(KeyError):
+            rows.append((max(start - index, index - end, 0), index,
+                         Photograph.cache[model.get_value(treeiter, 0)]))
+        treeiter = model.iter_next(treeiter)
+    photos = [photo for distance, index, photo in sorted(rows)]
+
+    size = Gst.get_int('thumbnail-size')
+    thumbnail_queue.prioritize(photos)
+    resize_queue.prioritize(photos)
+    thumbnail_queue.retain(photos)
+    for photo in photos:
+        if photo.source is not None or photo in thumbnail_queue.failed:
+            continue
+        if thumbnail_queue.requested(photo) != size:
+            thumbnail_queue.request(photo, photo.filename, size)
+    thumbnail_memory.protect(photos)
+    evict_thumbnails()
 
 
 @memoize
@@ -150,37 +271,59 @@ class Photograph(Coordinates):
     10.2m below sea level</span></b>
     """
     camera_info = None
+    source = None
     orig_time = None
+    orig_gps = None
+    on_disk = None
     manual = False
     camera = None
     label = None
     exif = None
     iter = None
 
+    @property
+    def tzinfo(self):
+        """The timezone that this photo's camera clock was set to."""
+        return self.camera.tzinfo if self.camera else None
+
     @staticmethod
     def resize_all_photos(gst, key):
-        """Reload all the thumbnails when the GSetting changes."""
-        # TODO: There's probably a more GObjecty way to do this with properties
-        # TODO: Is it necessary to reload every time? Probably could just load
-        # the max size to start and then scale it down to the requested size on
-        # the fly. But this works for now.
+        """Rescale all the thumbnails when the GSetting changes.
+
+        Photos that already have a big enough thumbnail in memory are scaled
+        in the background without any disk I/O, and the rest are simply
+        decoded at the new size once they're scrolled into view.
+        """
         size = gst.get_int(key)
         for photo in Photograph.instances:
-            photo.thumb = fetch_thumbnail(photo.filename, size)
-            Widgets.loaded_photos.set_value(photo.iter, 2, photo.thumb)
+            source = photo.source
+            if source is None:
+                continue
+            if max(source.get_width(), source.get_height()) >= size:
+                resize_queue.request(photo, source, size)
+            else:
+                # Keep showing the old thumbnail until the new one is ready.
+                resize_queue.cancel(photo)
+                photo.source = None
+        load_visible()
 
     @staticmethod
-    def load_from_file(uri):
+    def load_from_file(uri, metadata=None):
         """Coordinates instantiation of various classes.
 
         Ensures that related Photograph, Camera, CameraView, and Label are all
-        instantiated together.
+        instantiated together. Pass the result of read_metadata() if it was
+        already read in the background, otherwise it's read here. Raises
+        OSError for invalid file types.
         """
+        if metadata is None:
+            metadata = read_metadata(uri)
+
         photo = Photograph(uri)
 
         Label(photo)
 
-        photo.read()
+        photo.read(metadata)
 
         Widgets.empty_camera_list.hide()
 
@@ -201,17 +344,21 @@ class Photograph(Coordinates):
         return photo
 
     def __init__(self, filename):
-        """Raises OSError for invalid file types.
+        """Use Photograph.load_from_file() instead of calling this directly.
 
-        This MUST be the case in order to avoid the @memoize cache getting
-        filled up with invalid Photograph instances.
+        That ensures that the file is actually a photo before it gets put in
+        the @memoize cache, in order to avoid the cache getting filled up with
+        invalid Photograph instances.
         """
         Coordinates.__init__(self)
-        self.thumb = fetch_thumbnail(filename)
+        size = Gst.get_int('thumbnail-size')
+        self.thumb = get_placeholder(size)
         self.filename = filename
 
         self.connect('notify::geoname', self.update_liststore_summary)
         self.connect('notify::positioned', Widgets.button_sensitivity)
+        self.connect('notify::timestamp', photo_index.invalidate)
+        photo_index.add(self)
 
     def __str__(self):
         """Long summary of photo metadata with Pango markup."""
@@ -220,9 +367,14 @@ class Photograph(Coordinates):
             'style="italic" size="smaller"', Coordinates.__str__(self))
         return '<b>{}</b>'.format(summary) if self in modified else summary
 
-    def read(self):
-        """Discard all state and (re)initialize from disk."""
-        self.exif = GExiv2.Metadata(self.filename)
+    def read(self, metadata=None):
+        """Discard all state and (re)initialize from disk.
+
+        Does not read the file again if metadata is given.
+        """
+        if metadata is None:
+            metadata = read_metadata(self.filename)
+        self.exif = metadata.exif
         self.manual = False
         self.modified_timeout = None
         self.latitude = 0.0
@@ -233,17 +385,17 @@ class Photograph(Coordinates):
         self.names = (None, None, None)
         self.geotimezone = ''
 
-        for tag in ('Exif.Photo.DateTimeOriginal',
-                    'Exif.Image.DateTimeOriginal',
-                    'Exif.Photo.DateTime',
-                    'Exif.Image.DateTime'):
-            with ignored(TypeError, AttributeError, ValueError):
-                self.orig_time = datetime.strptime(
-                    self.exif.get(tag),
-                    '%Y:%m:%d %H:%M:%S').timetuple()
-                break
+        self.orig_time = metadata.orig_time
+        self.longitude, self.latitude, self.altitude = metadata.gps
 
-        self.longitude, self.latitude, self.altitude = self.exif.get_gps_info()
+        # Remember where the photo was when it was loaded, because this is
+        # likely to be overwritten once any GPS tracks are loaded.
+        self.orig_gps = ((self.latitude, self.longitude, self.altitude)
+                         if self.positioned else None)
+
+        # Remember what's in the file, so that saving can be skipped when
+        # nothing has really changed.
+        self.on_disk = quantize(metadata.gps, metadata.names)
 
         modified.discard(self)
         self.calculate_timestamp()
@@ -255,42 +407,72 @@ class Photograph(Coordinates):
                                                   self.thumb,
                                                   self.timestamp])
 
-        # Get the camera info
-        self.camera_info = {'Make': '', 'Model': ''}
-        keys = ['Exif.Image.' + key for key in list(self.camera_info.keys())
-                + ['CameraSerialNumber']] + ['Exif.Photo.BodySerialNumber']
-        for key in keys:
-            with ignored(KeyError):
-                self.camera_info.update(
-                    {key.split('.')[-1]: self.exif[key]})
+        self.camera_info = metadata.camera_info
 
-    def calculate_timestamp(self, offset=0):
-        """Determine the timestamp based on the currently selected timezone.
+    def calculate_timestamp(self, offset=0, correlate=True):
+        """Determine the timestamp based on the camera's selected timezone.
 
-        This method relies on the TZ environment variable to be set before
-        it is called. If you don't set TZ before calling this method, then it
-        implicitely assumes that the camera and the computer are set to the
-        same timezone.
+        If the photo doesn't belong to a camera yet, or the camera doesn't
+        specify a timezone, then it implicitely assumes that the camera and
+        the computer are set to the same timezone.
+
+        Pass correlate=False when recalculating many photos at once, and then
+        hand them all to timeline.correlate() in one batch afterwards.
         """
-        try:
-            self.timestamp = int(mktime(self.orig_time))
-        except TypeError:
-            self.timestamp = int(stat(self.filename).st_mtime)
-        self.timestamp += offset
-        auto_timestamp_comparison(self)
+        self.timestamp = self.timestamp_at(offset)
+        if correlate:
+            auto_timestamp_comparison(self)
+
+    def timestamp_at(self, offset=0):
+        """Calculate the timestamp for a given offset, without applying it.
+
+        This doesn't modify the photo at all, which makes it safe to call
+        from a background thread.
+        """
+        return photo_timestamp(
+            self.filename, self.orig_time, offset, self.tzinfo)
 
     def write(self):
-        """Save exif data to photo file on disk."""
-        times = stat(self.filename)
-        self.exif.set_gps_info(self.longitude, self.latitude, self.altitude)
-        self.exif[IPTC + 'City'] = self.names[0] or ''
-        self.exif[IPTC + 'ProvinceState'] = self.names[1] or ''
-        self.exif[IPTC + 'CountryName'] = self.names[2] or ''
-        self.exif['Iptc.Envelope.CharacterSet'] = '\x1b%G'
-        self.exif.save_file()
-        utime(self.filename, (times.st_atime, times.st_mtime))
-        modified.discard(self)
-        Widgets.loaded_photos.set_value(self.iter, 1, str(self))
+        """Save exif data to photo file on disk.
+
+        Returns False if the file already had this location in it.
+        """
+        snapshot = self.prepare_write()
+        if snapshot is None:
+            return False
+        filename, exif, location, names, sidecar = snapshot
+        exif = save_metadata(filename, exif, location, names, sidecar)
+        self.saved(exif, location, names)
+        return True
+
+    def prepare_write(self):
+        """Take a snapshot of everything that needs to be saved.
+
+        Returns the arguments for save_metadata(), which can then be called
+        from a worker thread without touching this photo at all. Returns None
+        if the file already has the same location and names, in which case
+        the photo is simply marked as saved.
+        """
+        location = (self.longitude, self.latitude, self.altitude)
+        if quantize(location, self.names) == self.on_disk:
+            self.saved(self.exif, location, self.names)
+            return None
+        return (self.filename, self.exif, location, self.names,
+                Gst.get_boolean('write-sidecars'))
+
+    def saved(self, exif, location, names):
+        """Record that the given location and names have been saved.
+
+        If the photo was moved again while it was being saved, then it is
+        still modified afterwards. It might also have been closed already.
+        """
+        self.exif = exif
+        self.on_disk = quantize(location, names)
+        if (self.longitude, self.latitude, self.altitude) == location and \
+           self.names == names:
+            modified.discard(self)
+        if self.iter is not None:
+            Widgets.loaded_photos.set_value(self.iter, 1, str(self))
 
     def disable_auto_position(self):
         """Indicate that the user has manually positioned the photo.
@@ -308,11 +490,46 @@ class Photograph(Coordinates):
         self.longitude = lon
 
     def get_large_preview(self):
-        """Return a GdkPixbuf that's 80% of the screen's shortest dimension."""
+        """Return a GdkPixbuf that's 80% of the screen's shortest dimension.
+
+        The previews of the photos before and after this one in the photo list
+        are then loaded in the background, so that paging through photos with
+        the large preview window open doesn't have to wait for each one.
+        """
         screen = Gdk.Screen.get_default()
-        return fetch_thumbnail(
-            self.filename,
-            int(min(screen.get_width(), screen.get_height()) * 0.8))
+        size = int(min(screen.get_width(), screen.get_height()) * 0.8)
+        cached = large_previews.get(self)
+        if cached is not None and cached[0] == size:
+            preview = cached[1]
+        else:
+            preview_queue.cancel(self)
+            preview = fetch_thumbnail(self.filename, size)
+            large_previews.add(self, (size, preview))
+        self.prefetch_neighbours(size)
+        return preview
+
+    def prefetch_neighbours(self, size):
+        """Load the large previews of the adjacent photos in the background.
+
+        Anything queued for photos that are no longer adjacent is dropped.
+        """
+        if self.iter is None:
+            return
+        model = Widgets.loaded_photos
+        neighbours = []
+        for treeiter in (model.iter_next(self.iter),
+                         model.iter_previous(self.iter)):
+            if treeiter is None:
+                continue
+            with ignored(KeyError):
+                neighbours.append(
+                    Photograph.cache[model.get_value(treeiter, 0)])
+        preview_queue.retain(neighbours)
+        for photo in neighbours:
+            cached = large_previews.get(photo)
+            if (cached is None or cached[0] != size) and \
+               preview_queue.requested(photo) != size:
+                preview_queue.request(photo, photo.filename, size)
 
     def update_liststore_summary(self, *ignore):
         """Update the text displayed in the GtkListStore."""
@@ -330,6 +547,13 @@ class Photograph(Coordinates):
         if self.camera is not None:
             self.camera.remove_photo(self)
         modified.discard(self)
+        photo_index.discard(self)
+        thumbnail_queue.cancel(self)
+        resize_queue.cancel(self)
+        thumbnail_memory.discard(self)
+        preview_queue.cancel(self)
+        large_previews.discard(self)
         if self.iter:
             Widgets.loaded_photos.remove(self.iter)
+            self.iter = None
         del Photograph.cache[self.filename]
@@ -0,0 +1,148 @@
+# Author: Robert Park <robru@gottengeography.ca>, (C) 2015
+# Copyright: See COPYING file included with this distribution.
+
+"""Remember which files were open and which photos were moved.
+
+The session is a small JSON file listing the loaded GPS tracks and photos,
+and the unsaved location of every photo that was moved. It's rewritten in a
+background thread whenever it changes, so that unsaved work survives a crash,
+and it's restored the next time the app starts. Per-camera settings don't
+need to be stored here, because they are already kept in GSettings.
+
+Photos are grouped by folder, which keeps the file compact even when tens of
+thousands of photos from the same memory card are loaded.
+
+>>> state = pack(['/gps/day1.gpx'], ['/dcim/IMG_1.JPG', '/dcim/IMG_2.JPG'],
+...             {'/dcim/IMG_2.JPG': (53.5, -113.5, 668.0, True)})
+>>> state['photos']
+{'/dcim': ['IMG_1.JPG', 'IMG_2.JPG']}
+>>> tracks, photos, positions = unpack(state)
+>>> photos
+['/dcim/IMG_1.JPG', '/dcim/IMG_2.JPG']
+>>> positions
+{'/dcim/IMG_2.JPG': (53.5, -113.5, 668.0, True)}
+"""
+
+
+from os import makedirs, remove, rename, getpid
+from os.path import dirname, basename, join
+from threading import Lock, Thread
+from json import dump, load
+
+
+# Bump this whenever the file changes shape, to ignore old sessions.
+SESSION_VERSION = 1
+
+
+def pack(tracks, photos, positions):
+    """Describe the open files in a form that can be saved as JSON.
+
+    `positions` maps the filenames of moved photos to (lat, lon, alt, manual).
+    """
+    folders = {}
+    for filename in photos:
+        folders.setdefault(dirname(filename), []).append(basename(filename))
+    return {
+        'version': SESSION_VERSION,
+        'tracks': list(tracks),
+        'photos': folders,
+        'positions': {filename: list(position)
+                      for filename, position in positions.items()},
+    }
+
+
+def unpack(state):
+    """Reverse pack(), returning (tracks, photos, positions)."""
+    photos = [join(folder, name)
+              for folder, names in state.get('photos', {}).items()
+              for name in names]
+    positions = {filename: tuple(position)
+                 for filename, position in state.get('positions', {}).items()}
+    return state.get('tracks', []), photos, positions
+
+
+class Session:
+    """Read and write a session file, writing in the background.
+
+    Only the latest state is ever written, so a burst of changes that happen
+    while a write is in progress results in just one more write.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.io = Lock()
+        self.latest = None
+        self.written = None
+        self.generation = 0
+        self.writing = False
+
+    def save(self, state, background=True):
+        """Write the state to disk, unless it hasn't changed."""
+        with self.lock:
+            if state == self.written:
+                return
+            self.written = state
+            self.generation += 1
+            generation = self.generation
+            if not background:
+                self.latest = None
+            else:
+                self.latest = (generation, state)
+                if self.writing:
+                    return
+                self.writing = True
+        if background:
+            Thread(target=self.work, daemon=True).start()
+        else:
+            self.write(generation, state)
+
+    def work(self):
+        """Write states until there are no more. Runs in a worker thread."""
+        while True:
+            with self.lock:
+                if self.latest is None:
+                    self.writing = False
+                    return
+                generation, state = self.latest
+                self.latest = None
+            self.write(generation, state)
+
+    def write(self, generation, state):
+        """Atomically replace the session file, unless it's out of date."""
+        temp = '{}.{}.tmp'.format(self.path, getpid())
+        with self.io:
+            if generation != self.generation:
+                return
+            try:
+                makedirs(dirname(self.path), exist_ok=True)
+                with open(temp, 'w', encoding='utf-8') as session:
+                    dump(state, session, separators=(',', ':'))
+                rename(temp, self.path)
+            except OSError:
+                pass
+
+    def load(self):
+        """Read the saved session, or None if there isn't a usable one."""
+        try:
+            with open(self.path, encoding='utf-8') as session:
+                state = load(session)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(state, dict) or \
+           state.get('version') != SESSION_VERSION:
+            return None
+        self.written = state
+        return state
+
+    def discard(self):
+        """Forget the session, including any write that's still pending."""
+        with self.lock:
+            self.generation += 1
+            self.latest = None
+            self.written = None
+        with self.io:
+            try:
+                remove(self.path)
+            except OSError:
+                pass
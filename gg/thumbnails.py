@@ -0,0 +1,359 @@
+# Author: Robert Park <robru@gottengeography.ca>, (C) 2015
+# Copyright: See COPYING file included with this distribution.
+
+"""Share thumbnails with the rest of the desktop.
+
+Thumbnails are cached in ~/.cache/thumbnails according to the freedesktop.org
+thumbnail spec, which means that any thumbnails already generated by the file
+manager or photo manager can be reused here without decoding the image at all,
+and vice versa.
+
+Thumbnails that do have to be decoded are handed to a ThumbnailQueue, which
+decodes them on a pool of worker threads so that the photo list can be
+populated immediately with placeholder icons.
+
+http://specifications.freedesktop.org/thumbnail-spec/thumbnail-spec-latest.html
+"""
+
+
+from gi.repository import Gtk, GdkPixbuf, GLib, GObject
+from os import chmod, cpu_count, getpid, makedirs, rename, stat, unlink
+from os.path import abspath, join
+from collections import OrderedDict
+from threading import Condition, Thread
+from traceback import print_exc
+from hashlib import md5
+
+from gg.common import ignored, memoize
+
+
+# The standard sizes of thumbnails, smallest first.
+FLAVORS = (
+    ('normal', 128),
+    ('large', 256),
+    ('x-large', 512),
+    ('xx-large', 1024),
+)
+
+URI = 'tEXt::Thumb::URI'
+MTIME = 'tEXt::Thumb::MTime'
+
+
+def get_flavor(size):
+    """Find the smallest standard thumbnail that is at least the given size.
+
+    >>> get_flavor(100)
+    ('normal', 128)
+    >>> get_flavor(200)
+    ('large', 256)
+    >>> get_flavor(5000) is None
+    True
+    """
+    for flavor, pixels in FLAVORS:
+        if pixels >= size:
+            return flavor, pixels
+
+
+@memoize
+def get_placeholder(size):
+    """Load a generic image icon to show until the real thumbnail is ready."""
+    try:
+        return Gtk.IconTheme.get_default().load_icon(
+            'image-x-generic', size, Gtk.IconLookupFlags.FORCE_SIZE)
+    except GObject.GError:
+        return None
+
+
+def get_path(uri, flavor):
+    """Determine where the thumbnail for the given URI belongs."""
+    return join(GLib.get_user_cache_dir(), 'thumbnails', flavor,
+                md5(uri.encode('utf-8')).hexdigest() + '.png')
+
+
+def scale_to_fit(pixbuf, size):
+    """Shrink a pixbuf to fit within a square, preserving aspect ratio."""
+    width, height = pixbuf.get_width(), pixbuf.get_height()
+    ratio = size / max(width, height)
+    if ratio >= 1:
+        return pixbuf
+    return pixbuf.scale_simple(
+        max(1, round(width * ratio)), max(1, round(height * ratio)),
+        GdkPixbuf.InterpType.BILINEAR)
+
+
+def load_thumbnail(filename, size):
+    """Load a cached thumbnail, if one exists and is still valid.
+
+    The smallest standard size that is big enough is preferred, but a larger
+    one that some other program already generated is just as good once it's
+    scaled down. Returns None if there's no such thumbnail, or if the file has
+    been modified since the thumbnail was generated.
+    """
+    uri = GLib.filename_to_uri(abspath(filename), None)
+    try:
+        mtime = str(int(stat(filename).st_mtime))
+    except OSError:
+        return None
+
+    for flavor, pixels in FLAVORS:
+        if pixels < size:
+            continue
+        try:
+            thumb = GdkPixbuf.Pixbuf.new_from_file(get_path(uri, flavor))
+        except GObject.GError:
+            continue
+        if thumb.get_option(URI) == uri and thumb.get_option(MTIME) == mtime:
+            return scale_to_fit(thumb, size)
+
+    return None
+
+
+def save_thumbnail(filename, thumb, flavor):
+    """Store a thumbnail in the cache so nobody has to generate it again.
+
+    The thumbnail is written to a temporary file first and then renamed into
+    place, so that other programs never see a partially written thumbnail.
+    Failure to write the thumbnail is not considered an error, but the
+    temporary file is cleaned up so it doesn't litter the shared cache.
+    """
+    uri = GLib.filename_to_uri(abspath(filename), None)
+    path = get_path(uri, flavor)
+    temp = '{}.{}.tmp'.format(path, getpid())
+
+    with ignored(OSError, GObject.GError):
+        mtime = str(int(stat(filename).st_mtime))
+        makedirs(join(GLib.get_user_cache_dir(), 'thumbnails', flavor),
+                 0o700, exist_ok=True)
+        try:
+            thumb.savev(temp, 'png', [URI, MTIME], [uri, mtime])
+            chmod(temp, 0o600)
+            rename(temp, path)
+        except (OSError, GObject.GError):
+            with ignored(OSError):
+                unlink(temp)
+            raise
+
+
+class ThumbnailQueue:
+    """Decode thumbnails on a pool of worker threads.
+
+    `loader` is called in a worker thread with a filename and a size, and
+    should return a pixbuf or raise OSError. Anything else that it raises is
+    printed and then treated the same way, so that one bad file can't stop a
+    worker. `callback` is called in the main thread with the item and its
+    pixbuf once it's ready. Items that are currently visible are always
+    decoded first, everything else is decoded in the order it was requested.
+    """
+
+    def __init__(self, loader, callback, workers=None):
+        self.loader = loader
+        self.callback = callback
+        self.workers = workers or min(4, cpu_count() or 1)
+        self.threads = []
+        self.lock = Condition()
+        self.pending = OrderedDict()
+        self.wanted = {}
+        self.failed = set()
+        self.visible = ()
+        self.done = []
+        self.flushing = False
+
+    def __len__(self):
+        return len(self.wanted)
+
+    def request(self, item, filename, size):
+        """Queue up a thumbnail, replacing any earlier request for the item."""
+        with self.lock:
+            self.pending.pop(item, None)
+            self.pending[item] = (filename, size)
+            self.wanted[item] = size
+            self.lock.notify()
+        self.failed.discard(item)
+        while len(self.threads) < min(self.workers, len(self.wanted)):
+            thread = Thread(target=self.work, daemon=True)
+            self.threads.append(thread)
+            thread.start()
+
+    def requested(self, item):
+        """Return the size that an item was requested at, if it's queued."""
+        with self.lock:
+            return self.wanted.get(item)
+
+    def retain(self, items):
+        """Forget queued items that haven't been started yet, except these."""
+        keep = set(items)
+        with self.lock:
+            for item in list(self.pending):
+                if item not in keep:
+                    del self.pending[item]
+                    del self.wanted[item]
+
+    def cancel(self, item):
+        """Forget about an item, even if it's already being decoded."""
+        with self.lock:
+            self.pending.pop(item, None)
+            self.wanted.pop(item, None)
+        self.failed.discard(item)
+
+    def prioritize(self, items):
+        """Decode these items before anything else."""
+        with self.lock:
+            self.visible = list(items)
+
+    def next(self):
+        """Block until there is something to decode, then return it."""
+        with self.lock:
+            while not self.pending:
+                self.lock.wait()
+            for item in self.visible:
+                if item in self.pending:
+                    return (item,) + self.pending.pop(item)
+            item, (filename, size) = self.pending.popitem(last=False)
+            return item, filename, size
+
+    def work(self):
+        """Decode thumbnails forever. Runs in a worker thread.
+
+        Results are delivered to the main thread in batches, so that a flood
+        of cheap thumbnails doesn't schedule thousands of idle callbacks.
+        """
+        while True:
+            item, filename, size = self.next()
+            try:
+                thumb = self.loader(filename, size)
+            except OSError:
+                thumb = None
+            except Exception:
+                print_exc()
+                thumb = None
+            with self.lock:
+                self.done.append((item, size, thumb))
+                if self.flushing:
+                    continue
+                self.flushing = True
+            GLib.idle_add(self.flush)
+
+    def flush(self):
+        """Deliver every thumbnail that has been decoded so far."""
+        with self.lock:
+            done, self.done = self.done, []
+            self.flushing = False
+        for item, size, thumb in done:
+            self.finish(item, size, thumb)
+        return False
+
+    def finish(self, item, size, thumb):
+        """Deliver a decoded thumbnail, unless it was cancelled or replaced.
+
+        Items that couldn't be decoded are remembered in self.failed, so
+        that they aren't requested over and over again.
+        """
+        with self.lock:
+            if self.wanted.get(item) != size or item in self.pending:
+                return
+            del self.wanted[item]
+        if thumb is None:
+            self.failed.add(item)
+        else:
+            self.callback(item, thumb)
+
+
+class ThumbnailMemory:
+    """Keep track of how much memory the loaded thumbnails are using.
+
+    Items are remembered in the order they were last seen, so that the ones
+    that have been out of view the longest are the first to be evicted.
+
+    >>> class Pixbuf:
+    ...     def get_byte_length(self): return 10
+    >>> memory = ThumbnailMemory()
+    >>> for name in 'abcd': memory.add(name, Pixbuf(), Pixbuf())
+    >>> memory.total
+    80
+    >>> memory.protect('a')
+    >>> memory.evict(45)
+    ['b', 'c']
+    """
+
+    def __init__(self):
+        self.sizes = OrderedDict()
+        self.keep = set()
+        self.total = 0
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def add(self, item, *pixbufs):
+        """Remember how big an item's pixbufs are."""
+        self.discard(item)
+        unique = {id(pixbuf): pixbuf for pixbuf in pixbufs}.values()
+        self.sizes[item] = sum(pixbuf.get_byte_length() for pixbuf in unique)
+        self.total += self.sizes[item]
+
+    def discard(self, item):
+        """Forget about an item."""
+        self.total -= self.sizes.pop(item, 0)
+
+    def protect(self, items):
+        """Mark these items as recently seen, and never evict them."""
+        self.keep = set(items)
+        for item in items:
+            if item in self.sizes:
+                self.sizes.move_to_end(item)
+
+    def evict(self, budget):
+        """Forget the stalest items until the total is within budget.
+
+        Returns the evicted items, which should then release their pixbufs.
+        """
+        evicted = []
+        for item in list(self.sizes):
+            if self.total <= budget:
+                break
+            if item not in self.keep:
+                self.discard(item)
+                evicted.append(item)
+        return evicted
+
+
+class PixbufCache:
+    """Remember the few most recently used pixbufs.
+
+    >>> cache = PixbufCache(2)
+    >>> cache.add('a', 1); cache.add('b', 2); cache.get('a')
+    1
+    >>> cache.add('c', 3)
+    >>> cache.get('b') is None
+    True
+    >>> sorted(cache.items)
+    ['a', 'c']
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.items = OrderedDict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        return item in self.items
+
+    def get(self, item):
+        """Look up an item, marking it as recently used."""
+        if item not in self.items:
+            return None
+        self.items.move_to_end(item)
+        return self.items[item]
+
+    def add(self, item, value):
+        """Store an item, forgetting the least recently used beyond the limit.
+        """
+        self.items[item] = value
+        self.items.move_to_end(item)
+        while len(self.items) > self.limit:
+            self.items.popitem(last=False)
+
+    def discard(self, item):
+        """Forget about an item."""
+        self.items.pop(item, None)
@@ -0,0 +1,248 @@
+# Author: Robert Park <robru@gottengeography.ca>, (C) 2015
+# Copyright: See COPYING file included with this distribution.
+
+"""Measure where the time goes, for finding out what makes things slow.
+
+The slow parts of the app, such as parsing GPS tracks, decoding thumbnails,
+reading and writing EXIF data, geocoding, and correlating photos with the
+tracks, are wrapped in named spans, and interesting quantities are added up
+in named counters:
+
+    with span('track.parse', file=filename):
+        ...
+    count('geocode.lookups')
+
+Tracing is off unless the GG_TRACE environment variable names a file, or
+batch or watch mode is given --trace. While it's off, span() just returns
+the same do-nothing context manager every time and count() returns
+immediately, so the instrumentation can stay in the hottest of loops. While
+it's on, every span is recorded, and when the program exits they're written
+to the file in Chrome's trace event format, which can be opened in
+chrome://tracing or https://ui.perfetto.dev, and a table summarizing them is
+printed to stderr.
+
+Only the process that turned tracing on is traced, so run batch mode with
+-j 1 to include the work that's done for each photo.
+
+>>> with span('nothing'):
+...     count('nothing')
+>>> enabled()
+False
+"""
+
+
+from threading import Lock, current_thread, get_native_id
+from collections import Counter, defaultdict
+from time import perf_counter_ns
+from functools import wraps
+from os import environ, getpid
+import atexit
+import json
+import sys
+
+
+# Set this to the name of a file to write the trace to.
+TRACE_ENV = 'GG_TRACE'
+
+# Stop recording individual events after this many, to bound memory use.
+# Spans are still added to the summary after that.
+MAX_EVENTS = 1000000
+
+# How often the main loop is expected to check in, and how late it has to
+# be to count as a stall, in milliseconds. See stall_detector().
+STALL_INTERVAL = 50
+STALL_THRESHOLD = 100
+
+# The Tracer that is recording, or None while tracing is off.
+tracer = None
+
+
+class NullSpan:
+    """Stand in for a Span while tracing is off."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span:
+    """Time a block of code, as a context manager."""
+    __slots__ = ('tracer', 'name', 'args', 'start')
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.complete(self.name, self.start, perf_counter_ns(),
+                             self.args)
+
+
+class Tracer:
+    """Record spans and counters, and write them out when finished."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.pid = getpid()
+        self.lock = Lock()
+        self.epoch = perf_counter_ns()
+        self.events = []
+        self.dropped = 0
+        self.threads = set()
+        # {name: [count, total nanoseconds, max nanoseconds]}
+        self.spans = defaultdict(lambda: [0, 0, 0])
+        self.counters = Counter()
+
+    def record(self, event):
+        """Add an event to the trace, naming each thread the first time."""
+        tid = get_native_id()
+        event.update(pid=self.pid, tid=tid)
+        if len(self.events) >= MAX_EVENTS:
+            self.dropped += 1
+            return
+        if tid not in self.threads:
+            self.threads.add(tid)
+            self.events.append(dict(
+                name='thread_name', ph='M', pid=self.pid, tid=tid,
+                args=dict(name=current_thread().name)))
+        self.events.append(event)
+
+    def complete(self, name, start, end, args=None):
+        """Record a span, given its start and end in nanoseconds."""
+        with self.lock:
+            totals = self.spans[name]
+            totals[0] += 1
+            totals[1] += end - start
+            totals[2] = max(totals[2], end - start)
+            event = dict(name=name, ph='X', ts=(start - self.epoch) / 1000,
+                         dur=(end - start) / 1000)
+            if args:
+                event['args'] = args
+            self.record(event)
+
+    def count(self, name, value=1):
+        """Add to a counter."""
+        with self.lock:
+            self.counters[name] += value
+            self.record(dict(
+                name=name, ph='C',
+                ts=(perf_counter_ns() - self.epoch) / 1000,
+                args={name: self.counters[name]}))
+
+    def write(self):
+        """Write the trace, in Chrome's trace event format."""
+        with self.lock, open(self.filename, 'w') as trace:
+            json.dump(dict(traceEvents=self.events,
+                           displayTimeUnit='ms'), trace)
+
+    def summary(self):
+        """Tabulate the spans by total time, and then the counters."""
+        lines = ['{:<24} {:>8} {:>12} {:>10} {:>10}'.format(
+            'span', 'count', 'total ms', 'mean ms', 'max ms')]
+        for name, (calls, total, longest) in sorted(
+                self.spans.items(), key=lambda item: -item[1][1]):
+            lines.append('{:<24} {:>8} {:>12.1f} {:>10.2f} {:>10.2f}'.format(
+                name, calls, total / 1e6, total / calls / 1e6, longest / 1e6))
+        if self.counters:
+            lines.append('')
+            lines.append('{:<24} {:>8}'.format('counter', 'value'))
+            for name, value in sorted(self.counters.items()):
+                lines.append('{:<24} {:>8}'.format(name, value))
+        if self.dropped:
+            lines.append('')
+            lines.append('{} events were left out of {}.'.format(
+                self.dropped, self.filename))
+        return '\n'.join(lines)
+
+    def finish(self, out=None):
+        """Write the trace and print the summary."""
+        try:
+            self.write()
+        except OSError as error:
+            print('Could not write trace: {}'.format(error), file=sys.stderr)
+        print(self.summary(), file=out or sys.stderr)
+
+
+def enable(filename):
+    """Start tracing, to be written to the given file at exit."""
+    global tracer
+    if tracer is None:
+        tracer = Tracer(filename)
+        atexit.register(tracer.finish)
+    return tracer
+
+
+def disable():
+    """Stop tracing, without writing anything."""
+    global tracer
+    if tracer is not None:
+        atexit.unregister(tracer.finish)
+    tracer = None
+
+
+def enabled():
+    """Determine whether anything is being recorded."""
+    return tracer is not None
+
+
+def span(name, **args):
+    """Time a block of code, as a context manager."""
+    if tracer is None:
+        return NULL_SPAN
+    return Span(tracer, name, args)
+
+
+def count(name, value=1):
+    """Add to a counter."""
+    if tracer is not None:
+        tracer.count(name, value)
+
+
+def traced(name):
+    """Time every call to a function, as a decorator."""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if tracer is None:
+                return function(*args, **kwargs)
+            with Span(tracer, name, None):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def stall_detector(interval=STALL_INTERVAL, threshold=STALL_THRESHOLD):
+    """Make a callback for a repeating main loop timer that records stalls.
+
+    Register it to be called every `interval` milliseconds, and whenever it
+    runs more than `threshold` milliseconds late, the time that the main loop
+    was too busy to call it is recorded as a mainloop.stall span.
+    """
+    interval *= 1000000
+    threshold *= 1000000
+    last = [perf_counter_ns()]
+
+    def check():
+        now = perf_counter_ns()
+        due = last[0] + interval
+        last[0] = now
+        if tracer is not None and now - due > threshold:
+            tracer.complete('mainloop.stall', due, now)
+        return True
+    return check
+
+
+if environ.get(TRACE_ENV):
+    enable(environ[TRACE_ENV])
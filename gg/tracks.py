@@ -0,0 +1,344 @@
+# Author: Robert Park <robru@gottengeography.ca>, (C) 2015
+# Copyright: See COPYING file included with this distribution.
+
+"""Read GPS tracks from GPX, TCX, KML, and CSV files.
+
+The readers in here know nothing about maps or widgets. Each one collects a
+dict mapping epoch seconds to track points, which is exactly what a Timeline
+needs. By default those points are plain TrackPoint tuples, but a caller that
+wants to draw the tracks can supply its own `segment` callable, which is
+called whenever a new track segment begins and must return a function that
+takes (lat, lon, ele) and returns the point to store.
+
+>>> tracks = read_track('demo/2010 10 16.gpx')
+>>> len(tracks)
+374
+>>> tracks[min(tracks)]
+TrackPoint(lat=53.52263, lon=-113.448979, ele=671.666)
+"""
+
+
+from xml.parsers.expat import ParserCreate, ExpatError
+from dateutil.parser import parse as parse_date
+from collections import defaultdict, deque, namedtuple
+from re import compile as re_compile
+from calendar import timegm
+
+from gg.filetypes import sniff
+from gg.trace import span, count
+
+
+TrackPoint = namedtuple('TrackPoint', 'lat lon ele')
+
+
+def track_point(lat, lon, ele):
+    """Create a TrackPoint, treating any unusable elevation as sea level.
+
+    >>> track_point(49.899754, -97.137494, None)
+    TrackPoint(lat=49.899754, lon=-97.137494, ele=0.0)
+    >>> track_point(53.529201, -113.499324, '1000')
+    TrackPoint(lat=53.529201, lon=-113.499324, ele=1000.0)
+    """
+    try:
+        ele = float(ele)
+    except (ValueError, TypeError):
+        ele = 0.0
+    return TrackPoint(lat, lon, ele)
+
+
+def single_segment():
+    """Store plain TrackPoints, no matter how many segments there are."""
+    return track_point
+
+
+# GPX files use ISO 8601 dates, which look like 2010-10-16T20:09:13Z.
+# This regex splits that up into a list like 2010, 10, 16, 20, 09, 13.
+split = re_compile(r'[:T.Z-]').split
+
+
+class XMLSimpleParser:
+    """A simple wrapper for the Expat XML parser."""
+
+    def __init__(self, filename, root, watch, call_start, call_end):
+        self.state = defaultdict(str)
+        self.call_start = call_start
+        self.call_end = call_end
+        self.watchlist = watch
+        self.rootname = root
+        self.tracking = None
+        self.element = None
+
+        self.parser = ParserCreate()
+        self.parser.StartElementHandler = self.element_root
+
+        try:
+            with open(filename, 'rb') as xml:
+                self.parser.ParseFile(xml)
+        except ExpatError:
+            raise OSError
+
+    def element_root(self, name, attributes):
+        """Called on the root XML element, we check if it's the one we want."""
+        if name != self.rootname:
+            raise OSError
+        self.parser.StartElementHandler = self.element_start
+
+    def element_start(self, name, attributes):
+        """Only collect the attributes from XML elements that we care about."""
+        if not self.tracking:
+            if name not in self.watchlist:
+                return
+            if self.call_start(name, attributes):
+                # Start tracking this element, accumulate everything under it.
+                self.tracking = name
+                self.parser.CharacterDataHandler = self.element_data
+                self.parser.EndElementHandler = self.element_end
+
+        if self.tracking is not None:
+            self.element = name
+            self.state.update(attributes)
+
+    def element_data(self, data):
+        """Accumulate all data for an element.
+
+        Expat can call this handler multiple times with data chunks.
+        """
+        if not data.strip():
+            return
+        self.state[self.element] += data
+
+    def element_end(self, name, state=None):
+        """When the tag closes, pass its data to the end callback and reset."""
+        if name != self.tracking:
+            return
+
+        self.call_end(name, self.state)
+        self.tracking = None
+        self.state.clear()
+        self.parser.CharacterDataHandler = None
+        self.parser.EndElementHandler = None
+
+
+class TrackReader:
+    """Parent class for all types of GPS track readers.
+
+    Subclasses must define the root element and the watchlist, the first
+    entry of which marks the start of each new segment, and must implement
+    at least element_end. `progress` is called after every track point.
+    """
+    root = None
+    watchlist = ()
+
+    def __init__(self, filename, segment=None, progress=None):
+        self.filename = filename
+        self.segment = segment or single_segment
+        self.progress = progress or (lambda: None)
+        self.append = None
+        self.segments = 0
+        self.tracks = {}
+
+        with span('track.parse', file=filename):
+            self.parse(filename)
+        count('track.points', len(self.tracks))
+
+    def parse(self, filename):
+        """Feed the file to the XML parser."""
+        XMLSimpleParser(filename, self.root, self.watchlist,
+                        self.element_start, self.element_end)
+
+    def new_segment(self):
+        """Start appending points to a new segment."""
+        self.append = self.segment()
+        self.segments += 1
+
+    def element_start(self, name, attributes=None):
+        """Determine when new segments start."""
+        if name == self.watchlist[0]:
+            self.new_segment()
+            return False
+        return True
+
+    def element_end(self, name=None, state=None):
+        """Report progress after each point."""
+        self.progress()
+
+
+class GPXReader(TrackReader):
+    """Support for the open GPS eXchange format."""
+    root = 'gpx'
+    watchlist = ('trkseg', 'trkpt')
+
+    def element_end(self, name, state):
+        """Collect and use all the parsed data."""
+        try:
+            timestamp = timegm(list(map(int, split(state['time'])[0:6])))
+            lat = float(state['lat'])
+            lon = float(state['lon'])
+        except Exception as error:
+            print(error)
+            return
+
+        self.tracks[timestamp] = self.append(lat, lon, state.get('ele'))
+
+        TrackReader.element_end(self)
+
+
+class TCXReader(TrackReader):
+    """Support for Garmin's Training Center XML."""
+    root = 'TrainingCenterDatabase'
+    watchlist = ('Track', 'Trackpoint')
+
+    def element_end(self, name, state):
+        """Collect and use all the parsed data."""
+        try:
+            timestamp = timegm(list(map(int, split(state['Time'])[0:6])))
+            lat = float(state['LatitudeDegrees'])
+            lon = float(state['LongitudeDegrees'])
+        except Exception as error:
+            print(error)
+            return
+
+        self.tracks[timestamp] = self.append(
+            lat, lon, state.get('AltitudeMeters'))
+
+        TrackReader.element_end(self)
+
+
+class KMLReader(TrackReader):
+    """Support for Google's Keyhole Markup Language.
+
+    The KML parser is a little bit different than the other XML parsers,
+    it uses a two-pass approach of loading points first, then storing them
+    in the second pass. This is because KML has an absurd requirement
+    of allowing `when` tags to be decoupled from their associated `gx:coord`
+    tags which makes the single-pass approach significantly slower.
+    """
+    root = 'kml'
+    watchlist = ('gx:Track', 'when', 'gx:coord')
+
+    def __init__(self, filename, segment=None, progress=None):
+        self.whens = deque()
+        self.coords = deque()
+
+        TrackReader.__init__(self, filename, segment, progress)
+
+    def element_start(self, name, attributes=None):
+        """Make note of where new segments start."""
+        if name == self.watchlist[0]:
+            self.whens.append(None)
+            self.coords.append(None)
+            return False
+        return True
+
+    def element_end(self, name, state):
+        """Watch for complete pairs of when and gx:coord tags.
+
+        This is accomplished by maintaining parallel deques of each tag.
+        """
+        if name == 'when':
+            try:
+                timestamp = timegm(parse_date(state['when']).utctimetuple())
+            except Exception as error:
+                print(error)
+                return
+            self.whens.append(timestamp)
+        if name == 'gx:coord':
+            self.coords.append(state['gx:coord'].split())
+        TrackReader.element_end(self)
+
+    def parse(self, filename):
+        """Trigger the first pass and then do the second pass."""
+        # First pass
+        TrackReader.parse(self, filename)
+
+        # Second pass
+        self.new_segment()
+
+        whens = self.whens
+        coords = self.coords
+        tracks = self.tracks
+        append = self.append
+
+        while whens and coords:
+            when = whens.popleft()
+            coord = coords.popleft()
+            try:
+                tracks[when] = append(
+                    float(coord[1]), float(coord[0]), coord[2])
+            except TypeError:
+                self.new_segment()
+                append = self.append
+            else:
+                TrackReader.element_end(self)
+
+
+class CSVReader(TrackReader):
+    """Support for Google's MyTracks' Comma Separated Values format.
+
+    This implementation ignores everything before the first line that contains
+    the necessary column headers, allowing you to have any arbitrary preamble
+    you like. Extra columns are harmlessly ignored. All "values" must be
+    "quoted" with "double quotes".
+    """
+    columns = None
+    watchlist = ('Segment', 'Latitude (deg)', 'Longitude (deg)', 'Time')
+
+    def parse(self, filename):
+        """Call the appropriate handler for each line of the file."""
+        with open(filename) as lines:
+            parse_line = re_compile(r'"([^"]*)",?').findall
+            for line in lines:
+                self.parse_header(parse_line(line), self.columns)
+
+    def parse_header(self, state, columns, alt='Altitude (m)'):
+        """Ignore as many lines as necessary until column headers are found."""
+        try:
+            self.columns = {
+                col.split(' ')[0].lower(): state.index(col)
+                for col in self.watchlist}
+        except ValueError:
+            return
+
+        self.columns['alt'] = state.index(alt) if alt in state else -1
+
+        self.parse_header = self.parse_row
+
+    def parse_row(self, state, col):
+        """All subsequent lines contain one track point each."""
+        try:
+            if int(state[col['segment']]) > self.segments:
+                self.element_start('Segment')
+
+            timestamp = timegm(
+                list(map(int, split(state[col['time']])[0:6])))
+            lat = float(state[col['latitude']])
+            lon = float(state[col['longitude']])
+        except Exception as error:
+            print(error)
+            return
+
+        self.tracks[timestamp] = self.append(
+            lat, lon, state[col['alt']] if col['alt'] >= 0 else 0.0)
+
+        TrackReader.element_end(self)
+
+
+# The reader for each of gg.filetypes.TRACK_FORMATS.
+READERS = {
+    'GPX': GPXReader,
+    'TCX': TCXReader,
+    'KML': KMLReader,
+    'CSV': CSVReader,
+}
+
+
+def read_track(filename, kind=None):
+    """Read the track points from a file, identifying it if necessary.
+
+    Returns a dict mapping epoch seconds to TrackPoints. Raises OSError if
+    the file can't be read or isn't a GPS track.
+    """
+    reader = READERS.get(kind or sniff(filename))
+    if reader is None:
+        raise OSError('Not a GPS track: {}'.format(filename))
+    return reader(filename).tracks
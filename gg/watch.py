@@ -0,0 +1,593 @@
+# Author: Robert Park <robru@gottengeography.ca>, (C) 2015
+# Copyright: See COPYING file included with this distribution.
+
+"""Geotag photos as they arrive in some folders, for as long as it runs.
+
+This is what runs when GottenGeography is started as
+
+    gottengeography watch --offset 12 /srv/inbox
+
+Photos and GPS tracks can be dropped into the watched folders in any order.
+New files are noticed with inotify where the kernel has it, or else by
+listing the folders every few seconds, and then left alone until they've
+stopped changing, so that half-copied files are never read. Tracks are added
+to the timeline as they arrive, and photos are geotagged in batches on the
+same worker processes as `gottengeography batch`. Photos taken outside of
+the tracks seen so far wait until a track that covers them turns up.
+
+While it runs, a line of statistics is printed every so often, and the same
+numbers can be written to a JSON file for monitoring tools to pick up.
+"""
+
+
+from gg.version import APPNAME, PACKAGE
+
+import gettext
+gettext.bindtextdomain(PACKAGE)
+gettext.textdomain(PACKAGE)
+
+from os import O_CLOEXEC, O_NONBLOCK, close, fsdecode, fsencode, read
+from os import replace, scandir, stat
+from ctypes import CDLL, get_errno
+from argparse import ArgumentParser
+from collections import Counter, deque
+from gettext import gettext as _
+from os.path import basename, isdir, join
+from signal import signal, SIGTERM
+from time import monotonic, sleep
+from select import select
+from struct import Struct
+import json
+import sys
+
+from gg.batch import EXIT_OK, EXIT_USAGE, AUTO_TIMEZONE, FAILED, UNTRACKED
+from gg.batch import TAGGED, Job, Result, add_geotag_arguments, describe
+from gg.batch import find_tracks, make_pool, run, track_timezone
+from gg.correlate import Timeline
+from gg.filetypes import sniff, importable, walk_files
+from gg.filetypes import MIN_IMPORT_SIZE, TRACK_FORMATS, UNSUPPORTED_FORMATS
+from gg.trace import enable as enable_tracing
+from gg.tracks import read_track
+
+
+# Files are only read once they haven't changed for this many seconds.
+SETTLE_SECONDS = 2.0
+
+# How often to check on files that are still settling.
+TICK_SECONDS = 0.5
+
+# How often to list the folders when inotify isn't available.
+POLL_SECONDS = 5.0
+
+# How often to print statistics.
+STATS_SECONDS = 60.0
+
+# Throughput is measured over this many recent seconds.
+THROUGHPUT_WINDOW = 60.0
+
+# Latency percentiles are calculated from this many recent photos.
+LATENCY_SAMPLES = 1000
+
+# From <sys/inotify.h>.
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+# struct inotify_event, which is followed by `len` bytes of file name.
+INOTIFY_EVENT = Struct('iIII')
+INOTIFY_BUFFER = 64 * 1024
+
+
+def load_inotify():
+    """Find the inotify functions in the C library, or None if there aren't
+    any, as on every kernel but Linux.
+    """
+    try:
+        # The C library is already loaded, so look in this process for it.
+        libc = CDLL(None, use_errno=True)
+        libc.inotify_init1, libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class PollWatcher:
+    """Notice new and changed files by listing the folders every so often."""
+
+    def __init__(self, folders, interval=POLL_SECONDS):
+        self.folders = folders
+        self.interval = interval
+        self.files = {}
+        self.due = 0
+
+    def scan(self):
+        """List the files that appeared or changed since the last scan."""
+        files = {}
+        for filename in walk_files(self.folders):
+            try:
+                info = stat(filename)
+            except OSError:
+                continue
+            files[filename] = (info.st_size, info.st_mtime_ns)
+        changed = [filename for filename, key in files.items()
+                   if self.files.get(filename) != key]
+        self.files = files
+        return changed
+
+    def wait(self, timeout):
+        """Wait a while, then return any files that appeared or changed."""
+        sleep(timeout)
+        if monotonic() < self.due:
+            return []
+        self.due = monotonic() + self.interval
+        return self.scan()
+
+    def close(self):
+        """Nothing to clean up."""
+
+
+class InotifyWatcher:
+    """Notice new and changed files as soon as the kernel tells us about them.
+
+    Subfolders are watched too, including ones that are created later.
+    Raises OSError if inotify can't be used, such as when the limit on the
+    number of watches has been reached.
+    """
+
+    def __init__(self, folders, libc):
+        self.libc = libc
+        self.roots = folders
+        self.watches = {}
+        self.fd = libc.inotify_init1(O_NONBLOCK | O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(get_errno(), 'inotify_init1')
+        # The files that were there before we started, see wait().
+        self.found = []
+        try:
+            for folder in folders:
+                self.found.extend(self.add_folder(folder))
+        except OSError:
+            self.close()
+            raise
+
+    def add_folder(self, folder):
+        """Watch a folder and its subfolders, returning the files in them.
+
+        Each folder is watched before it's listed, so that nothing that's
+        added in between can be missed.
+        """
+        found = []
+        pending = [folder]
+        while pending:
+            path = pending.pop()
+            watch = self.libc.inotify_add_watch(
+                self.fd, fsencode(path), WATCH_MASK)
+            if watch < 0:
+                raise OSError(get_errno(), 'inotify_add_watch', path)
+            self.watches[watch] = path
+            try:
+                with scandir(path) as listing:
+                    for entry in listing:
+                        if entry.name.startswith('.'):
+                            continue
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append(entry.path)
+                        elif importable(entry.name):
+                            found.append(entry.path)
+            except OSError:
+                continue
+        return found
+
+    def events(self, data):
+        """Yield the (watch, mask, name) of each event read from inotify."""
+        offset = 0
+        while offset < len(data):
+            watch, mask, cookie, length = INOTIFY_EVENT.unpack_from(
+                data, offset)
+            offset += INOTIFY_EVENT.size
+            name = fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            yield watch, mask, name
+
+    def wait(self, timeout):
+        """Wait a while for any files to appear or change, and return them."""
+        changed, self.found = self.found, []
+        if not select([self.fd], [], [], timeout)[0]:
+            return changed
+        try:
+            data = read(self.fd, INOTIFY_BUFFER)
+        except BlockingIOError:
+            return changed
+
+        for watch, mask, name in self.events(data):
+            if mask & IN_Q_OVERFLOW:
+                # Some events were lost, so look at everything again.
+                changed.extend(walk_files(self.roots))
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(watch, None)
+                continue
+            folder = self.watches.get(watch)
+            if folder is None or not name or name.startswith('.'):
+                continue
+            path = join(folder, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    changed.extend(self.add_folder(path))
+            elif importable(name):
+                changed.append(path)
+        return changed
+
+    def close(self):
+        """Stop watching."""
+        close(self.fd)
+
+
+def make_watcher(folders, poll=None):
+    """Use inotify if possible, or else list the folders every `poll` secs."""
+    libc = load_inotify() if poll is None else None
+    if libc is not None:
+        try:
+            return InotifyWatcher(folders, libc)
+        except OSError:
+            pass
+    return PollWatcher(folders, poll or POLL_SECONDS)
+
+
+def percentile(ordered, fraction):
+    """Pick a value from a sorted list, such that `fraction` are below it.
+
+    >>> percentile([1, 2, 3, 4], 0.5), percentile([1, 2, 3, 4], 0.95)
+    (3, 4)
+    >>> percentile([], 0.5) is None
+    True
+    """
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class Metrics:
+    """Keep track of how much the daemon has done, and how quickly.
+
+    Latency is the time from when a photo was first noticed until it was
+    geotagged, including any time spent waiting for its track to arrive.
+    """
+
+    def __init__(self, clock=monotonic):
+        self.clock = clock
+        self.started = clock()
+        self.counts = Counter()
+        self.tracks = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.finished = deque()
+
+    def record(self, status, latency):
+        """Count one photo that has been dealt with."""
+        self.counts[status] += 1
+        self.latencies.append(latency)
+        self.finished.append(self.clock())
+
+    def snapshot(self, **extra):
+        """Collect the current numbers into a dict, ready for JSON."""
+        now = self.clock()
+        while self.finished and self.finished[0] < now - THROUGHPUT_WINDOW:
+            self.finished.popleft()
+        uptime = now - self.started
+        window = min(THROUGHPUT_WINDOW, uptime) or 1
+        ordered = sorted(self.latencies)
+        snapshot = dict(
+            uptime=round(uptime, 1),
+            photos=dict(self.counts),
+            tracks=self.tracks,
+            per_minute=round(len(self.finished) * 60 / window, 1),
+            latency=dict(
+                p50=percentile(ordered, 0.5),
+                p95=percentile(ordered, 0.95),
+                max=ordered[-1] if ordered else None),
+        )
+        snapshot.update(extra)
+        return snapshot
+
+
+def format_snapshot(snapshot):
+    """Describe the statistics in one line of text.
+
+    >>> print(format_snapshot(dict(uptime=61.2, photos=dict(tagged=3),
+    ...     tracks=1, waiting=2, pending=0, per_minute=3.0,
+    ...     latency=dict(p50=2.5, p95=4.0, max=4.0))))
+    61s: 3 tagged, 2 waiting for tracks, 1 tracks, 3.0 photos/min, \
+latency 2.5s (p50) 4.0s (p95)
+    """
+    counts = ', '.join('{} {}'.format(count, status) for status, count in
+                       sorted(snapshot['photos'].items())) or _('0 photos')
+    line = _('{:.0f}s: {}, {} waiting for tracks, {} tracks, '
+             '{} photos/min').format(
+                 snapshot['uptime'], counts, snapshot['waiting'],
+                 snapshot['tracks'], snapshot['per_minute'])
+    latency = snapshot['latency']
+    if latency['p50'] is not None:
+        line += _(', latency {:.1f}s (p50) {:.1f}s (p95)').format(
+            latency['p50'], latency['p95'])
+    return line
+
+
+def write_snapshot(filename, snapshot):
+    """Replace the metrics file, such that readers never see half of it."""
+    with open(filename + '.tmp', 'w') as metrics:
+        json.dump(snapshot, metrics, indent=2, sort_keys=True)
+    replace(filename + '.tmp', filename)
+
+
+class Daemon:
+    """Geotag photos that arrive in some folders, as their tracks arrive.
+
+    `report` is called with a batch Result for each photo that has been
+    dealt with, or that is waiting for a track.
+    """
+
+    def __init__(self, watcher, job, jobs=1, settle=SETTLE_SECONDS,
+                 auto_timezone=False, report=None, clock=monotonic):
+        self.watcher = watcher
+        self.job = job
+        self.jobs = jobs
+        self.settle = settle
+        self.auto_timezone = auto_timezone
+        self.report = report or (lambda result: None)
+        self.clock = clock
+        self.metrics = Metrics(clock)
+        self.running = True
+        self.points = {}
+        # {filename: ((size, mtime), when it last changed, when first seen)}
+        self.pending = {}
+        # {filename: (size, mtime)} as of when we last changed or read it,
+        # so that we aren't woken up by our own changes to the photos.
+        self.handled = {}
+        # {filename: when first seen} for photos without a track yet.
+        self.waiting = {}
+        # Worker processes, kept for as long as the tracks stay the same.
+        self.pool = None
+
+    def notice(self, filenames):
+        """Start waiting for some new or changed files to settle down."""
+        now = self.clock()
+        for filename in filenames:
+            seen = self.pending.get(filename, (None, now, now))[2]
+            self.pending[filename] = (None, now, seen)
+
+    def settled(self):
+        """Return the files that have stopped changing, and when they were
+        first seen.
+        """
+        now = self.clock()
+        ready = []
+        for filename, (key, changed, seen) in list(self.pending.items()):
+            try:
+                info = stat(filename)
+            except OSError:
+                del self.pending[filename]
+                self.handled.pop(filename, None)
+                continue
+            current = (info.st_size, info.st_mtime_ns)
+            if current != key:
+                self.pending[filename] = (current, now, seen)
+            elif now - changed >= self.settle:
+                del self.pending[filename]
+                if self.handled.get(filename) == current:
+                    # That was our own change, which has now been ignored.
+                    del self.handled[filename]
+                elif info.st_size >= MIN_IMPORT_SIZE:
+                    ready.append((filename, seen))
+        return ready
+
+    def remember(self, filename):
+        """Make note of a file as it is now, after dealing with it."""
+        try:
+            info = stat(filename)
+        except OSError:
+            return
+        self.handled[filename] = (info.st_size, info.st_mtime_ns)
+
+    def forget_missing(self):
+        """Forget about files that have been deleted since we handled them."""
+        for filename in list(self.handled):
+            try:
+                stat(filename)
+            except OSError:
+                del self.handled[filename]
+
+    def workers(self):
+        """Return the worker processes, starting them if necessary."""
+        if self.pool is None:
+            self.pool = make_pool(self.job, self.jobs)
+        return self.pool
+
+    def close_pool(self):
+        """Stop the worker processes, which only know about the old tracks.
+        """
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def load_tracks(self, filenames):
+        """Add some GPS tracks to the timeline."""
+        for filename in filenames:
+            try:
+                self.points.update(read_track(filename))
+            except OSError as error:
+                self.report(Result(filename, FAILED, None, str(error)))
+                continue
+            self.metrics.tracks += 1
+            self.remember(filename)
+
+        self.job.timeline = Timeline(self.points)
+        if self.auto_timezone and len(self.job.timeline) >= 2:
+            self.job.tzinfo = track_timezone(self.job.timeline)
+        self.close_pool()
+
+    def geotag(self, photos):
+        """Geotag photos, given a dict of when each was first seen.
+
+        Photos that aren't covered by the tracks yet are kept for later.
+        The worker processes are reused from one batch to the next, so that
+        they don't have to be started over again for every few photos.
+        """
+        if len(self.job.timeline) < 2:
+            self.waiting.update(photos)
+            return
+
+        pool = self.workers() if self.jobs > 1 and len(photos) > 1 else None
+        writes = not (self.job.dry_run or self.job.sidecar)
+        for result in run(self.job, list(photos), self.jobs, pool):
+            seen = photos[result.filename]
+            if result.status == UNTRACKED:
+                self.waiting[result.filename] = seen
+            else:
+                self.waiting.pop(result.filename, None)
+                if result.status == TAGGED and writes:
+                    self.remember(result.filename)
+                self.metrics.record(result.status, self.clock() - seen)
+            self.report(result)
+
+    def ingest(self, ready):
+        """Deal with files that have settled: tracks first, then photos."""
+        tracks, photos = [], {}
+        for filename, seen in ready:
+            try:
+                kind = sniff(filename)
+            except OSError:
+                continue
+            if kind in TRACK_FORMATS:
+                tracks.append(filename)
+            elif kind not in UNSUPPORTED_FORMATS:
+                photos[filename] = seen
+
+        if tracks:
+            self.load_tracks(tracks)
+            # Maybe the new tracks cover some of the photos that were waiting.
+            for filename, seen in self.waiting.items():
+                photos.setdefault(filename, seen)
+        if photos:
+            self.geotag(photos)
+
+    def tick(self):
+        """Wait briefly for changes, then deal with any files that are ready.
+        """
+        self.notice(self.watcher.wait(TICK_SECONDS))
+        ready = self.settled()
+        if ready:
+            self.ingest(ready)
+
+    def snapshot(self):
+        """Collect the statistics about what's been done so far."""
+        return self.metrics.snapshot(
+            waiting=len(self.waiting), pending=len(self.pending),
+            track_points=len(self.points))
+
+    def stop(self, *ignored):
+        """Stop at the end of the current tick, suitable as a signal handler.
+        """
+        self.running = False
+
+    def run(self, stats=None, interval=STATS_SECONDS):
+        """Keep geotagging until stopped, passing a snapshot of the
+        statistics to `stats` every `interval` seconds.
+        """
+        due = self.clock() + interval
+        try:
+            while self.running:
+                self.tick()
+                if self.clock() >= due:
+                    due = self.clock() + interval
+                    self.forget_missing()
+                    if stats is not None:
+                        stats(self.snapshot())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.watcher.close()
+            self.close_pool()
+        if stats is not None:
+            stats(self.snapshot())
+
+
+def make_parser():
+    """Describe the command line arguments."""
+    parser = ArgumentParser(
+        prog=PACKAGE + ' watch',
+        description=_('Geotag photos as they arrive in some folders, using '
+                      'the GPS tracks that arrive with them.'))
+    parser.add_argument(
+        'folders', nargs='+', metavar='FOLDER',
+        help=_('folders to watch for photos and GPS tracks'))
+    parser.add_argument(
+        '-t', '--track', action='append', default=[], dest='tracks',
+        metavar='TRACK', help=_('a GPS track, or folder of them, to load '
+                                'before watching (may be given more than '
+                                'once)'))
+    parser.add_argument(
+        '--settle', type=float, default=SETTLE_SECONDS, metavar='SECONDS',
+        help=_('how long files must stop changing before they\'re read'))
+    parser.add_argument(
+        '--poll', type=float, default=None, metavar='SECONDS',
+        help=_('list the folders this often instead of using inotify'))
+    parser.add_argument(
+        '--stats', type=float, default=STATS_SECONDS, metavar='SECONDS',
+        help=_('how often to report statistics'))
+    parser.add_argument(
+        '--metrics', metavar='FILE',
+        help=_('also write the statistics to this file, as JSON'))
+    add_geotag_arguments(parser)
+    return parser
+
+
+def main(argv, out=sys.stdout, err=sys.stderr):
+    """Watch folders as described by the command line arguments.
+
+    Returns the exit status once stopped by SIGINT or SIGTERM.
+    """
+    parser = make_parser()
+    try:
+        args = parser.parse_args(argv)
+    except SystemExit as done:
+        return done.code
+    if args.trace:
+        enable_tracing(args.trace)
+    for folder in args.folders:
+        if not isdir(folder):
+            print(_('{}: Not a folder: {}').format(APPNAME, folder), file=err)
+            return EXIT_USAGE
+
+    def report(result):
+        if result.status == FAILED:
+            print(describe(result), file=err)
+        elif args.verbose and result.status == UNTRACKED:
+            print(_('{}: waiting for a GPS track').format(
+                basename(result.filename)), file=out)
+        elif args.verbose:
+            print(describe(result), file=out)
+        out.flush()
+
+    def stats(snapshot):
+        if args.metrics:
+            write_snapshot(args.metrics, snapshot)
+        if not args.quiet:
+            print(format_snapshot(snapshot), file=out)
+            out.flush()
+
+    auto = args.timezone == AUTO_TIMEZONE
+    job = Job(Timeline(), args.offset, None if auto else args.timezone,
+              args.geocode, args.sidecar, args.overwrite, args.dry_run)
+    daemon = Daemon(make_watcher(args.folders, args.poll), job, args.jobs,
+                    args.settle, auto, report)
+    if args.tracks:
+        daemon.load_tracks(find_tracks(args.tracks))
+
+    signal(SIGTERM, daemon.stop)
+    daemon.run(stats, args.stats)
+    return EXIT_OK
@@ -20,7 +20,8 @@ GtkClutter.init([])
 from gi.repository import GtkChamplain, Champlain
 from gi.repository import Gdk, GdkPixbuf
 from gi.repository import Gtk, GLib
-from time import gmtime, strftime
+from datetime import datetime, timezone
+from time import gmtime
 from os.path import join
 
 from gg.version import APPNAME, PACKAGE
@@ -138,9 +139,13 @@ class Widgets(Builder):
 
         while handler_ids:
             self.clock_photo_button.disconnect(handler_ids.pop())
+        # The UTC offset that the camera was using when the photo was taken.
+        zone = datetime.fromtimestamp(
+            photo.timestamp, timezone.utc).astimezone(photo.tzinfo)
+
         handler_ids.add(self.clock_photo_button.connect(
             'clicked', photo.camera.get_offset_from_clock_photo,
-            stamp, strftime('%z')))
+            stamp, zone.strftime('%z')))
 
         self.large_preview_window.show_all()
         self.large_preview_window.present()
@@ -161,6 +166,7 @@ class Widgets(Builder):
         self.close_button.set_sensitive(selected)
         self.apply_button.set_sensitive(selected)
         self.save_button.set_sensitive(modified)
+        self.export_button.set_sensitive(len(self.loaded_photos))
         self.revert_button.set_sensitive(modified & selected)
         self.jump_button.set_sensitive(
             [photo for photo in selected if photo.positioned])
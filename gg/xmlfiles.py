@@ -1,27 +1,27 @@
 # Author: Robert Park <robru@gottengeography.ca>, (C) 2010
 # Copyright: See COPYING file included with this distribution.
 
-"""Define classes used for parsing GPX and KML XML files."""
+"""Draw GPS track files on the map.
+
+The files themselves are parsed by the readers in gg.tracks.
+"""
 
 
 from gi.repository import GtkClutter
 GtkClutter.init([])
 
-from xml.parsers.expat import ParserCreate, ExpatError
 from gi.repository import Champlain, Clutter, Gtk, Gdk
-from dateutil.parser import parse as parse_date
-from collections import defaultdict, deque
-from re import compile as re_compile
 from gettext import gettext as _
 from os.path import basename
-from calendar import timegm
-from time import clock
+from time import perf_counter
 
 from gg.camera import Camera
 from gg.gpsmath import Coordinates
 from gg.common import staticmethod
 from gg.widgets import Widgets, Builder, MapView
-from gg.common import GSettings, Gst, Struct, memoize, points
+from gg.common import GSettings, Gst, memoize, points
+from gg.common import timeline, photo_index
+from gg.tracks import GPXReader, TCXReader, KMLReader, CSVReader
 
 
 BOTTOM = Gtk.PositionType.BOTTOM
@@ -79,83 +79,22 @@ class Polygon(Champlain.PathLayer):
         return coord
 
 
-class XMLSimpleParser:
-    """A simple wrapper for the Expat XML parser."""
-
-    def __init__(self, filename, root, watch, call_start, call_end):
-        self.state = defaultdict(str)
-        self.call_start = call_start
-        self.call_end = call_end
-        self.watchlist = watch
-        self.rootname = root
-        self.tracking = None
-        self.element = None
-
-        self.parser = ParserCreate()
-        self.parser.StartElementHandler = self.element_root
-
-        try:
-            with open(filename, 'rb') as xml:
-                self.parser.ParseFile(xml)
-        except ExpatError:
-            raise OSError
-
-    def element_root(self, name, attributes):
-        """Called on the root XML element, we check if it's the one we want."""
-        if name != self.rootname:
-            raise OSError
-        self.parser.StartElementHandler = self.element_start
-
-    def element_start(self, name, attributes):
-        """Only collect the attributes from XML elements that we care about."""
-        if not self.tracking:
-            if name not in self.watchlist:
-                return
-            if self.call_start(name, attributes):
-                # Start tracking this element, accumulate everything under it.
-                self.tracking = name
-                self.parser.CharacterDataHandler = self.element_data
-                self.parser.EndElementHandler = self.element_end
-
-        if self.tracking is not None:
-            self.element = name
-            self.state.update(attributes)
-
-    def element_data(self, data):
-        """Accumulate all data for an element.
-
-        Expat can call this handler multiple times with data chunks.
-        """
-        if not data.strip():
-            return
-        self.state[self.element] += data
-
-    def element_end(self, name, state=None):
-        """When the tag closes, pass its data to the end callback and reset."""
-        if name != self.tracking:
-            return
-
-        self.call_end(name, self.state)
-        self.tracking = None
-        self.state.clear()
-        self.parser.CharacterDataHandler = None
-        self.parser.EndElementHandler = None
-
-
 class TrackFile():
     """Parent class for all types of GPS track files.
 
-    Subclasses must implement at least element_end.
+    Subclasses must name the gg.tracks reader that parses their format, and
+    this takes care of drawing each segment on the map as it's read.
     """
     range = []
-    parse = XMLSimpleParser
+    reader = None
     instances = set()
 
     @staticmethod
     def update_range():
-        """Ensure that TrackFile.range contains the correct info."""
+        """Ensure that TrackFile.range and the timeline are up to date."""
         while TrackFile.range:
             TrackFile.range.pop()
+        timeline.load(points)
         if not TrackFile.instances:
             Widgets.empty_trackfile_list.show()
         else:
@@ -194,22 +133,24 @@ class TrackFile():
         points.clear()
 
     @staticmethod
-    def load_from_file(uri):
+    def load_from_file(uri, kind=None):
         """Determine the correct subclass to instantiate.
 
-        Also time everything and report how long it took. Raises OSError if
-        the file extension is unknown, or no track points were found.
+        The kind is one of gg.filetypes.TRACK_FORMATS, and is guessed from
+        the file extension if it isn't given. Also time everything and report
+        how long it took. Raises OSError if the file type is unknown, or no
+        track points were found.
         """
-        start_time = clock()
+        start_time = perf_counter()
 
         try:
-            gpx = globals()[uri[-3:].upper() + 'File'](uri)
+            gpx = globals()[(kind or uri[-3:].upper()) + 'File'](uri)
         except KeyError:
             raise OSError
 
         Widgets.status_message(
             _('%d points loaded in %.2fs.') %
-            (len(gpx.tracks), clock() - start_time), True)
+            (len(gpx.tracks), perf_counter() - start_time), True)
 
         if len(gpx.tracks) < 2:
             return
@@ -220,17 +161,16 @@ class TrackFile():
         MapView.ensure_visible(TrackFile.get_bounding_box(), False)
 
         TrackFile.update_range()
+        timeline.correlate(
+            photo_index.between(*timeline.affected(gpx.alpha, gpx.omega)))
         Camera.set_all_found_timezone(gpx.start.geotimezone)
 
-    def __init__(self, filename, root, watch):
-        self.watchlist = watch
+    def __init__(self, filename):
         self.filename = filename
         self.progress = Widgets.progressbar
         self.polygons = set()
         self.widgets = Builder('trackfile')
-        self.append = None
-        self.tracks = {}
-        self.clock = clock()
+        self.clock = perf_counter()
 
         self.gst = GSettings('trackfile', basename(filename))
         if self.gst.get_string('start-timezone') is '':
@@ -257,7 +197,8 @@ class TrackFile():
         Widgets.trackfile_colors_group.add_widget(self.widgets.colorpicker)
         Widgets.trackfiles_group.add_widget(self.widgets.trackfile_label)
 
-        self.parse(filename, root, watch, self.element_start, self.element_end)
+        self.tracks = self.reader(
+            filename, self.new_polygon, self.pulse).tracks
 
         if not self.tracks:
             raise OSError('No points found')
@@ -274,26 +215,24 @@ class TrackFile():
 
         Widgets.trackfiles_view.add(self.widgets.trackfile_settings)
 
-    def element_start(self, name, attributes=None):
-        """Determine when new tracks start and create a new Polygon."""
-        if name == self.watchlist[0]:
-            polygon = Polygon()
-            self.polygons.add(polygon)
-            self.append = polygon.append_point
-            self.widgets.colorpicker.emit('color-set')
-            return False
-        return True
-
-    def element_end(self, name=None, state=None):
+    def new_polygon(self):
+        """Draw each new track segment as a new Polygon."""
+        polygon = Polygon()
+        self.polygons.add(polygon)
+        self.widgets.colorpicker.emit('color-set')
+        return polygon.append_point
+
+    def pulse(self):
         """Occasionally redraw the screen so the user can see activity."""
-        if clock() - self.clock > .2:
+        if perf_counter() - self.clock > .2:
             self.progress.pulse()
             while Gtk.events_pending():
                 Gtk.main_iteration()
-            self.clock = clock()
+            self.clock = perf_counter()
 
     def destroy(self, button=None):
         """Die a horrible death."""
+        affected = timeline.affected(self.alpha, self.omega)
         for polygon in self.polygons:
             MapView.remove_layer(polygon)
         self.polygons.clear()
@@ -304,177 +243,28 @@ class TrackFile():
         for trackfile in TrackFile.instances:
             points.update(trackfile.tracks)
         TrackFile.update_range()
-
-
-# GPX files use ISO 8601 dates, which look like 2010-10-16T20:09:13Z.
-# This regex splits that up into a list like 2010, 10, 16, 20, 09, 13.
-split = re_compile(r'[:T.Z-]').split
+        timeline.correlate(photo_index.between(*affected))
 
 
 @memoize
 class GPXFile(TrackFile):
     """Support for the open GPS eXchange format."""
-
-    def __init__(self, filename):
-        TrackFile.__init__(self, filename, 'gpx', ('trkseg', 'trkpt'))
-
-    def element_end(self, name, state):
-        """Collect and use all the parsed data."""
-        try:
-            timestamp = timegm(list(map(int, split(state['time'])[0:6])))
-            lat = float(state['lat'])
-            lon = float(state['lon'])
-        except Exception as error:
-            print(error)
-            return
-
-        self.tracks[timestamp] = self.append(lat, lon, state.get('ele'))
-
-        TrackFile.element_end(self)
+    reader = GPXReader
 
 
 @memoize
 class TCXFile(TrackFile):
     """Support for Garmin's Training Center XML."""
-
-    def __init__(self, filename):
-        TrackFile.__init__(self, filename,
-                           'TrainingCenterDatabase', ('Track', 'Trackpoint'))
-
-    def element_end(self, name, state):
-        """Collect and use all the parsed data."""
-        try:
-            timestamp = timegm(list(map(int, split(state['Time'])[0:6])))
-            lat = float(state['LatitudeDegrees'])
-            lon = float(state['LongitudeDegrees'])
-        except Exception as error:
-            print(error)
-            return
-
-        self.tracks[timestamp] = self.append(
-            lat, lon, state.get('AltitudeMeters'))
-
-        TrackFile.element_end(self)
+    reader = TCXReader
 
 
 @memoize
 class KMLFile(TrackFile):
-    """Support for Google's Keyhole Markup Language.
-
-    The KML parser is a little bit different than the other XML parsers,
-    it uses a two-pass approach of loading points first, then marking them on
-    the map in the second pass. This is because KML has an absurd requirement
-    of allowing `when` tags to be decoupled from their associated `gx:coord`
-    tags which makes the single-pass approach significantly slower.
-    """
-
-    def __init__(self, filename):
-        self.whens = deque()
-        self.coords = deque()
-
-        TrackFile.__init__(self, filename,
-                           'kml', ('gx:Track', 'when', 'gx:coord'))
-
-    def element_start(self, name, attributes=None):
-        """Make note of where new polygons start."""
-        if name == self.watchlist[0]:
-            self.whens.append(None)
-            self.coords.append(None)
-            return False
-        return True
-
-    def element_end(self, name, state):
-        """Watch for complete pairs of when and gx:coord tags.
-
-        This is accomplished by maintaining parallel deques of each tag.
-        """
-        if name == 'when':
-            try:
-                timestamp = timegm(parse_date(state['when']).utctimetuple())
-            except Exception as error:
-                print(error)
-                return
-            self.whens.append(timestamp)
-        if name == 'gx:coord':
-            self.coords.append(state['gx:coord'].split())
-        TrackFile.element_end(self)
-
-    def parse(self, filename, root, watch, start, end):
-        """Trigger the first pass and then do the second pass."""
-        # First pass
-        TrackFile.parse(filename, root, watch, start, end)
-
-        # Second pass
-        TrackFile.element_start(self, 'gx:Track')
-
-        whens = self.whens
-        coords = self.coords
-        tracks = self.tracks
-        append = self.append
-
-        while whens and coords:
-            when = whens.popleft()
-            coord = coords.popleft()
-            try:
-                tracks[when] = append(
-                    float(coord[1]), float(coord[0]), coord[2])
-            except TypeError:
-                TrackFile.element_start(self, 'gx:Track')
-                append = self.append
-            else:
-                TrackFile.element_end(self)
+    """Support for Google's Keyhole Markup Language."""
+    reader = KMLReader
 
 
 @memoize
 class CSVFile(TrackFile):
-    """Support for Google's MyTracks' Comma Separated Values format.
-
-    This implementation ignores everything before the first line that contains
-    the necessary column headers, allowing you to have any arbitrary preamble
-    you like. Extra columns are harmlessly ignored. All "values" must be
-    "quoted" with "double quotes".
-    """
-    columns = None
-
-    def __init__(self, filename):
-        TrackFile.__init__(
-            self, filename, None,
-            ('Segment', 'Latitude (deg)', 'Longitude (deg)', 'Time'))
-
-    def parse(self, filename, root, watch, start, end):
-        """Call the appropriate handler for each line of the file."""
-        with open(filename) as lines:
-            parse_line = re_compile(r'"([^"]*)",?').findall
-            for line in lines:
-                self.parse_header(parse_line(line), self.columns)
-
-    def parse_header(self, state, columns, alt='Altitude (m)'):
-        """Ignore as many lines as necessary until column headers are found."""
-        try:
-            self.columns = Struct({
-                col.split(' ')[0].lower(): state.index(col)
-                for col in self.watchlist})
-        except ValueError:
-            return
-
-        self.columns.alt = state.index(alt) if alt in state else -1
-
-        self.parse_header = self.parse_row
-
-    def parse_row(self, state, col):
-        """All subsequent lines contain one track point each."""
-        try:
-            if int(state[col.segment]) > len(self.polygons):
-                self.element_start('Segment')
-
-            timestamp = timegm(list(map(int, split(state[col.time])[0:6])))
-            lat = float(state[col.latitude])
-            lon = float(state[col.longitude])
-        except Exception as error:
-            print(error)
-            return
-
-        self.tracks[timestamp] = self.append(
-            lat, lon, state[col.alt] if col.alt >= 0 else 0.0)
-
-        TrackFile.element_end(self)
+    """Support for Google's MyTracks' Comma Separated Values format."""
+    reader = CSVReader
@@ -54,6 +54,7 @@ class BaseTestCase(unittest.TestCase):
         giMock.Gio.Settings.__getitem__ = Mock()
         giMock.Gio.Settings.bind = Mock()
         giMock.Gio.Settings.connect = Mock()
+        giMock.Gio.Settings.get_boolean = Mock(return_value=False)
         giMock.Gio.Settings.get_int = Mock()
         giMock.Gio.Settings.get_string = Mock()
         giMock.Gio.Settings.get_value = Mock()
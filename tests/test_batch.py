@@ -0,0 +1,225 @@
+"""Test the classes and functions defined by gg/batch.py"""
+
+import sys
+from io import StringIO
+from argparse import ArgumentTypeError
+from collections import namedtuple
+from tempfile import TemporaryDirectory
+from datetime import timedelta
+from mock import Mock
+from os.path import join
+
+from gg.correlate import Timeline
+from tests import BaseTestCase
+
+
+Metadata = namedtuple('Metadata', 'exif orig_time gps names camera_info')
+Fix = namedtuple('Fix', 'filename timestamp lat lon ele names timezone')
+
+
+class point:
+    def __init__(self, lat, lon, ele):
+        self.lat = lat
+        self.lon = lon
+        self.ele = ele
+
+
+class BatchTestCase(BaseTestCase):
+    filename = 'batch'
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(sys.modules.pop, 'gg.batch', None)
+        self.mod.core_inspect_file = self.mod.inspect_file
+        self.mod.lookup_geodata = Mock(return_value=(
+            ('Edmonton', 'Alberta', 'Canada'), 'America/Edmonton'))
+        self.timeline = Timeline({
+            1000: point(10, 20, 30),
+            2000: point(20, 40, 60),
+        })
+        self.metadata = Metadata(None, None, (0.0, 0.0, 0.0), (None,) * 3, {})
+        self.mod.inspect_file = Mock(return_value=('JPEG', self.metadata))
+        self.mod.geotag = Mock(return_value=True)
+        self.track = join(self.demo_dir, '2010 10 16.gpx')
+
+    def locate(self, timestamp):
+        """Make every photo appear to be taken at the given time."""
+        def locate(timeline, photos, *args, **kwargs):
+            return [Fix(photos[0][0], timestamp, 15.0, 30.0, 45.0,
+                        (None,) * 3, '')]
+        self.mod.locate = Mock(side_effect=locate)
+
+    def test_parse_timezone(self):
+        """Ensure we understand timezone names and offsets."""
+        tz = self.mod.parse_timezone('America/Edmonton')
+        self.assertEqual(tz.key, 'America/Edmonton')
+        self.assertEqual(self.mod.parse_timezone('5.75').utcoffset(None),
+                         timedelta(hours=5.75))
+        self.assertEqual(self.mod.parse_timezone('auto'), 'auto')
+        with self.assertRaises(ArgumentTypeError):
+            self.mod.parse_timezone('Atlantis/Lost_City')
+
+    def test_job_geotag(self):
+        """Ensure photos are located, geocoded, and saved."""
+        self.locate(1500)
+        job = self.mod.Job(self.timeline, 15, 'tz', sidecar=True)
+        result = job.geotag('a.jpg')
+        self.assertEqual(result.status, self.mod.TAGGED)
+        self.assertEqual(result.fix.names, ('Edmonton', 'Alberta', 'Canada'))
+        self.mod.locate.assert_called_once_with(
+            self.timeline, [('a.jpg', self.metadata)], 15, 'tz',
+            geocode=False)
+        self.mod.geotag.assert_called_once_with(
+            result.fix, self.metadata, True)
+
+    def test_job_geotag_unchanged(self):
+        """Ensure photos that already have this location are reported."""
+        self.locate(1500)
+        self.mod.geotag.return_value = False
+        job = self.mod.Job(self.timeline)
+        self.assertEqual(job.geotag('a.jpg').status, self.mod.UNCHANGED)
+
+    def test_job_geotag_dry_run(self):
+        """Ensure nothing is saved in a dry run."""
+        self.locate(1500)
+        self.mod.is_new_location = Mock(return_value=True)
+        job = self.mod.Job(self.timeline, geocode=False, dry_run=True)
+        result = job.geotag('a.jpg')
+        self.assertEqual(result.status, self.mod.TAGGED)
+        self.assertEqual(self.mod.geotag.mock_calls, [])
+        self.assertEqual(self.mod.lookup_geodata.mock_calls, [])
+
+    def test_job_geotag_untracked(self):
+        """Ensure photos taken outside of the tracks aren't clamped to them."""
+        job = self.mod.Job(self.timeline)
+        for stamp in (999, 2001):
+            self.locate(stamp)
+            self.assertEqual(job.geotag('a.jpg').status, self.mod.UNTRACKED)
+        self.assertEqual(self.mod.geotag.mock_calls, [])
+
+    def test_job_geotag_skipped(self):
+        """Ensure photos that already have a location are left alone."""
+        self.locate(1500)
+        self.mod.inspect_file.return_value = (
+            'JPEG', self.metadata._replace(gps=(1.0, 2.0, 0.0)))
+        self.assertEqual(self.mod.Job(self.timeline).geotag('a.jpg').status,
+                         self.mod.SKIPPED)
+        job = self.mod.Job(self.timeline, overwrite=True)
+        self.assertEqual(job.geotag('a.jpg').status, self.mod.TAGGED)
+
+    def test_job_geotag_track(self):
+        """Ensure GPS tracks among the photos are ignored."""
+        self.mod.inspect_file.return_value = ('GPX', None)
+        self.assertEqual(self.mod.Job(self.timeline).geotag('a.gpx').status,
+                         self.mod.IGNORED)
+
+    def test_job_geotag_failed(self):
+        """Ensure errors are reported instead of raised."""
+        self.mod.inspect_file.side_effect = OSError('a.jpg: Not a photo.')
+        result = self.mod.Job(self.timeline).geotag('a.jpg')
+        self.assertEqual(
+            result, ('a.jpg', self.mod.FAILED, None, 'a.jpg: Not a photo.'))
+
+    def test_find_tracks(self):
+        """Ensure only tracks are found in folders."""
+        self.assertEqual(self.mod.find_tracks([self.demo_dir]), [self.track])
+        self.assertEqual(self.mod.find_tracks(['nope.gpx']), ['nope.gpx'])
+
+    def test_summarize(self):
+        """Ensure the summary mentions everything that happened."""
+        counts = self.mod.Counter({self.mod.TAGGED: 3, self.mod.UNTRACKED: 2,
+                                   self.mod.IGNORED: 1})
+        self.assertEqual(
+            self.mod.summarize(counts, 1.25),
+            'Geotagged 3 of 5 photos in 1.2s.\n'
+            '  2 were taken outside of the GPS tracks.')
+
+    def main(self, *argv):
+        """Run the batch command, returning the status and output."""
+        out, err = StringIO(), StringIO()
+        status = self.mod.main(list(argv), out, err)
+        return status, out.getvalue(), err.getvalue()
+
+    def test_main(self):
+        """Ensure the demo photos can be geotagged from the command line."""
+        metadata = self.metadata._replace(
+            orig_time=(2010, 10, 16, 14, 12, 28, 5, 289, -1))
+        self.mod.inspect_file.side_effect = lambda filename: (
+            ('GPX', None) if filename.endswith('.gpx') else ('JPEG', metadata))
+        status, out, err = self.main(
+            '-t', self.demo_dir, '-z', '-6', '-j', '1', '-v', self.demo_dir)
+        self.assertEqual(status, self.mod.EXIT_OK)
+        self.assertEqual(err, '')
+        self.assertIn('IMG_2411.JPG: tagged 53.52996, -113.44801 '
+                      '(Edmonton, Alberta, Canada)', out)
+        self.assertIn('Geotagged 2 of 2 photos', out)
+        self.assertEqual(len(self.mod.geotag.mock_calls), 2)
+
+    def test_main_processes(self):
+        """Ensure worker processes place photos just like this one does."""
+        self.mod.inspect_file = self.mod.core_inspect_file
+        photos = [join(self.demo_dir, 'IMG_2411.JPG'),
+                  join(self.demo_dir, 'IMG_2421.JPG')]
+        results = []
+        for jobs in ('1', '2'):
+            status, out, err = self.main(
+                '-t', self.track, '-z', '-6', '-j', jobs, '-n',
+                '--no-geocode', '-v', *photos)
+            self.assertEqual(status, self.mod.EXIT_OK)
+            self.assertEqual(err, '')
+            self.assertIn('Would geotag 2 of 2 photos', out)
+            results.append(out.splitlines()[:2])
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0][0],
+                         'IMG_2411.JPG: tagged 53.52996, -113.44801')
+        self.assertEqual(self.mod.geotag.mock_calls, [])
+
+    def test_main_export(self):
+        """Ensure the placed photos can be exported as they're geotagged."""
+        self.locate(1287259751)
+        with TemporaryDirectory() as tmp:
+            filename = join(tmp, 'photos.csv')
+            status, out, err = self.main(
+                '-t', self.track, '-j', '1', '-q', '--export', filename,
+                'a.jpg', 'b.jpg')
+            with open(filename) as export:
+                rows = export.read().splitlines()
+        self.assertEqual(status, self.mod.EXIT_OK)
+        self.assertEqual(len(rows), 3)
+        self.assertTrue(rows[1].startswith('a.jpg,2010-10-16T20:09:11Z,'))
+
+    def test_main_export_unknown(self):
+        """Ensure unknown export formats are refused before geotagging."""
+        sys.stderr, stderr = StringIO(), sys.stderr
+        try:
+            status = self.main(
+                '-t', self.track, '--export', 'a.txt', 'a.jpg')[0]
+        finally:
+            sys.stderr = stderr
+        self.assertEqual(status, self.mod.EXIT_USAGE)
+        self.assertEqual(self.mod.inspect_file.mock_calls, [])
+
+    def test_main_failed(self):
+        """Ensure failures are reported and change the exit status."""
+        self.mod.inspect_file.side_effect = OSError('Not a photo.')
+        status, out, err = self.main('-t', self.track, '-q', 'a.jpg')
+        self.assertEqual(status, self.mod.EXIT_FAILED)
+        self.assertEqual(out, '')
+        self.assertEqual(err, 'a.jpg: Not a photo.\n')
+
+    def test_main_bad_track(self):
+        """Ensure unreadable tracks stop everything."""
+        status, out, err = self.main(
+            '-t', join(self.root_dir, 'README.md'), 'a.jpg')
+        self.assertEqual(status, self.mod.EXIT_USAGE)
+        self.assertIn('Not a GPS track', err)
+        self.assertEqual(self.mod.inspect_file.mock_calls, [])
+
+    def test_main_usage(self):
+        """Ensure bad arguments are refused."""
+        self.assertEqual(self.mod.make_parser().prog, 'gottengeography batch')
+        sys.stderr, stderr = StringIO(), sys.stderr
+        try:
+            self.assertEqual(self.main('a.jpg')[0], self.mod.EXIT_USAGE)
+        finally:
+            sys.stderr = stderr
@@ -1,10 +1,179 @@
 """Test the classes and functions defined by gg/camera.py"""
 
+from datetime import datetime
+from mock import Mock
+
 from tests import BaseTestCase
 
+JAN = datetime(2015, 1, 1)
+
 
 class CameraTestCase(BaseTestCase):
     filename = 'camera'
 
     def setUp(self):
         super().setUp()
+
+    def test_camera_offset_handler(self):
+        """Ensure offset changes recalculate photos in a single batch."""
+        self.mod.timeline = Mock()
+        photos = set([Mock(), Mock()])
+        cam = Mock(offset=30, photos=photos)
+        self.mod.Camera.__wrapped__.offset_handler(cam)
+        for photo in photos:
+            photo.calculate_timestamp.assert_called_once_with(
+                30, correlate=False)
+        self.mod.timeline.correlate.assert_called_once_with(photos)
+
+    def test_camera_offset_changed(self):
+        """Ensure slider movements are coalesced into a single update."""
+        cam = Mock(generation=0, offset_timeout=None)
+        Camera = self.mod.Camera.__wrapped__
+        cam.cancel_correlation = lambda: Camera.cancel_correlation(cam)
+        Camera.offset_changed(cam)
+        Camera.offset_changed(cam)
+        self.assertEqual(cam.generation, 2)
+        self.mod.GLib.source_remove.assert_called_once_with(
+            self.mod.GLib.timeout_add.return_value)
+        self.assertEqual(
+            cam.offset_timeout, self.mod.GLib.timeout_add.return_value)
+
+    def test_camera_background_correlation(self):
+        """Ensure the worker calculates results without touching photos."""
+        self.mod.timeline = Mock(arrays=([1, 2], [3, 4], [5, 6], [7, 8]))
+        photo = Mock()
+        photo.timestamp_at.return_value = 100
+        cam = Mock(generation=3)
+        self.mod.Camera.__wrapped__.background_correlation(cam, 3, [photo], 7)
+        photo.timestamp_at.assert_called_once_with(7)
+        self.mod.timeline.interpolate.assert_called_once_with(
+            [100], self.mod.timeline.arrays)
+        self.mod.GLib.idle_add.assert_called_once_with(
+            cam.finish_correlation, 3, [photo], [100],
+            self.mod.timeline.arrays,
+            self.mod.timeline.interpolate.return_value)
+        self.assertEqual(photo.set_location.mock_calls, [])
+
+    def test_camera_background_correlation_failed(self):
+        """Ensure the photos are still updated if the worker fails."""
+        self.mod.timeline = Mock(arrays=([1, 2], [3, 4], [5, 6], [7, 8]))
+        self.mod.timeline.interpolate.side_effect = IndexError
+        photo = Mock()
+        photo.timestamp_at.return_value = 100
+        cam = Mock(generation=3)
+        with self.assertRaises(IndexError):
+            self.mod.Camera.__wrapped__.background_correlation(
+                cam, 3, [photo], 7)
+        self.mod.GLib.idle_add.assert_called_once_with(
+            cam.finish_correlation, 3, [photo], [100],
+            self.mod.timeline.arrays, None)
+
+    def test_camera_background_correlation_cancelled(self):
+        """Ensure the worker gives up when the offset moves again."""
+        photo = Mock()
+        cam = Mock(generation=4)
+        self.mod.Camera.__wrapped__.background_correlation(cam, 3, [photo], 7)
+        self.assertEqual(photo.timestamp_at.mock_calls, [])
+        self.assertEqual(self.mod.GLib.idle_add.mock_calls, [])
+
+    def test_camera_finish_correlation(self):
+        """Ensure only current results for this camera's photos are applied."""
+        self.mod.timeline = Mock()
+        cam = Mock(generation=3)
+        mine, gone = Mock(camera=cam, timestamp=5), Mock(camera=None)
+        Camera = self.mod.Camera.__wrapped__
+        self.assertFalse(Camera.finish_correlation(
+            cam, 3, [mine, gone], [10, 20], self.mod.timeline.arrays,
+            [(1, 2, 3), (4, 5, 6)]))
+        self.assertEqual(mine.timestamp, 10)
+        self.mod.timeline.apply.assert_called_once_with([mine], [(1, 2, 3)])
+        self.assertEqual(self.mod.timeline.correlate.mock_calls, [])
+
+        Camera.finish_correlation(cam, 2, [mine], [30], None, None)
+        self.assertEqual(mine.timestamp, 10)
+
+    def test_camera_finish_correlation_untracked(self):
+        """Ensure photos are correlated again when there were no positions."""
+        self.mod.timeline = Mock()
+        cam = Mock(generation=3)
+        mine, gone = Mock(camera=cam, timestamp=5), Mock(camera=None)
+        self.mod.Camera.__wrapped__.finish_correlation(
+            cam, 3, [mine, gone], [10, 20], self.mod.timeline.arrays, None)
+        self.assertEqual(mine.timestamp, 10)
+        self.mod.timeline.correlate.assert_called_once_with([mine])
+        self.assertEqual(self.mod.timeline.apply.mock_calls, [])
+
+    def test_camera_estimate_offset(self):
+        """Ensure we only consider photos that were already geotagged."""
+        self.mod.estimate_offset = Mock(return_value=-42)
+        tagged, untagged = Mock(orig_gps=(1, 2, 3)), Mock(orig_gps=None)
+        tagged.timestamp_at.return_value = 100
+        cam = Mock(photos=[tagged, untagged], offset=0)
+        self.mod.Camera.__wrapped__.estimate_offset(cam)
+        tagged.timestamp_at.assert_called_once_with(0)
+        self.mod.estimate_offset.assert_called_once_with(
+            self.mod.timeline, [(100, 1, 2)])
+        self.assertEqual(cam.offset, -42)
+
+    def test_camera_estimate_offset_impossible(self):
+        """Ensure we tell the user when there is nothing to compare."""
+        self.mod.estimate_offset = Mock(return_value=None)
+        self.mod.Widgets = Mock()
+        cam = Mock(photos=[], offset=5)
+        self.mod.Camera.__wrapped__.estimate_offset(cam)
+        self.assertEqual(cam.offset, 5)
+        self.assertEqual(self.mod.Widgets.status_message.call_count, 1)
+
+    def test_camera_refresh_new_photos(self):
+        """Ensure only newly added photos are recalculated."""
+        self.mod.timeline = Mock()
+        photo = Mock()
+        cam = Mock(tzinfo='UTC', offset=9, unsynced=set([photo]))
+        cam.get_tzinfo.return_value = 'UTC'
+        self.mod.Camera.__wrapped__.refresh(cam)
+        self.assertEqual(cam.timezone_handler.mock_calls, [])
+        photo.calculate_timestamp.assert_called_once_with(9, correlate=False)
+        self.mod.timeline.correlate.assert_called_once_with([photo])
+        self.assertEqual(cam.unsynced, set())
+
+    def test_camera_refresh_new_timezone(self):
+        """Ensure everything is recalculated when the timezone changes."""
+        cam = Mock(tzinfo='UTC', unsynced=set([Mock()]))
+        cam.get_tzinfo.return_value = 'America/Edmonton'
+        self.mod.Camera.__wrapped__.refresh(cam)
+        cam.timezone_handler.assert_called_once_with()
+
+    def test_camera_refresh_nothing(self):
+        """Ensure nothing happens when nothing has changed."""
+        self.mod.timeline = Mock()
+        cam = Mock(tzinfo=None, unsynced=set())
+        cam.get_tzinfo.return_value = None
+        self.mod.Camera.__wrapped__.refresh(cam)
+        self.assertEqual(cam.timezone_handler.mock_calls, [])
+        self.assertEqual(self.mod.timeline.correlate.mock_calls, [])
+
+    def test_camera_get_tzinfo(self):
+        """Ensure each timezone method produces the right kind of tzinfo."""
+        get_tzinfo = self.mod.Camera.__wrapped__.get_tzinfo
+        cam = Mock(timezone_method='system')
+        self.assertIsNone(get_tzinfo(cam))
+        cam = Mock(timezone_method='lookup', found_timezone='Asia/Tokyo')
+        self.assertEqual(
+            get_tzinfo(cam).utcoffset(JAN).total_seconds(), 9 * 3600)
+        cam = Mock(timezone_method='lookup', found_timezone='')
+        self.assertIsNone(get_tzinfo(cam))
+        cam = Mock(timezone_method='offset', utc_offset='-3.5')
+        self.assertEqual(
+            get_tzinfo(cam).utcoffset(JAN).total_seconds(), -3.5 * 3600)
+        cam = Mock(timezone_method='custom',
+                   timezone_region='America', timezone_city='Regina')
+        self.assertEqual(
+            get_tzinfo(cam).utcoffset(JAN).total_seconds(), -6 * 3600)
+
+    def test_camera_timezone_handler(self):
+        """Ensure changing timezones recalculates every photo."""
+        cam = Mock(unsynced=set([Mock()]))
+        self.mod.Camera.__wrapped__.timezone_handler(cam)
+        self.assertEqual(cam.tzinfo, cam.get_tzinfo.return_value)
+        self.assertEqual(cam.unsynced, set())
+        cam.offset_handler.assert_called_once_with()
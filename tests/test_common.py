@@ -44,6 +44,25 @@ class CommonTestCase(BaseTestCase):
         self.assertEqual(len(Memorable.instances), 2)
         self.assertEqual(print_.call_count, 2)
 
+    def test_parallel_map(self):
+        """Ensure we get results in order, with exceptions kept separate."""
+        def invert(x):
+            return 1 / x
+        results = list(self.mod.parallel_map(invert, range(-20, 21), 2))
+        self.assertEqual([item for item, future in results],
+                         list(range(-20, 21)))
+        with self.assertRaises(ZeroDivisionError):
+            results[20][1].result()
+        self.assertEqual(results[21][1].result(), 1)
+
+    def test_parallel_map_lookahead(self):
+        """Ensure we don't run too far ahead of the caller."""
+        started = []
+        results = self.mod.parallel_map(started.append, range(100), 2)
+        next(results)[1].result()
+        self.assertLessEqual(len(started), 9)
+        self.assertEqual(len(list(results)), 99)
+
     def test_binding(self):
         """Ensure we can bind GObject properties to GSettings keys."""
         m = self.mod.GObject.Binding.__init__ = Mock()
@@ -0,0 +1,133 @@
+"""Test the classes and functions defined by gg/core.py"""
+
+import sys
+from collections import namedtuple
+from mock import Mock
+from os.path import join
+
+from gg.correlate import Timeline, fixed_tzinfo
+from tests import BaseTestCase
+
+
+Metadata = namedtuple('Metadata', 'exif orig_time gps names camera_info')
+
+
+class point:
+    def __init__(self, lat, lon, ele):
+        self.lat = lat
+        self.lon = lon
+        self.ele = ele
+
+
+class CoreTestCase(BaseTestCase):
+    filename = 'core'
+
+    def setUp(self):
+        super().setUp()
+        # Other modules import gg.core, so they mustn't see these mocks.
+        self.addCleanup(sys.modules.pop, 'gg.core', None)
+        self.mod.lookup_geodata = Mock(return_value=(
+            ('Edmonton', 'Alberta', 'Canada'), 'America/Edmonton'))
+        self.timeline = Timeline({
+            1000: point(10, 20, 30),
+            2000: point(20, 40, 60),
+        })
+
+    def test_inspect_file_photo(self):
+        """Ensure we read metadata from photos."""
+        self.mod.sniff = Mock(return_value='JPEG')
+        self.mod.read_metadata = Mock()
+        self.assertEqual(
+            self.mod.inspect_file('IMG_1.JPG'),
+            ('JPEG', self.mod.read_metadata.return_value))
+        self.mod.read_metadata.assert_called_once_with('IMG_1.JPG')
+
+    def test_inspect_file_track(self):
+        """Ensure we don't try to read metadata from GPS tracks."""
+        self.mod.read_metadata = Mock()
+        self.assertEqual(
+            self.mod.inspect_file(self.demo_dir + '/2010 10 16.gpx'),
+            ('GPX', None))
+        self.assertEqual(self.mod.read_metadata.mock_calls, [])
+
+    def test_inspect_file_unsupported(self):
+        """Ensure we reject files that are neither photos nor tracks."""
+        self.mod.sniff = Mock(return_value='XML')
+        with self.assertRaisesRegexp(OSError, 'Unsupported'):
+            self.mod.inspect_file('index.html')
+
+    def test_load_tracks(self):
+        """Ensure tracks from several files end up in one timeline."""
+        timeline = self.mod.load_tracks([
+            join(self.data_dir, 'minimal.gpx'),
+            join(self.data_dir, 'minimal.csv')])
+        self.assertEqual(len(timeline), 6)
+        self.assertEqual(timeline.stamps[0], 1287259751)
+
+    def test_load_tracks_unsupported(self):
+        """Ensure files that aren't tracks are reported."""
+        with self.assertRaises(OSError):
+            self.mod.load_tracks([join(self.root_dir, 'README.md')])
+
+    def test_photo_timestamp(self):
+        """Ensure the camera's timezone and clock offset are applied."""
+        self.assertEqual(
+            self.mod.photo_timestamp(
+                'IMG_1.JPG', (2015, 1, 3, 12, 13, 14, 5, 3, -1), 30,
+                fixed_tzinfo(-7)),
+            1420312424)
+
+    def test_photo_timestamp_missing(self):
+        """Ensure photos without a timestamp use the file's mtime."""
+        self.mod.stat = Mock(return_value=Mock(st_mtime=1234.5))
+        self.assertEqual(self.mod.photo_timestamp('IMG_1.JPG', None, 6), 1240)
+        self.mod.stat.assert_called_once_with('IMG_1.JPG')
+
+    def test_locate(self):
+        """Ensure photos are placed along the track and geocoded."""
+        self.mod.photo_timestamp = Mock(side_effect=[1500, 2500])
+        metadata = Metadata(None, 'orig', (0.0, 0.0, 0.0), (None,) * 3, {})
+        fixes = self.mod.locate(
+            self.timeline, [('a.jpg', metadata), ('b.jpg', metadata)], 15)
+        self.assertEqual(
+            fixes,
+            [('a.jpg', 1500, 15.0, 30.0, 45.0,
+              ('Edmonton', 'Alberta', 'Canada'), 'America/Edmonton'),
+             ('b.jpg', 2500, 20, 40, 60,
+              ('Edmonton', 'Alberta', 'Canada'), 'America/Edmonton')])
+        self.mod.photo_timestamp.assert_any_call('a.jpg', 'orig', 15, None)
+        self.mod.lookup_geodata.assert_any_call(15.0, 30.0)
+
+    def test_locate_without_geocoding(self):
+        """Ensure geocoding can be skipped."""
+        metadata = Metadata(None, None, (0.0, 0.0, 0.0), (None,) * 3, {})
+        self.mod.photo_timestamp = Mock(return_value=1000)
+        fix, = self.mod.locate(
+            self.timeline, [('a.jpg', metadata)], geocode=False)
+        self.assertEqual(fix.names, (None, None, None))
+        self.assertEqual(fix.timezone, '')
+        self.assertEqual(self.mod.lookup_geodata.mock_calls, [])
+
+    def test_locate_no_tracks(self):
+        """Ensure nothing is located without any GPS data."""
+        metadata = Metadata(None, None, (0.0, 0.0, 0.0), (None,) * 3, {})
+        self.assertEqual(
+            self.mod.locate(Timeline(), [('a.jpg', metadata)]), [])
+
+    def test_geotag(self):
+        """Ensure locations are written to photos."""
+        self.mod.save_metadata = Mock()
+        fix = self.mod.Fix('a.jpg', 1000, 10, 20, 30, ('Here', None, None), '')
+        metadata = Metadata('exif', None, (0.0, 0.0, 0.0), (None,) * 3, {})
+        self.assertTrue(self.mod.geotag(fix, metadata, True))
+        self.mod.save_metadata.assert_called_once_with(
+            'a.jpg', 'exif', (20, 10, 30), ('Here', None, None), True)
+
+    def test_geotag_unchanged(self):
+        """Ensure photos that are already in place aren't rewritten."""
+        self.mod.save_metadata = Mock()
+        fix = self.mod.Fix('a.jpg', 1000, 10, 20, 30, ('Here', None, None), '')
+        metadata = Metadata(
+            None, None, (20.000001, 9.999999, 30.01), ('Here', '', ''), {})
+        self.assertFalse(self.mod.geotag(fix, metadata))
+        self.assertEqual(self.mod.save_metadata.mock_calls, [])
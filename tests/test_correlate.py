@@ -0,0 +1,125 @@
+"""Test the classes and functions defined by gg/correlate.py"""
+
+from mock import Mock
+
+from tests import BaseTestCase
+
+inf = float('inf')
+
+
+class point:
+    def __init__(self, lat, lon, ele):
+        self.lat = lat
+        self.lon = lon
+        self.ele = ele
+
+
+class CorrelateTestCase(BaseTestCase):
+    filename = 'correlate'
+
+    def setUp(self):
+        super().setUp()
+        self.timeline = self.mod.Timeline({
+            10: point(0, 0, 0),
+            20: point(10, 100, 1000),
+            40: point(30, 300, 3000),
+        })
+
+    def photo(self, timestamp, manual=False):
+        return Mock(timestamp=timestamp, manual=manual,
+                    latitude=0.0, longitude=0.0, altitude=0.0)
+
+    def test_timeline_load(self):
+        """Ensure the timeline sorts points and replaces old data at once."""
+        arrays = self.timeline.arrays
+        self.timeline.load({5: point(1, 2, 3), 2: point(4, 5, 6)})
+        self.assertEqual(arrays[0], [10, 20, 40])
+        self.assertEqual(self.timeline.stamps, [2, 5])
+        self.assertEqual(self.timeline.arrays,
+                         ([2, 5], [4, 1], [5, 2], [6, 3]))
+        self.assertEqual(len(self.timeline), 2)
+
+    def test_timeline_interpolate(self):
+        """Ensure we can interpolate many timestamps at once."""
+        self.assertEqual(
+            self.timeline.interpolate([1, 10, 15, 20, 30, 35, 40, 99]),
+            [(0, 0, 0), (0, 0, 0), (5.0, 50.0, 500.0), (10, 100, 1000),
+             (20.0, 200.0, 2000.0), (25.0, 250.0, 2500.0),
+             (30, 300, 3000), (30, 300, 3000)])
+
+    def test_timeline_interpolate_snapshot(self):
+        """Ensure a snapshot is still used after the timeline is emptied."""
+        arrays = self.timeline.arrays
+        self.timeline.load({})
+        self.assertEqual(self.timeline.interpolate([15], arrays),
+                         [(5.0, 50.0, 500.0)])
+
+    def test_timeline_correlate(self):
+        """Ensure we position automatic photos and leave manual ones alone."""
+        auto, manual = self.photo(15), self.photo(15, manual=True)
+        self.assertEqual(self.timeline.correlate([auto, manual]), [auto])
+        auto.set_location.assert_called_once_with(5.0, 50.0, 500.0)
+        auto.freeze_notify.assert_called_once_with()
+        auto.thaw_notify.assert_called_once_with()
+        self.assertEqual(manual.set_location.mock_calls, [])
+
+    def test_timeline_correlate_unchanged(self):
+        """Ensure photos that are already in place are not modified."""
+        photo = self.photo(10)
+        self.assertEqual(self.timeline.correlate([photo]), [])
+        self.assertEqual(photo.set_location.mock_calls, [])
+
+    def test_timeline_correlate_empty(self):
+        """Ensure we do nothing without at least two track points."""
+        photo = self.photo(15)
+        timeline = self.mod.Timeline({10: point(1, 1, 1)})
+        self.assertEqual(timeline.correlate([photo]), [])
+        self.assertEqual(photo.set_location.mock_calls, [])
+
+    def test_timeline_apply(self):
+        """Ensure we can apply positions that were calculated elsewhere."""
+        one, two = self.photo(15), self.photo(15, manual=True)
+        self.assertEqual(
+            self.mod.Timeline.apply([one, two], [(1, 2, 3), (4, 5, 6)]),
+            [one])
+        one.set_location.assert_called_once_with(1, 2, 3)
+        self.assertEqual(two.set_location.mock_calls, [])
+
+    def test_estimate_offset(self):
+        """Ensure we can find the clock offset from geotagged photos."""
+        timeline = self.mod.Timeline(
+            {t: point(t / 1000, t / 2000, 0) for t in range(0, 9000, 10)})
+        samples = [(t + 421, t / 1000, t / 2000) for t in range(2000, 7000)]
+        self.assertEqual(self.mod.estimate_offset(timeline, samples), -421)
+        self.assertEqual(
+            self.mod.estimate_offset(timeline, samples, limit=100), -100)
+
+    def test_estimate_offset_no_data(self):
+        """Ensure we don't guess anything without data to compare."""
+        self.assertIsNone(self.mod.estimate_offset(self.timeline, []))
+        self.assertIsNone(
+            self.mod.estimate_offset(self.mod.Timeline(), [(1, 2, 3)]))
+
+    def test_timeline_affected(self):
+        """Ensure we can tell which photos depend on part of a track."""
+        self.assertEqual(self.timeline.affected(20, 20), (10, 40))
+        self.assertEqual(self.timeline.affected(15, 25), (10, 40))
+        self.assertEqual(self.timeline.affected(10, 20), (-inf, 40))
+        self.assertEqual(self.timeline.affected(40, 50), (20, inf))
+        self.assertEqual(self.mod.Timeline().affected(1, 2), (-inf, inf))
+
+    def test_photo_index(self):
+        """Ensure we can find photos by timestamp."""
+        index = self.mod.PhotoIndex()
+        one, two, three = self.photo(30), self.photo(10), self.photo(20)
+        for photo in (one, two, three):
+            index.add(photo)
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.between(-inf, inf), [two, three, one])
+        self.assertEqual(index.between(11, 30), [three, one])
+        two.timestamp = 25
+        self.assertEqual(index.between(11, 30), [three, one])
+        index.invalidate()
+        self.assertEqual(index.between(11, 30), [three, two, one])
+        index.discard(three)
+        self.assertEqual(index.between(11, 30), [two, one])
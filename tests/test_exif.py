@@ -0,0 +1,254 @@
+"""Test the classes and functions defined by gg/exif.py"""
+
+from struct import pack
+from mock import Mock
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+from os.path import join
+
+from tests import BaseTestCase
+
+
+def ifd(order, entries, start, after=b''):
+    """Pack an IFD at offset start, with out-of-line values following it."""
+    data = b''
+    extra = start + 2 + 12 * len(entries) + 4
+    out = b''
+    for tag, kind, count, value in entries:
+        if len(value) > 4:
+            data += pack(order + 'HHII', tag, kind, count, extra + len(out))
+            out += value
+        else:
+            data += pack(order + 'HHI', tag, kind, count) + \
+                value.ljust(4, b'\0')
+    return pack(order + 'H', len(entries)) + data + pack(order + 'I', 0) + out
+
+
+def rationals(order, *values):
+    return b''.join(pack(order + 'II', num, den) for num, den in values)
+
+
+def tiff(order='<', gps=True):
+    """Build a small TIFF with camera, time, and GPS tags."""
+    magic = b'II' if order == '<' else b'MM'
+    gps_entries = [
+        (1, 2, 2, b'S\0'),
+        (2, 5, 3, rationals(order, (49, 1), (30, 1), (36, 1))),
+        (3, 2, 2, b'W\0'),
+        (4, 5, 3, rationals(order, (123, 1), (15, 1), (0, 0))),
+        (5, 1, 1, b'\x01'),
+        (6, 5, 1, rationals(order, (1205, 10))),
+    ]
+    exif_entries = [
+        (0x9003, 2, 20, b'2015:01:03 12:13:14\0'),
+        (0xA431, 2, 6, b'12345\0'),
+    ]
+    # Lay out IFD0, then the Exif IFD, then the GPS IFD.
+    image_entries = [
+        (0x010F, 2, 6, b'Canon\0'),
+        (0x0110, 2, 10, b'PowerShot\0'),
+        (0x0112, 3, 1, pack(order + 'H', 6)),
+        (0x8769, 4, 1, pack(order + 'I', 0)),
+        (0x8825, 4, 1, pack(order + 'I', 0)),
+    ]
+    if not gps:
+        image_entries.pop()
+    ifd0 = ifd(order, image_entries, 8)
+    exif_at = 8 + len(ifd0)
+    exif = ifd(order, exif_entries, exif_at)
+    gps_at = exif_at + len(exif)
+    image_entries[3] = (0x8769, 4, 1, pack(order + 'I', exif_at))
+    if gps:
+        image_entries[4] = (0x8825, 4, 1, pack(order + 'I', gps_at))
+    ifd0 = ifd(order, image_entries, 8)
+    return (magic + pack(order + 'HI', 42, 8) + ifd0 + exif +
+            ifd(order, gps_entries, gps_at))
+
+
+def iptc(utf8=True, **names):
+    """Build an IPTC block with the given record 2 datasets."""
+    data = b''
+    if utf8:
+        data += b'\x1c\x01\x5a' + pack('>H', 3) + b'\x1b%G'
+    for dataset, name in sorted(names.items()):
+        value = name.encode('utf-8' if utf8 else 'latin-1')
+        data += b'\x1c\x02' + bytes([int(dataset[1:])]) + \
+            pack('>H', len(value)) + value
+    return data
+
+
+def jpeg(payload, names=b''):
+    """Wrap some TIFF data in the APP1 segment of a JPEG, and IPTC in APP13."""
+    app0 = b'\xff\xe0' + pack('>H', 16) + b'JFIF\0' + bytes(9)
+    app1 = b''
+    if payload:
+        app1 = b'\xff\xe1' + pack('>H', len(payload) + 8) + b'Exif\0\0' + \
+            payload
+    app13 = b''
+    if names:
+        # An unrelated resource with a name, and then the IPTC resource.
+        resources = (b'8BIM\x03\xed\x03abc' + pack('>I', 3) + b'xyz\0' +
+                     b'8BIM\x04\x04\0\0' + pack('>I', len(names)) + names)
+        app13 = b'\xff\xed' + pack('>H', len(resources) + 16) + \
+            b'Photoshop 3.0\0' + resources
+    return b'\xff\xd8' + app0 + app1 + app13 + b'\xff\xda' + bytes(100)
+
+
+class ExifTestCase(BaseTestCase):
+    filename = 'exif'
+
+    def check(self, header):
+        self.assertEqual(header['Exif.Image.Make'], 'Canon')
+        self.assertEqual(header['Exif.Image.Model'], 'PowerShot')
+        # Thumbnails read the orientation with GExiv2 along with previews.
+        self.assertNotIn('Exif.Image.Orientation', header)
+        self.assertEqual(
+            header['Exif.Photo.DateTimeOriginal'], '2015:01:03 12:13:14')
+        self.assertEqual(header['Exif.Photo.BodySerialNumber'], '12345')
+        lon, lat, ele = header.get_gps_info()
+        self.assertAlmostEqual(lat, -49.51)
+        self.assertAlmostEqual(lon, -123.25)
+        self.assertAlmostEqual(ele, -120.5)
+
+    def test_parse_tiff_little_endian(self):
+        """Ensure we can read Intel byte order TIFF files."""
+        self.check(self.mod.parse_header(tiff('<')))
+
+    def test_parse_tiff_big_endian(self):
+        """Ensure we can read Motorola byte order TIFF files."""
+        self.check(self.mod.parse_header(tiff('>')))
+
+    def test_parse_jpeg(self):
+        """Ensure we can find the EXIF data inside of a JPEG."""
+        self.check(self.mod.parse_header(jpeg(tiff('>'))))
+
+    def test_parse_jpeg_no_gps(self):
+        """Ensure photos without GPS data are at 0, 0, 0 like in GExiv2."""
+        header = self.mod.parse_header(jpeg(tiff(gps=False)))
+        self.assertEqual(header.get_gps_info(), (0.0, 0.0, 0.0))
+        self.assertEqual(header['Exif.Image.Make'], 'Canon')
+
+    def test_parse_jpeg_no_exif(self):
+        """Ensure we can read JPEGs that have no EXIF data at all."""
+        header = self.mod.parse_header(jpeg(b'')[:2] + b'\xff\xda' + bytes(9))
+        self.assertEqual(header, {})
+
+    def test_parse_jpeg_iptc(self):
+        """Ensure we can read the location names saved in a JPEG."""
+        header = self.mod.parse_header(
+            jpeg(tiff(), iptc(d90='Montréal', d95='Québec', d101='Canada')))
+        self.check(header)
+        self.assertEqual(header['Iptc.Application2.City'], 'Montréal')
+        self.assertEqual(header['Iptc.Application2.ProvinceState'], 'Québec')
+        self.assertEqual(header['Iptc.Application2.CountryName'], 'Canada')
+
+    def test_parse_jpeg_iptc_latin1(self):
+        """Ensure IPTC data without a character set is read as Latin-1."""
+        header = self.mod.parse_header(
+            jpeg(b'', iptc(False, d90='Montréal')))
+        self.assertEqual(header, {'Iptc.Application2.City': 'Montréal'})
+
+    def test_parse_tiff_iptc(self):
+        """Ensure we can read IPTC data that is embedded in a TIFF."""
+        names = iptc(d101='Canada')
+        data = tiff('<')
+        # Point the GPS entry of IFD0 at IPTC data on the end instead.
+        entry = data.index(pack('<HHI', 0x8825, 4, 1))
+        data = (data[:entry] +
+                pack('<HHII', 0x83BB, 7, len(names), len(data)) +
+                data[entry + 12:] + names)
+        header = self.mod.parse_header(data)
+        self.assertEqual(header['Iptc.Application2.CountryName'], 'Canada')
+        self.assertEqual(header['Exif.Image.Make'], 'Canon')
+
+    def test_parse_out_of_bounds(self):
+        """Ensure we give up on corrupt files so GExiv2 can have a go."""
+        with self.assertRaisesRegexp(ValueError, 'out of bounds'):
+            self.mod.parse_header(tiff()[:60])
+
+    def test_parse_bad_pointer(self):
+        """Ensure pointers that aren't offsets are ignored."""
+        for kind, count in ((4, 0), (2, 4)):
+            data = tiff('<')
+            entry = data.index(pack('<HHI', 0x8825, 4, 1))
+            data = (data[:entry] + pack('<HHI', 0x8825, kind, count) +
+                    data[entry + 8:])
+            header = self.mod.parse_header(data)
+            self.assertEqual(header['Exif.Image.Make'], 'Canon')
+            self.assertEqual(header.get_gps_info(), (0.0, 0.0, 0.0))
+
+    def test_parse_corrupt(self):
+        """Ensure any kind of parse error lets GExiv2 have a go."""
+        self.mod.find_tags = Mock(side_effect=IndexError)
+        with self.assertRaisesRegexp(ValueError, 'Corrupt'):
+            self.mod.parse_header(tiff())
+
+    def test_parse_bounded(self):
+        """Ensure we don't read too far into huge files."""
+        self.mod.MAX_HEADER = 50
+        with self.assertRaisesRegexp(ValueError, 'out of bounds'):
+            self.mod.parse_header(tiff())
+
+    def test_parse_unsupported(self):
+        """Ensure we don't try to read other file formats."""
+        with self.assertRaisesRegexp(ValueError, 'Unsupported'):
+            self.mod.parse_header(b'<?xml version="1.0"?><gpx></gpx>')
+
+    def test_read_header(self):
+        """Ensure we can read real photos."""
+        header = self.mod.read_header(self.demo_dir + '/IMG_2421.JPG')
+        self.assertEqual(header['Exif.Image.Make'], 'Canon')
+        self.assertEqual(
+            header['Exif.Photo.DateTimeOriginal'], '2010:10:16 14:20:16')
+
+    def test_read_header_empty(self):
+        """Ensure empty files aren't photos."""
+        with NamedTemporaryFile(suffix='.jpg') as empty:
+            with self.assertRaisesRegexp(ValueError, 'Empty'):
+                self.mod.read_header(empty.name)
+
+    def test_create_sidecar(self):
+        """Ensure we can create new XMP sidecars."""
+        with TemporaryDirectory() as tmp:
+            photo = join(tmp, 'IMG_1.CR2')
+            self.assertIsNone(self.mod.find_sidecar(photo))
+            sidecar = self.mod.create_sidecar(photo)
+            self.assertEqual(sidecar, join(tmp, 'IMG_1.CR2.xmp'))
+            with open(sidecar) as xmp:
+                self.assertIn('<x:xmpmeta', xmp.read())
+            self.assertEqual(self.mod.find_sidecar(photo), sidecar)
+
+    def test_find_sidecar_replaced(self):
+        """Ensure sidecars without the photo's extension are found."""
+        with TemporaryDirectory() as tmp:
+            photo = join(tmp, 'IMG_1.CR2')
+            open(photo, 'w').close()
+            with open(join(tmp, 'IMG_1.xmp'), 'w') as xmp:
+                xmp.write('lightroom')
+            self.assertEqual(
+                self.mod.find_sidecar(photo), join(tmp, 'IMG_1.xmp'))
+            self.assertEqual(
+                self.mod.create_sidecar(photo), join(tmp, 'IMG_1.xmp'))
+
+    def test_create_sidecar_pair(self):
+        """Ensure RAW+JPEG pairs don't share a sidecar."""
+        with TemporaryDirectory() as tmp:
+            raw, jpeg = join(tmp, 'IMG_1.CR2'), join(tmp, 'IMG_1.JPG')
+            for photo in (raw, jpeg):
+                open(photo, 'w').close()
+            with open(join(tmp, 'IMG_1.xmp'), 'w') as xmp:
+                xmp.write('ambiguous')
+            self.assertIsNone(self.mod.find_sidecar(raw))
+            self.assertIsNone(self.mod.find_sidecar(jpeg))
+            self.assertEqual(self.mod.create_sidecar(raw), raw + '.xmp')
+            self.assertEqual(self.mod.create_sidecar(jpeg), jpeg + '.xmp')
+            self.assertEqual(self.mod.find_sidecar(raw), raw + '.xmp')
+
+    def test_create_sidecar_existing(self):
+        """Ensure we don't clobber sidecars made by other programs."""
+        with TemporaryDirectory() as tmp:
+            photo = join(tmp, 'IMG_1.CR2')
+            with open(photo + '.xmp', 'w') as xmp:
+                xmp.write('darktable')
+            self.assertEqual(self.mod.create_sidecar(photo), photo + '.xmp')
+            with open(photo + '.xmp') as xmp:
+                self.assertEqual(xmp.read(), 'darktable')
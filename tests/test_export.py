@@ -0,0 +1,120 @@
+"""Test the classes and functions defined by gg/export.py"""
+
+import json
+from io import StringIO
+from collections import namedtuple
+from tempfile import TemporaryDirectory
+from xml.dom.minidom import parseString
+from os.path import join
+
+from gg.filetypes import sniff
+from tests import BaseTestCase
+
+
+Fix = namedtuple('Fix', 'filename timestamp lat lon ele names timezone')
+
+PLACED = Fix('/dcim/IMG_1.JPG', 1287259751, 53.52263, -113.448979, 671.666,
+             ('Edmonton', 'Alberta', 'Canada'), 'America/Edmonton')
+UNPLACED = Fix('/dcim/A & B.JPG', 0, 0.0, 0.0, 0.0, (None, None, None), '')
+
+
+class ExportTestCase(BaseTestCase):
+    filename = 'export'
+
+    def export(self, kind, fixes=(PLACED, UNPLACED)):
+        """Export some photos, returning the text of the file."""
+        out = StringIO()
+        self.mod.write_export(iter(fixes), out, kind)
+        return out.getvalue()
+
+    def test_export_format(self):
+        """Ensure formats are chosen by file extension."""
+        self.assertEqual(self.mod.export_format('a/b.GPX'), 'GPX')
+        self.assertEqual(self.mod.export_format('b.json'), 'GeoJSON')
+        with self.assertRaises(ValueError):
+            self.mod.export_format('b.txt')
+
+    def test_geojson(self):
+        """Ensure GeoJSON has a feature for every photo."""
+        collection = json.loads(self.export('GeoJSON'))
+        self.assertEqual(collection['type'], 'FeatureCollection')
+        placed, unplaced = collection['features']
+        self.assertEqual(placed['geometry']['coordinates'],
+                         [-113.448979, 53.52263, 671.7])
+        self.assertEqual(placed['properties'], {
+            'filename': '/dcim/IMG_1.JPG',
+            'timestamp': '2010-10-16T20:09:11Z',
+            'city': 'Edmonton',
+            'state': 'Alberta',
+            'country': 'Canada',
+            'timezone': 'America/Edmonton',
+        })
+        self.assertIsNone(unplaced['geometry'])
+        self.assertIsNone(unplaced['properties']['timezone'])
+
+    def test_geojson_empty(self):
+        """Ensure exporting nothing is still valid GeoJSON."""
+        self.assertEqual(json.loads(self.export('GeoJSON', [])),
+                         {'type': 'FeatureCollection', 'features': []})
+
+    def test_kml(self):
+        """Ensure KML has a placemark for every photo."""
+        doc = parseString(self.export('KML'))
+        placed, unplaced = doc.getElementsByTagName('Placemark')
+
+        def text(node, tag):
+            return node.getElementsByTagName(tag)[0].firstChild.data
+
+        self.assertEqual(text(placed, 'name'), 'IMG_1.JPG')
+        self.assertEqual(text(placed, 'description'),
+                         'Edmonton, Alberta, Canada')
+        self.assertEqual(text(placed, 'when'), '2010-10-16T20:09:11Z')
+        self.assertEqual(text(placed, 'coordinates'),
+                         '-113.448979,53.522630,671.7')
+        self.assertEqual(text(unplaced, 'name'), 'A & B.JPG')
+        self.assertEqual(unplaced.getElementsByTagName('Point'), [])
+
+    def test_gpx(self):
+        """Ensure GPX has a waypoint for every placed photo."""
+        text = self.export('GPX')
+        wpt, = parseString(text).getElementsByTagName('wpt')
+        self.assertEqual(wpt.getAttribute('lat'), '53.522630')
+        self.assertEqual(wpt.getAttribute('lon'), '-113.448979')
+        self.assertIn('<ele>671.7</ele><time>2010-10-16T20:09:11Z</time>'
+                      '<name>IMG_1.JPG</name>', text)
+
+    def test_gpx_readable(self):
+        """Ensure exported waypoints are in a file we can sniff."""
+        with TemporaryDirectory() as tmp:
+            filename = join(tmp, 'photos.gpx')
+            self.mod.export([PLACED], filename)
+            self.assertEqual(sniff(filename), 'GPX')
+
+    def test_csv(self):
+        """Ensure CSV has a row for every photo."""
+        self.assertEqual(
+            self.export('CSV').splitlines(),
+            ['filename,timestamp,latitude,longitude,altitude,city,state,'
+             'country,timezone',
+             '/dcim/IMG_1.JPG,2010-10-16T20:09:11Z,53.522630,-113.448979,'
+             '671.7,Edmonton,Alberta,Canada,America/Edmonton',
+             '/dcim/A & B.JPG,1970-01-01T00:00:00Z,,,,,,,'])
+
+    def test_chunks(self):
+        """Ensure records are written a few at a time, as they're made."""
+        self.mod.EXPORT_CHUNK = 4
+        consumed = []
+
+        def fixes():
+            for i in range(10):
+                consumed.append(i)
+                yield PLACED._replace(filename=str(i))
+
+        class Stream:
+            writes = []
+
+            def write(self, text):
+                self.writes.append((len(consumed), text.count('\n')))
+
+        self.mod.write_export(fixes(), Stream(), 'CSV')
+        self.assertEqual(Stream.writes, [(3, 4), (7, 4), (10, 3)])
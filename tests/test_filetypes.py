@@ -0,0 +1,92 @@
+"""Test the classes and functions defined by gg/filetypes.py"""
+
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+from os import makedirs, symlink
+from os.path import join
+
+from tests import BaseTestCase
+
+
+class FiletypesTestCase(BaseTestCase):
+    filename = 'filetypes'
+
+    def test_sniff_tracks(self):
+        """Ensure we recognize every kind of track file by its contents."""
+        for name, kind in (('minimal.gpx', 'GPX'),
+                           ('sample.tcx', 'TCX'),
+                           ('normal.kml', 'KML'),
+                           ('mytracks.csv', 'CSV')):
+            self.assertEqual(self.mod.sniff(join(self.data_dir, name)), kind)
+
+    def test_sniff_photos(self):
+        """Ensure we recognize photos by their magic bytes."""
+        for data, kind in ((b'\xff\xd8\xff\xe1', 'JPEG'),
+                           (b'MM\0*\0\0\0\x08', 'TIFF'),
+                           (b'II*\0\x10\0\0\0CR\x02\0', 'RAW'),
+                           (b'\0\0\0\x18ftypcrx ', 'RAW'),
+                           (b'\0\0\0\x18ftypheic', 'HEIF')):
+            self.assertEqual(self.mod.sniff_bytes(data), kind)
+
+    def test_sniff_misleading_extension(self):
+        """Ensure the contents win over the filename."""
+        with NamedTemporaryFile(suffix='.jpg') as track:
+            track.write(b'<?xml version="1.0"?>\n'
+                        b'<!DOCTYPE kml>\n<kml xmlns="x"></kml>')
+            track.flush()
+            self.assertEqual(self.mod.sniff(track.name), 'KML')
+
+    def test_sniff_utf16(self):
+        """Ensure we can find the root element of UTF-16 XML."""
+        data = '﻿<?xml version="1.0"?><gpx/>'.encode('utf-16-le')
+        self.assertEqual(self.mod.sniff_bytes(data), 'GPX')
+
+    def test_sniff_csv_extension(self):
+        """Ensure CSV files without the usual headers are still CSV."""
+        self.assertEqual(self.mod.sniff_bytes(b'a,b,c', 'track.CSV'), 'CSV')
+        self.assertEqual(self.mod.sniff_bytes(b'a,b,c', 'notes.txt'), 'TEXT')
+
+    def test_sniff_missing(self):
+        """Ensure unreadable files raise OSError."""
+        with self.assertRaises(OSError):
+            self.mod.sniff('/nonexistent/file.gpx')
+
+    def test_walk_files(self):
+        """Ensure we only find files that look importable, in order."""
+        with TemporaryDirectory() as tmp:
+            makedirs(join(tmp, 'DCIM', '100CANON'))
+            makedirs(join(tmp, '.thumbnails'))
+            for name, size in (('DCIM/100CANON/IMG_2.JPG', 500),
+                               ('DCIM/100CANON/IMG_1.CR2', 500),
+                               ('DCIM/100CANON/IMG_3.JPG', 0),
+                               ('DCIM/notes.txt', 500),
+                               ('.thumbnails/IMG_1.png', 500),
+                               ('track.gpx', 500)):
+                with open(join(tmp, name), 'wb') as data:
+                    data.write(bytes(size))
+            symlink(tmp, join(tmp, 'DCIM', 'loop'))
+            self.assertEqual(
+                list(self.mod.walk_files([tmp, 'explicit.txt'])),
+                [join(tmp, 'track.gpx'),
+                 join(tmp, 'DCIM', '100CANON', 'IMG_1.CR2'),
+                 join(tmp, 'DCIM', '100CANON', 'IMG_2.JPG'),
+                 'explicit.txt'])
+
+    def test_walk_files_lazy(self):
+        """Ensure subfolders are only read once the files before are used."""
+        with TemporaryDirectory() as tmp:
+            makedirs(join(tmp, 'sub'))
+            for name in ('a.gpx', 'sub/b.gpx'):
+                with open(join(tmp, name), 'wb') as data:
+                    data.write(bytes(200))
+            walk = self.mod.walk_files([tmp])
+            self.assertEqual(next(walk), join(tmp, 'a.gpx'))
+            with open(join(tmp, 'sub', 'c.gpx'), 'wb') as data:
+                data.write(bytes(200))
+            self.assertEqual(list(walk), [join(tmp, 'sub', 'b.gpx'),
+                                          join(tmp, 'sub', 'c.gpx')])
+
+    def test_walk_files_missing(self):
+        """Ensure missing paths are passed along to be reported as invalid."""
+        self.assertEqual(
+            list(self.mod.walk_files(['/nonexistent/folder', 'a.jpg'])),
+            ['/nonexistent/folder', 'a.jpg'])
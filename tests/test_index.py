@@ -0,0 +1,104 @@
+"""Test the classes and functions defined by gg/index.py"""
+
+from tempfile import TemporaryDirectory
+from shutil import copy
+from os.path import join
+from os import utime
+import sqlite3
+
+from tests import BaseTestCase
+
+
+class IndexTestCase(BaseTestCase):
+    filename = 'index'
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = TemporaryDirectory()
+        self.db = join(self.tmp.name, 'cache', 'metadata.sqlite')
+        self.photo = join(self.tmp.name, 'IMG_1.JPG')
+        with open(self.photo, 'wb') as photo:
+            photo.write(b'\xff\xd8')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_disabled(self):
+        """Ensure the index does nothing until it has been opened."""
+        index = self.mod.MetadataIndex()
+        index.put(self.photo, 'sig', [1])
+        self.assertIsNone(index.get(self.photo, 'sig'))
+        index.commit()
+        index.close()
+
+    def test_persistence(self):
+        """Ensure stored metadata survives being closed and reopened."""
+        index = self.mod.MetadataIndex()
+        index.open(self.db)
+        index.put(self.photo, 'sig', [None, [1.5, 2, 3], {'Make': 'Canon'}])
+        index.close()
+        index = self.mod.MetadataIndex()
+        index.open(self.db)
+        self.assertEqual(
+            index.get(self.photo, 'sig'),
+            [None, [1.5, 2, 3], {'Make': 'Canon'}])
+        self.assertIsNone(index.get(self.photo, 'other'))
+        index.close()
+
+    def test_schema_version(self):
+        """Ensure an index from an older version is started over."""
+        index = self.mod.MetadataIndex()
+        index.open(self.db)
+        index.put(self.photo, 'sig', [1])
+        index.close()
+        self.mod.SCHEMA_VERSION += 1
+        index.open(self.db)
+        self.assertIsNone(index.get(self.photo, 'sig'))
+        index.close()
+
+    def test_open_failure(self):
+        """Ensure an unusable index is simply disabled."""
+        index = self.mod.MetadataIndex()
+        index.open(join(self.photo, 'impossible.sqlite'))
+        self.assertIsNone(index.db)
+
+    def test_commit_batches(self):
+        """Ensure rows are committed in batches."""
+        self.mod.COMMIT_EVERY = 2
+        index = self.mod.MetadataIndex()
+        index.open(self.db)
+        index.put('a', 'sig', 1)
+        self.assertEqual(index.pending, 1)
+        index.put('b', 'sig', 2)
+        self.assertEqual(index.pending, 0)
+        other = sqlite3.connect(self.db)
+        self.assertEqual(
+            other.execute('SELECT count(*) FROM photos').fetchone(), (2,))
+        other.close()
+        index.close()
+
+    def test_signature(self):
+        """Ensure the signature changes when the photo or sidecar change."""
+        signature = self.mod.MetadataIndex.signature
+        original = signature(self.photo)
+        self.assertEqual(signature(self.photo), original)
+        utime(self.photo, (1, 1))
+        touched = signature(self.photo)
+        self.assertNotEqual(touched, original)
+        with open(join(self.tmp.name, 'IMG_1.xmp'), 'w') as sidecar:
+            sidecar.write('<x:xmpmeta/>')
+        self.assertNotEqual(signature(self.photo), touched)
+
+    def test_signature_pair(self):
+        """Ensure RAW+JPEG pairs aren't tied to the same sidecar."""
+        signature = self.mod.MetadataIndex.signature
+        copy(self.photo, join(self.tmp.name, 'IMG_1.CR2'))
+        original = signature(self.photo)
+        with open(join(self.tmp.name, 'IMG_1.xmp'), 'w') as sidecar:
+            sidecar.write('<x:xmpmeta/>')
+        self.assertEqual(signature(self.photo), original)
+
+    def test_signature_missing(self):
+        """Ensure missing files raise OSError."""
+        with self.assertRaises(OSError):
+            self.mod.MetadataIndex.signature(join(self.tmp.name, 'nope.jpg'))
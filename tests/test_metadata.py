@@ -0,0 +1,177 @@
+"""Test the classes and functions defined by gg/metadata.py"""
+
+import sys
+from time import struct_time
+from mock import Mock, call
+
+from gg.exif import ExifHeader
+from tests import BaseTestCase
+
+
+class GError(Exception):
+    pass
+
+
+class MetadataTestCase(BaseTestCase):
+    filename = 'metadata'
+
+    def setUp(self):
+        super().setUp()
+        # Other modules import gg.metadata, so they mustn't see these mocks.
+        self.addCleanup(sys.modules.pop, 'gg.metadata', None)
+        self.mod.metadata_index = Mock()
+        self.mod.metadata_index.get.return_value = None
+
+    def test_quantize(self):
+        """Ensure tiny differences in location are ignored."""
+        location = (10.000001, 14.999999, 20.01)
+        self.assertEqual(
+            self.mod.quantize(location, ('Here', None, None)),
+            ((10.0, 15.0, 20.0), ('Here', '', '')))
+
+    def test_read_metadata(self):
+        """Ensure we can parse the EXIF data we care about."""
+        self.mod.read_header = Mock(side_effect=ValueError)
+        m = self.mod.GExiv2.Metadata
+        m.return_value.get.return_value = '2015:01:03 12:13:14'
+        m.return_value.__getitem__ = Mock(return_value='hi')
+        m.return_value.get_gps_info.return_value = (3, 5, 8)
+        meta = self.mod.read_metadata('hello.jpg')
+        self.mod.read_header.assert_called_once_with('hello.jpg')
+        m.assert_called_once_with('hello.jpg')
+        self.assertEqual(meta.exif, m.return_value)
+        self.assertEqual(
+            meta.orig_time, struct_time([2015, 1, 3, 12, 13, 14, 5, 3, -1]))
+        self.assertEqual(meta.gps, (3, 5, 8))
+        self.assertEqual(meta.names, ('hi', 'hi', 'hi'))
+        self.assertEqual(
+            meta.camera_info,
+            dict(Make='hi', BodySerialNumber='hi',
+                 CameraSerialNumber='hi', Model='hi'))
+
+    def test_read_metadata_indexed(self):
+        """Ensure unchanged photos aren't opened again."""
+        self.mod.parse_metadata = Mock()
+        index = self.mod.metadata_index
+        index.get.return_value = [
+            [2010, 10, 16, 14, 12, 28, 5, 289, -1], [1, 2, 3],
+            ['Here', None, None], dict(Make='Canon')]
+        meta = self.mod.read_metadata('IMG_2411.JPG')
+        index.signature.assert_called_once_with('IMG_2411.JPG')
+        index.get.assert_called_once_with(
+            'IMG_2411.JPG', index.signature.return_value)
+        self.assertEqual(self.mod.parse_metadata.mock_calls, [])
+        self.assertEqual(self.mod.GExiv2.Metadata.mock_calls, [])
+        self.assertEqual(
+            meta, (None, struct_time([2010, 10, 16, 14, 12, 28, 5, 289, -1]),
+                   (1, 2, 3), ('Here', None, None), dict(Make='Canon')))
+
+    def test_read_metadata_index_miss(self):
+        """Ensure newly read photos are added to the index."""
+        index = self.mod.metadata_index
+        meta = self.mod.read_metadata(self.demo_dir + '/IMG_2411.JPG')
+        index.put.assert_called_once_with(
+            self.demo_dir + '/IMG_2411.JPG', index.signature.return_value,
+            [list(meta.orig_time), meta.gps, meta.names, meta.camera_info])
+
+    def test_read_metadata_header(self):
+        """Ensure we don't open GExiv2 for JPEGs."""
+        meta = self.mod.read_metadata(self.demo_dir + '/IMG_2411.JPG')
+        self.assertEqual(self.mod.GExiv2.Metadata.mock_calls, [])
+        self.assertIsNone(meta.exif)
+        self.assertEqual(meta.orig_time,
+                         struct_time([2010, 10, 16, 14, 12, 28, 5, 289, -1]))
+        self.assertEqual(meta.gps, (0.0, 0.0, 0.0))
+        self.assertEqual(meta.names, (None, None, None))
+        self.assertEqual(
+            meta.camera_info,
+            dict(Make='Canon', Model='Canon PowerShot A590 IS'))
+
+    def test_read_metadata_missing(self):
+        """Ensure we can read photos that are missing EXIF tags."""
+        self.mod.read_header = Mock(side_effect=ValueError)
+        m = self.mod.GExiv2.Metadata
+        m.return_value.get.return_value = None
+        m.return_value.__getitem__ = Mock(side_effect=KeyError)
+        meta = self.mod.read_metadata('hello.jpg')
+        self.assertIsNone(meta.orig_time)
+        self.assertEqual(meta.camera_info, dict(Make='', Model=''))
+
+    def test_read_metadata_invalid(self):
+        """Ensure we raise OSError for files that aren't photos."""
+        self.mod.read_header = Mock(side_effect=ValueError)
+        self.mod.GExiv2.Metadata.side_effect = self.mod.GObject.GError = GError
+        with self.assertRaisesRegexp(OSError, 'Not a photo.'):
+            self.mod.read_metadata('track.gpx')
+
+    def test_save_metadata_sidecar(self):
+        """Ensure we can save locations without touching the photo."""
+        self.mod.create_sidecar = Mock(return_value='gamma.xmp')
+        self.mod.stat = Mock()
+        self.mod.utime = Mock()
+        self.mod.GExiv2.Metadata.return_value = xmp = Mock(__setitem__=Mock())
+        self.assertEqual(
+            self.mod.save_metadata(
+                'gamma.jpg', 'exif', (1, 2, 3), ('A', 'B', 'C'), True),
+            'exif')
+        self.mod.create_sidecar.assert_called_once_with('gamma.jpg')
+        self.mod.GExiv2.Metadata.assert_called_once_with('gamma.xmp')
+        xmp.set_gps_info.assert_called_once_with(1, 2, 3)
+        xmp.__setitem__.assert_any_call('Iptc.Application2.City', 'A')
+        xmp.save_file.assert_called_once_with()
+        self.assertEqual(self.mod.stat.mock_calls, [])
+        self.assertEqual(self.mod.utime.mock_calls, [])
+
+    def test_read_metadata_sidecar(self):
+        """Ensure locations in sidecars take precedence."""
+        self.mod.find_sidecar = Mock(return_value='IMG_2411.xmp')
+        xmp = self.mod.GExiv2.Metadata.return_value
+        xmp.get_gps_info.return_value = (-123.25, 49.5, 10)
+        xmp.__getitem__ = Mock(side_effect=KeyError)
+        meta = self.mod.read_metadata(self.demo_dir + '/IMG_2411.JPG')
+        self.mod.GExiv2.Metadata.assert_called_once_with('IMG_2411.xmp')
+        self.assertIsNone(meta.exif)
+        self.assertEqual(meta.gps, (-123.25, 49.5, 10))
+        self.assertEqual(meta.names, (None, None, None))
+
+    def test_read_metadata_sidecar_empty(self):
+        """Ensure sidecars without locations don't erase the photo's."""
+        header = ExifHeader()
+        header.gps = (1, 2, 3)
+        self.mod.read_header = Mock(return_value=header)
+        self.mod.find_sidecar = Mock(return_value='IMG_2411.xmp')
+        xmp = self.mod.GExiv2.Metadata.return_value
+        xmp.get_gps_info.return_value = (0.0, 0.0, 0.0)
+        meta = self.mod.read_metadata('IMG_2411.JPG')
+        self.assertEqual(meta.gps, (1, 2, 3))
+
+    def test_save_metadata(self):
+        """Ensure we can write locations to photos, preserving the mtime."""
+        self.mod.stat = Mock(return_value=Mock(st_atime=5432, st_mtime=9876))
+        self.mod.utime = Mock()
+        exif = Mock(__setitem__=Mock())
+        self.assertEqual(
+            self.mod.save_metadata('gamma.jpg', exif, (10, 15, 20),
+                                   ('Here', 'There', 'Everywhere')),
+            exif)
+        self.mod.stat.assert_called_once_with('gamma.jpg')
+        exif.set_gps_info.assert_called_once_with(10, 15, 20)
+        self.assertEqual(
+            exif.__setitem__.mock_calls,
+            [call('Iptc.Application2.City', 'Here'),
+             call('Iptc.Application2.ProvinceState', 'There'),
+             call('Iptc.Application2.CountryName', 'Everywhere'),
+             call('Iptc.Envelope.CharacterSet', '\x1b%G')])
+        exif.save_file.assert_called_once_with()
+        self.mod.utime.assert_called_once_with('gamma.jpg', (5432, 9876))
+
+    def test_save_metadata_unopened(self):
+        """Ensure we open GExiv2 when saving photos read from the header."""
+        self.mod.stat = Mock()
+        self.mod.utime = Mock()
+        self.mod.GExiv2.Metadata.return_value = Mock(__setitem__=Mock())
+        exif = self.mod.save_metadata(
+            'gamma.jpg', None, (10, 15, 20), (None, None, None))
+        self.mod.GExiv2.Metadata.assert_called_once_with('gamma.jpg')
+        self.assertEqual(exif, self.mod.GExiv2.Metadata.return_value)
+        exif.save_file.assert_called_once_with()
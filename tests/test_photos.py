@@ -1,8 +1,10 @@
 """Test the classes and functions defined by gg/photos.py"""
 
+from collections import namedtuple
 from time import struct_time
 from mock import Mock, call
 
+from gg.correlate import Timeline
 from tests import BaseTestCase
 
 
@@ -17,6 +19,9 @@ class GError(Exception):
     pass
 
 
+Metadata = namedtuple('Metadata', 'exif orig_time gps names camera_info')
+
+
 class PhotosTestCase(BaseTestCase):
     filename = 'photos'
 
@@ -24,15 +29,24 @@ class PhotosTestCase(BaseTestCase):
         super().setUp()
         self.mod.TrackFile = Mock()
         self.mod.Widgets = Mock()
+        self.mod.load_thumbnail = Mock(return_value=None)
+        self.mod.save_thumbnail = Mock()
+        self.mod.scale_to_fit = Mock(side_effect=lambda thumb, size: thumb)
+        self.mod.get_placeholder = Mock()
+        self.mod.thumbnail_queue = Mock()
+        self.mod.resize_queue = Mock()
+        self.mod.thumbnail_memory = Mock()
+        self.mod.large_previews = Mock()
+        self.mod.large_previews.get.return_value = None
+        self.mod.preview_queue = Mock()
 
     def test_auto_timestamp_comparison_exact(self):
         """Ensure we can find exact matches in GPX/EXIF data."""
-        self.mod.points = {
+        self.mod.timeline = Timeline({
             1: point(0, 0, 0),
             2: point(1, 1, 1),
             3: point(2, 2, 2),
-        }
-        self.mod.TrackFile.range = [1, 3]
+        })
         photo = Mock()
         photo.manual = False
         photo.timestamp = 3
@@ -41,11 +55,10 @@ class PhotosTestCase(BaseTestCase):
 
     def test_auto_timestamp_comparison_interpolate(self):
         """Ensure we can interpolate GPX data (easy numbers)."""
-        self.mod.points = {
+        self.mod.timeline = Timeline({
             1: point(0, 0, 0),
             4: point(1, 10, 100),
-        }
-        self.mod.TrackFile.range = [1, 4]
+        })
         photo = Mock()
         photo.manual = False
         photo.timestamp = 3
@@ -57,11 +70,10 @@ class PhotosTestCase(BaseTestCase):
 
     def test_auto_timestamp_comparison_interpolate_2(self):
         """Ensure we can interpolate GPX data (realistic timestamps)."""
-        self.mod.points = {
+        self.mod.timeline = Timeline({
             1420254516: point(0, 0, 0),
             1420254518: point(100, 50, 800),
-        }
-        self.mod.TrackFile.range = [1420254516, 1420254518]
+        })
         photo = Mock()
         photo.manual = False
         photo.timestamp = 1420254517
@@ -70,7 +82,10 @@ class PhotosTestCase(BaseTestCase):
 
     def test_auto_timestamp_comparison_manual(self):
         """Ensure we don't clobber manually-set EXIF data."""
-        self.mod.TrackFile.range = [1, 4]
+        self.mod.timeline = Timeline({
+            1: point(0, 0, 0),
+            4: point(1, 10, 100),
+        })
         photo = Mock()
         photo.manual = True
         photo.timestamp = 3
@@ -80,16 +95,42 @@ class PhotosTestCase(BaseTestCase):
     def test_fetch_thumbnail(self, orient=1, pixbuf=None, args=None):
         """Ensure we can load thumbnails from photos."""
         new = self.mod.GdkPixbuf.Pixbuf.new_from_file_at_size
-        new_args = ['foo.jpg', 100, 100]
+        new_args = ['foo.jpg', 128, 128]
         pixbuf = pixbuf or new
         args = [new.return_value] + args if args else new_args
         self.mod.GExiv2.Metadata.return_value.__getitem__ = Mock(
             return_value=orient)
+        self.mod.GExiv2.Metadata.return_value\
+            .get_preview_properties.return_value = []
         thumb = self.mod.fetch_thumbnail('foo.jpg', size=100)
+        self.mod.load_thumbnail.assert_called_once_with('foo.jpg', 100)
         self.mod.GExiv2.Metadata.assert_called_once_with('foo.jpg')
         new.assert_called_once_with(*new_args)
         self.assertEqual(thumb, pixbuf.return_value)
         pixbuf.assert_called_once_with(*args)
+        self.mod.save_thumbnail.assert_called_once_with(
+            'foo.jpg', thumb, 'normal')
+        self.mod.scale_to_fit.assert_called_once_with(thumb, 100)
+
+    def test_fetch_thumbnail_cached(self):
+        """Ensure we don't decode anything when the thumbnail is cached."""
+        self.mod.load_thumbnail.return_value = 'cached'
+        self.assertEqual(self.mod.fetch_thumbnail('foo.jpg', 100), 'cached')
+        self.assertEqual(self.mod.GExiv2.Metadata.mock_calls, [])
+        self.assertEqual(
+            self.mod.GdkPixbuf.Pixbuf.new_from_file_at_size.mock_calls, [])
+        self.assertEqual(self.mod.save_thumbnail.mock_calls, [])
+
+    def test_fetch_thumbnail_huge(self):
+        """Ensure we don't cache thumbnails bigger than the standard sizes."""
+        self.mod.GExiv2.Metadata.return_value.__getitem__ = Mock(
+            return_value=1)
+        self.mod.GExiv2.Metadata.return_value\
+            .get_preview_properties.return_value = []
+        self.mod.fetch_thumbnail('foo.jpg', 2000)
+        self.mod.GdkPixbuf.Pixbuf.new_from_file_at_size\
+            .assert_called_once_with('foo.jpg', 2000, 2000)
+        self.assertEqual(self.mod.save_thumbnail.mock_calls, [])
 
     def test_fetch_thumbnail_orient_2(self):
         """Ensure we can rotate EXIF correctly (orientation 2)."""
@@ -133,43 +174,234 @@ class PhotosTestCase(BaseTestCase):
             self.mod.fetch_thumbnail('foo.jpg', size=100)
 
     def test_fetch_thumbnail_gerror2(self):
-        """Ensure we can handle missing thumbnails in the second attempt."""
+        """Ensure we can handle photos without previews that can't decode."""
         m = self.mod.GExiv2.Metadata.return_value
         m.__getitem__ = Mock(return_value=1)
-        m.get_preview_properties.return_value.__getitem__ = Mock()
-        m.get_preview_image.side_effect = GError
+        m.get_preview_properties.return_value = []
         self.mod.GdkPixbuf.Pixbuf.new_from_file_at_size.side_effect = GError
         self.mod.GObject.GError = GError
         with self.assertRaisesRegexp(OSError, 'No thumbnail found.'):
             self.mod.fetch_thumbnail('foo.jpg', size=100)
 
-    def test_fetch_thumbnail_gerror3(self):
-        """Ensure we can handle the third potential thubnail failure."""
+    def test_fetch_thumbnail_raw(self):
+        """Ensure undecodable photos fall back on their small previews."""
         m = self.mod.GExiv2.Metadata.return_value
         m.__getitem__ = Mock(return_value=1)
-        m.get_preview_properties.return_value.__getitem__ = Mock()
+        m.get_preview_properties.return_value = [
+            Mock(get_width=Mock(return_value=160),
+                 get_height=Mock(return_value=120))]
         self.mod.GdkPixbuf.Pixbuf.new_from_file_at_size.side_effect = GError
         self.mod.GObject.GError = GError
-        thumb = self.mod.fetch_thumbnail('foo.jpg', size=100)
+        thumb = self.mod.fetch_thumbnail('foo.cr2', size=200)
         stream = self.mod.GdkPixbuf.Pixbuf.new_from_stream_at_scale
+        stream.assert_called_once_with(
+            self.mod.Gio.MemoryInputStream.new_from_data.return_value,
+            160, 160, True, None)
         self.assertEqual(thumb, stream.return_value)
+        self.mod.save_thumbnail.assert_called_once_with(
+            'foo.cr2', thumb, 'large')
+
+    def test_fetch_thumbnail_preview(self):
+        """Ensure we prefer embedded previews over decoding the whole photo."""
+        m = self.mod.GExiv2.Metadata.return_value
+        m.__getitem__ = Mock(return_value=6)
+        self.mod.fetch_preview = Mock()
+        thumb = self.mod.fetch_thumbnail('foo.jpg', size=100)
+        self.mod.fetch_preview.assert_called_once_with(m, 128)
+        self.assertEqual(
+            self.mod.GdkPixbuf.Pixbuf.new_from_file_at_size.mock_calls, [])
+        rotate = self.mod.GdkPixbuf.Pixbuf.rotate_simple
+        rotate.assert_called_once_with(
+            self.mod.fetch_preview.return_value,
+            self.mod.GdkPixbuf.PixbufRotation.CLOCKWISE)
+        self.assertEqual(thumb, rotate.return_value)
+
+    def test_fetch_thumbnail_preview_gerror(self):
+        """Ensure we decode the whole photo if the preview is corrupt."""
+        self.mod.GExiv2.Metadata.return_value.__getitem__ = Mock(
+            return_value=1)
+        self.mod.fetch_preview = Mock(side_effect=GError)
+        self.mod.GObject.GError = GError
+        thumb = self.mod.fetch_thumbnail('foo.jpg', size=100)
+        new = self.mod.GdkPixbuf.Pixbuf.new_from_file_at_size
+        new.assert_called_once_with('foo.jpg', 128, 128)
+        self.assertEqual(thumb, new.return_value)
+
+    def test_fetch_preview(self):
+        """Ensure we pick the smallest preview that is big enough."""
+        exif = Mock()
+        exif.get_preview_properties.return_value = [
+            Mock(get_width=Mock(return_value=w),
+                 get_height=Mock(return_value=h))
+            for w, h in ((160, 120), (1620, 1080), (640, 480), (120, 160))]
+        preview = self.mod.fetch_preview(exif, 128)
+        stream = self.mod.GdkPixbuf.Pixbuf.new_from_stream_at_scale
+        self.assertEqual(preview, stream.return_value)
+        picked = exif.get_preview_image.mock_calls[0][1][0]
+        self.assertEqual((picked.get_width(), picked.get_height()), (160, 120))
+        self.mod.Gio.MemoryInputStream.new_from_data.assert_called_once_with(
+            exif.get_preview_image.return_value.get_data.return_value, None)
+        stream.assert_called_once_with(
+            self.mod.Gio.MemoryInputStream.new_from_data.return_value,
+            128, 128, True, None)
+
+    def test_fetch_preview_too_small(self):
+        """Ensure we don't upscale tiny previews."""
+        exif = Mock()
+        exif.get_preview_properties.return_value = [
+            Mock(get_width=Mock(return_value=160),
+                 get_height=Mock(return_value=120))]
+        self.assertIsNone(self.mod.fetch_preview(exif, 256))
+        self.assertEqual(exif.get_preview_image.mock_calls, [])
+
+    def test_fetch_preview_smaller(self):
+        """Ensure tiny previews can be used if there's nothing better."""
+        exif = Mock()
+        exif.get_preview_properties.return_value = [
+            Mock(get_width=Mock(return_value=w),
+                 get_height=Mock(return_value=h))
+            for w, h in ((160, 120), (120, 90))]
+        preview = self.mod.fetch_preview(exif, 256, smaller=True)
+        stream = self.mod.GdkPixbuf.Pixbuf.new_from_stream_at_scale
+        self.assertEqual(preview, stream.return_value)
+        picked = exif.get_preview_image.mock_calls[0][1][0]
+        self.assertEqual(picked.get_width(), 160)
         stream.assert_called_once_with(
             self.mod.Gio.MemoryInputStream.new_from_data.return_value,
-            100, 100, True, None)
+            160, 160, True, None)
+
+    def test_fetch_preview_none(self):
+        """Ensure we can't fall back on previews that don't exist."""
+        exif = Mock()
+        exif.get_preview_properties.return_value = []
+        self.assertIsNone(self.mod.fetch_preview(exif, 256, smaller=True))
+
+    def test_fetch_pyramid(self):
+        """Ensure we keep the standard sized thumbnail around for later."""
+        self.mod.fetch_thumbnail = Mock()
+        source, thumb = self.mod.fetch_pyramid('foo.jpg', 100)
+        self.mod.fetch_thumbnail.assert_called_once_with('foo.jpg', 128)
+        self.assertEqual(source, self.mod.fetch_thumbnail.return_value)
+        self.mod.scale_to_fit.assert_called_once_with(source, 100)
+        self.assertEqual(
+            self.mod.rescale_pyramid(source, 50), (source, source))
+
+    def test_swap_thumbnail(self):
+        """Ensure decoded thumbnails replace the placeholders."""
+        photo = Mock()
+        self.mod.evict_thumbnails = Mock()
+        self.mod.swap_thumbnail(photo, ('source', 'thumb'))
+        self.assertEqual(photo.source, 'source')
+        self.assertEqual(photo.thumb, 'thumb')
+        self.mod.Widgets.loaded_photos.set_value.assert_called_once_with(
+            photo.iter, 2, 'thumb')
+        self.mod.thumbnail_memory.add.assert_called_once_with(
+            photo, 'source', 'thumb')
+        self.mod.evict_thumbnails.assert_called_once_with()
+
+    def test_swap_thumbnail_unlisted(self):
+        """Ensure thumbnails can arrive before the photo is listed."""
+        photo = Mock(iter=None)
+        self.mod.evict_thumbnails = Mock()
+        self.mod.swap_thumbnail(photo, ('source', 'thumb'))
+        self.assertEqual(photo.thumb, 'thumb')
+        self.assertEqual(self.mod.Widgets.loaded_photos.mock_calls, [])
+
+    def test_evict_thumbnails(self):
+        """Ensure evicted photos go back to showing a placeholder."""
+        self.mod.Gst = Mock()
+        self.mod.Gst.get_int.side_effect = {
+            'thumbnail-memory': 2, 'thumbnail-size': 100}.get
+        photo = Mock()
+        self.mod.thumbnail_memory.evict.return_value = [photo]
+        self.mod.evict_thumbnails()
+        self.mod.thumbnail_memory.evict.assert_called_once_with(2097152)
+        self.mod.resize_queue.cancel.assert_called_once_with(photo)
+        self.assertIsNone(photo.source)
+        self.mod.get_placeholder.assert_called_once_with(100)
+        self.assertEqual(photo.thumb, self.mod.get_placeholder.return_value)
+        self.mod.Widgets.loaded_photos.set_value.assert_called_once_with(
+            photo.iter, 2, photo.thumb)
+
+    def test_evict_thumbnails_within_budget(self):
+        """Ensure nothing happens while there's memory to spare."""
+        self.mod.Gst = Mock()
+        self.mod.Gst.get_int.return_value = 256
+        self.mod.thumbnail_memory.evict.return_value = []
+        self.mod.evict_thumbnails()
+        self.assertEqual(self.mod.get_placeholder.mock_calls, [])
+
+    def test_load_visible(self):
+        """Ensure visible photos are loaded first, then their neighbours."""
+        self.mod.Gst = Mock()
+        self.mod.Gst.get_int.return_value = 100
+        self.mod.PREFETCH_ROWS = 2
+        self.mod.evict_thumbnails = Mock()
+        view = self.mod.Widgets.photos_view
+        view.get_visible_range.return_value = (
+            Mock(get_indices=Mock(return_value=[3])),
+            Mock(get_indices=Mock(return_value=[4])))
+        model = view.get_model.return_value
+        model.iter_nth_child.side_effect = lambda parent, n: n
+        model.iter_next.side_effect = lambda it: it + 1 if it < 5 else None
+        model.get_value.side_effect = lambda it, col: 'p{}.jpg'.format(it)
+        photos = {i: Mock(source=None, filename='p{}.jpg'.format(i))
+                  for i in range(6)}
+        photos[4].source = 'loaded'
+        self.mod.thumbnail_queue.failed = {photos[1]}
+        self.mod.Photograph.cache.update(
+            {photo.filename: photo for photo in photos.values()})
+        self.mod.thumbnail_queue.requested.side_effect = \
+            lambda photo: 100 if photo is photos[2] else None
+        self.mod.load_visible()
+        model.iter_nth_child.assert_called_once_with(None, 1)
+        order = [photos[i] for i in (3, 4, 2, 5, 1)]
+        self.mod.thumbnail_queue.prioritize.assert_called_once_with(order)
+        self.mod.resize_queue.prioritize.assert_called_once_with(order)
+        self.mod.thumbnail_queue.retain.assert_called_once_with(order)
+        self.assertEqual(
+            self.mod.thumbnail_queue.request.mock_calls,
+            [call(photos[i], photos[i].filename, 100) for i in (3, 5)])
+        self.mod.thumbnail_memory.protect.assert_called_once_with(order)
+        self.mod.evict_thumbnails.assert_called_once_with()
+
+    def test_load_visible_empty(self):
+        """Ensure we don't care if nothing is visible."""
+        self.mod.Widgets.photos_view.get_visible_range.return_value = None
+        self.mod.load_visible()
+        self.assertEqual(self.mod.thumbnail_queue.mock_calls, [])
 
     def test_photograph_resize_all_photos(self):
-        """Ensure we can resize all photos."""
+        """Ensure we can resize all photos without reloading them."""
         gst = Mock()
         gst.get_int.return_value = 150
-        p = Mock()
-        self.mod.Photograph.instances = [p]
+        loaded, pending = Mock(), Mock(source=None)
+        loaded.source.get_width.return_value = 256
+        loaded.source.get_height.return_value = 192
+        self.mod.Photograph.instances = [loaded, pending]
         self.mod.fetch_thumbnail = Mock()
+        self.mod.load_visible = Mock()
         self.mod.Photograph.resize_all_photos(gst, 'size')
         gst.get_int.assert_called_once_with('size')
-        self.assertEqual(p.thumb, self.mod.fetch_thumbnail.return_value)
-        self.mod.fetch_thumbnail.assert_called_once_with(p.filename, 150)
-        self.mod.Widgets.loaded_photos.set_value.assert_called_once_with(
-            p.iter, 2, p.thumb)
+        self.assertEqual(self.mod.fetch_thumbnail.mock_calls, [])
+        self.mod.resize_queue.request.assert_called_once_with(
+            loaded, loaded.source, 150)
+        self.mod.load_visible.assert_called_once_with()
+
+    def test_photograph_resize_all_photos_bigger(self):
+        """Ensure thumbnails are decoded again when they're too small."""
+        gst = Mock()
+        gst.get_int.return_value = 300
+        photo = Mock()
+        photo.source.get_width.return_value = 256
+        photo.source.get_height.return_value = 192
+        self.mod.Photograph.instances = [photo]
+        self.mod.load_visible = Mock()
+        self.mod.Photograph.resize_all_photos(gst, 'size')
+        self.assertIsNone(photo.source)
+        self.mod.resize_queue.cancel.assert_called_once_with(photo)
+        self.assertEqual(self.mod.resize_queue.request.mock_calls, [])
+        self.mod.load_visible.assert_called_once_with()
 
     def test_photograph_load_from_file(self):
         """Ensure we can load photos from files."""
@@ -183,10 +415,12 @@ class PhotosTestCase(BaseTestCase):
         self.mod.CameraView = Mock()
         c.timezone_method = 'lookup'
         self.mod.Widgets = Mock()
+        self.mod.read_metadata = Mock()
         self.assertEqual(load('zing.jpg'), p)
+        self.mod.read_metadata.assert_called_once_with('zing.jpg')
         self.mod.Photograph.assert_called_once_with('zing.jpg')
         self.mod.Label.assert_called_once_with(p)
-        p.read.assert_called_once_with()
+        p.read.assert_called_once_with(self.mod.read_metadata.return_value)
         self.mod.Widgets.empty_camera_list.hide.assert_called_once_with()
         self.mod.Camera.generate_id.assert_called_once_with(p.camera_info)
         self.mod.Camera.assert_called_once_with('Nikon')
@@ -195,18 +429,44 @@ class PhotosTestCase(BaseTestCase):
         p.calculate_timestamp.assert_called_once_with(c.offset)
         self.mod.Widgets.button_sensitivity.assert_called_once_with()
 
+    def test_photograph_load_from_file_invalid(self):
+        """Ensure we reject files that aren't photos before caching them."""
+        self.mod.read_metadata = Mock(
+            side_effect=OSError('track.gpx: Not a photo.'))
+        with self.assertRaisesRegexp(OSError, 'Not a photo.'):
+            self.mod.Photograph.load_from_file('track.gpx')
+        self.assertNotIn('track.gpx', self.mod.Photograph.cache)
+
+    def test_photograph_load_from_file_metadata(self):
+        """Ensure we don't read files again if they were read in advance."""
+        load = self.mod.Photograph.load_from_file
+        self.mod.Photograph = Mock()
+        for name in ('Label', 'Camera', 'CameraView', 'read_metadata'):
+            setattr(self.mod, name, Mock())
+        self.mod.Camera.generate_id.return_value = ('Nikon', 'Nikonos')
+        load('zing.jpg', 'meta')
+        self.assertEqual(self.mod.read_metadata.mock_calls, [])
+        self.mod.Photograph.return_value.read.assert_called_once_with('meta')
+
     def test_photograph_init(self):
         """Ensure we can initialize Photograph object."""
         self.mod.Coordinates.__init__ = Mock()
         self.mod.fetch_thumbnail = Mock()
+        self.mod.Gst = Mock()
+        self.mod.Gst.get_int.return_value = 200
         p = self.mod.Photograph('grill.jpg')
+        self.assertEqual(self.mod.GExiv2.Metadata.mock_calls, [])
         self.mod.Coordinates.__init__.assert_called_once_with(p)
-        self.assertEqual(p.thumb, self.mod.fetch_thumbnail.return_value)
+        self.assertEqual(self.mod.fetch_thumbnail.mock_calls, [])
+        self.mod.get_placeholder.assert_called_once_with(200)
+        self.assertEqual(p.thumb, self.mod.get_placeholder.return_value)
+        self.assertEqual(self.mod.thumbnail_queue.mock_calls, [])
         self.assertEqual(p.filename, 'grill.jpg')
         self.assertEqual(
             p.connect.mock_calls,
             [call('notify::geoname', p.update_liststore_summary),
-             call('notify::positioned', self.mod.Widgets.button_sensitivity)])
+             call('notify::positioned', self.mod.Widgets.button_sensitivity),
+             call('notify::timestamp', self.mod.photo_index.invalidate)])
 
     def test_photograph_str(self):
         """Ensure we can stringify Photograph objects."""
@@ -223,24 +483,25 @@ class PhotosTestCase(BaseTestCase):
         self.mod.modified = Mock()
         self.mod.fetch_thumbnail = Mock()
         self.mod.str = Mock(return_value='hola!')
-        m = self.mod.GExiv2.Metadata
-        m.return_value.get.return_value = '2015:01:03 12:13:14'
-        m.return_value.__getitem__ = Mock(return_value='hi')
-        m.return_value.get_gps_info.return_value = (3, 5, 8)
+        meta = Metadata(
+            'exif', struct_time([2015, 1, 3, 12, 13, 14, 5, 3, -1]),
+            (3, 5, 8), ('Here', None, None), dict(Make='hi'))
+        self.mod.read_metadata = Mock(return_value=meta)
         p = self.mod.Photograph('hello.jpg')
         p.calculate_timestamp = Mock()
         self.assertIsNone(p.exif)
         p.read()
-        self.assertEqual(p.exif, m.return_value)
-        m.assert_called_once_with('hello.jpg')
+        self.mod.read_metadata.assert_called_once_with('hello.jpg')
+        self.assertEqual(p.exif, 'exif')
         self.assertFalse(p.manual)
         self.assertIsNone(p.modified_timeout)
         self.assertEqual(p.names, (None, None, None))
-        self.assertEqual(
-            p.orig_time, struct_time([2015, 1, 3, 12, 13, 14, 5, 3, -1]))
+        self.assertEqual(p.orig_time, meta.orig_time)
         self.assertEqual(p.longitude, 3)
         self.assertEqual(p.latitude, 5)
         self.assertEqual(p.altitude, 8)
+        self.assertEqual(p.orig_gps, (5, 3, 8))
+        self.assertEqual(p.on_disk, ((3, 5, 8), ('Here', '', '')))
         self.mod.modified.discard.assert_called_once_with(p)
         p.calculate_timestamp.assert_called_once_with()
         self.mod.Widgets.loaded_photos.append.assert_called_once_with()
@@ -249,21 +510,30 @@ class PhotosTestCase(BaseTestCase):
         self.mod.Widgets.loaded_photos.set_row.assert_called_once_with(
             p.iter,
             [p.filename, self.mod.str.return_value, p.thumb, p.timestamp])
-        print(p.camera_info)
-        self.assertEqual(
-            p.camera_info,
-            dict(Make='hi', BodySerialNumber='hi',
-                 CameraSerialNumber='hi', Model='hi'))
+        self.assertEqual(p.camera_info, dict(Make='hi'))
+
+    def test_photograph_read_metadata(self):
+        """Ensure we don't read the file again if it was read in advance."""
+        self.mod.fetch_thumbnail = Mock()
+        self.mod.read_metadata = Mock()
+        p = self.mod.Photograph('hello.jpg')
+        p.calculate_timestamp = Mock()
+        p.read(Metadata('exif', None, (1, 2, 3), (None,) * 3, {}))
+        self.assertEqual(self.mod.read_metadata.mock_calls, [])
+        self.assertEqual(p.exif, 'exif')
+        self.assertEqual(p.latitude, 2)
 
     def test_photograph_calculate_timestamp(self, time=1420341828, offset=0):
         """Ensure we can get the timestamp from a photo."""
-        self.mod.mktime = Mock(return_value=time + 0.1)
+        self.mod.photo_timestamp = Mock(return_value=time + offset)
         self.mod.auto_timestamp_comparison = Mock()
         self.mod.fetch_thumbnail = Mock()
         p = self.mod.Photograph('alpha.jpg')
         p.orig_time = 'zap'
+        p.camera = Mock()
         p.calculate_timestamp(offset)
-        self.mod.mktime.assert_called_once_with(p.orig_time)
+        self.mod.photo_timestamp.assert_called_once_with(
+            'alpha.jpg', p.orig_time, offset, p.camera.tzinfo)
         self.mod.auto_timestamp_comparison.assert_called_once_with(p)
         self.assertEqual(p.timestamp, time + offset)
 
@@ -271,46 +541,83 @@ class PhotosTestCase(BaseTestCase):
         """Ensure we can get the timestamp from a photo with a clock offset."""
         self.test_photograph_calculate_timestamp(1420341828, 15)
 
-    def test_photograph_calculate_timestamp_typeerror(self):
-        """Ensure we can handle TypeErrors when calculating timestamps."""
-        self.mod.mktime = Mock(side_effect=TypeError)
-        self.mod.auto_timestamp_comparison = Mock()
-        self.mod.fetch_thumbnail = Mock()
-        self.mod.stat = Mock(return_value=Mock(st_mtime=1234))
-        p = self.mod.Photograph('beta.jpg')
-        p.orig_time = 'zip'
-        p.calculate_timestamp()
-        self.mod.mktime.assert_called_once_with(p.orig_time)
-        self.mod.auto_timestamp_comparison.assert_called_once_with(p)
-        self.assertEqual(p.timestamp, 1234)
-
     def test_photograph_write(self):
         """Ensure we can write photo data to disk."""
         self.mod.modified = Mock()
-        self.mod.stat = Mock(return_value=Mock(st_atime=5432, st_mtime=9876))
         self.mod.fetch_thumbnail = Mock()
-        self.mod.utime = Mock()
+        self.mod.save_metadata = Mock(return_value='exif')
         self.mod.str = Mock()
         p = self.mod.Photograph('gamma.jpg')
-        p.exif = Mock(__setitem__=Mock())
+        p.exif = None
+        p.iter = 'row'
         p.longitude, p.latitude, p.altitude = (10, 15, 20)
         p.names = 'Here There Everywhere'.split()
-        p.write()
-        self.mod.stat.assert_called_once_with('gamma.jpg')
-        p.exif.set_gps_info.assert_called_once_with(
-            p.longitude, p.latitude, p.altitude)
+        self.assertTrue(p.write())
+        self.mod.save_metadata.assert_called_once_with(
+            'gamma.jpg', None, (10, 15, 20), p.names, False)
+        self.assertEqual(p.exif, 'exif')
+        self.mod.modified.discard.assert_called_once_with(p)
+        self.mod.Widgets.loaded_photos.set_value.assert_called_once_with(
+            p.iter, 1, self.mod.str.return_value)
+
+    def test_photograph_prepare_write(self):
+        """Ensure we can snapshot a photo to save it in the background."""
+        self.mod.fetch_thumbnail = Mock()
+        p = self.mod.Photograph('gamma.jpg')
+        p.exif = 'exif'
+        p.longitude, p.latitude, p.altitude = (10, 15, 20)
+        p.names = ('Here', 'There', 'Everywhere')
         self.assertEqual(
-            p.exif.__setitem__.mock_calls,
-            [call('Iptc.Application2.City', 'Here'),
-             call('Iptc.Application2.ProvinceState', 'There'),
-             call('Iptc.Application2.CountryName', 'Everywhere'),
-             call('Iptc.Envelope.CharacterSet', '\x1b%G')])
-        self.mod.utime.assert_called_once_with(
-            'gamma.jpg', (5432, 9876))
+            p.prepare_write(),
+            ('gamma.jpg', 'exif', (10, 15, 20),
+             ('Here', 'There', 'Everywhere'), False))
+
+    def test_photograph_prepare_write_unchanged(self):
+        """Ensure we don't rewrite files that already have this location."""
+        self.mod.modified = Mock()
+        self.mod.fetch_thumbnail = Mock()
+        self.mod.str = Mock()
+        p = self.mod.Photograph('gamma.jpg')
+        p.exif = 'exif'
+        p.on_disk = ((10.0, 15.0, 20.0), ('Here', '', ''))
+        p.longitude, p.latitude, p.altitude = (10.000001, 14.999999, 20.01)
+        p.names = ('Here', None, None)
+        self.assertIsNone(p.prepare_write())
         self.mod.modified.discard.assert_called_once_with(p)
+        self.mod.save_metadata = Mock()
+        self.assertFalse(p.write())
+        self.assertEqual(self.mod.save_metadata.mock_calls, [])
+        p.names = ('There', None, None)
+        self.assertTrue(p.write())
+        self.assertEqual(p.on_disk, ((10.0, 15.0, 20.0), ('There', '', '')))
+
+    def test_photograph_saved_moved(self):
+        """Ensure photos that moved while saving are still modified."""
+        self.mod.modified = Mock()
+        self.mod.fetch_thumbnail = Mock()
+        self.mod.str = Mock()
+        p = self.mod.Photograph('gamma.jpg')
+        p.iter = 'row'
+        p.longitude, p.latitude, p.altitude = (10, 15, 20)
+        p.names = (None, None, None)
+        p.saved('exif', (10, 15, 0), (None, None, None))
+        self.assertEqual(p.exif, 'exif')
+        self.assertEqual(self.mod.modified.discard.mock_calls, [])
         self.mod.Widgets.loaded_photos.set_value.assert_called_once_with(
             p.iter, 1, self.mod.str.return_value)
 
+    def test_photograph_saved_closed(self):
+        """Ensure photos that were closed while saving are left alone."""
+        self.mod.modified = Mock()
+        self.mod.fetch_thumbnail = Mock()
+        p = self.mod.Photograph('gamma.jpg')
+        p.longitude, p.latitude, p.altitude = (10, 15, 20)
+        p.names = (None, None, None)
+        p.saved('exif', (10, 15, 20), (None, None, None))
+        self.mod.modified.discard.assert_called_once_with(p)
+        self.assertEqual(self.mod.Widgets.loaded_photos.set_value.mock_calls,
+                         [])
+
     def test_photograph_disable_auto_position(self):
         """Ensure we mark photos as manual-positioned to preserve locations."""
         self.mod.fetch_thumbnail = Mock()
@@ -337,6 +644,7 @@ class PhotosTestCase(BaseTestCase):
         s.get_height.return_value = 69
         self.mod.fetch_thumbnail = Mock()
         p = self.mod.Photograph('zeta.jpg')
+        p.prefetch_neighbours = Mock()
         self.mod.fetch_thumbnail.reset_mock()
         self.assertEqual(
             p.get_large_preview(), self.mod.fetch_thumbnail.return_value)
@@ -345,6 +653,53 @@ class PhotosTestCase(BaseTestCase):
             p.filename, 33)
         s.get_width.assert_called_once_with()
         s.get_height.assert_called_once_with()
+        self.mod.preview_queue.cancel.assert_called_once_with(p)
+        self.mod.large_previews.add.assert_called_once_with(
+            p, (33, self.mod.fetch_thumbnail.return_value))
+        p.prefetch_neighbours.assert_called_once_with(33)
+
+    def test_photograph_get_large_preview_cached(self):
+        """Ensure we reuse large previews that were prefetched."""
+        s = self.mod.Gdk.Screen.get_default.return_value
+        s.get_width.return_value = s.get_height.return_value = 100
+        self.mod.fetch_thumbnail = Mock()
+        self.mod.large_previews.get.return_value = (80, 'preview')
+        p = self.mod.Photograph('zeta.jpg')
+        p.prefetch_neighbours = Mock()
+        self.assertEqual(p.get_large_preview(), 'preview')
+        self.assertEqual(self.mod.fetch_thumbnail.mock_calls, [])
+        self.mod.large_previews.get.assert_called_once_with(p)
+        p.prefetch_neighbours.assert_called_once_with(80)
+
+    def test_photograph_prefetch_neighbours(self):
+        """Ensure we load the previews on either side of the current photo."""
+        self.mod.fetch_thumbnail = Mock()
+        model = self.mod.Widgets.loaded_photos
+        model.iter_next.return_value = 'next.jpg'
+        model.iter_previous.return_value = 'prev.jpg'
+        model.get_value.side_effect = lambda it, col: it
+        p = self.mod.Photograph('zeta.jpg')
+        p.iter = 'zeta.jpg'
+        nxt = self.mod.Photograph('next.jpg')
+        prev = self.mod.Photograph('prev.jpg')
+        self.mod.large_previews.get.side_effect = {nxt: (80, 'x')}.get
+        p.prefetch_neighbours(80)
+        model.iter_next.assert_called_once_with('zeta.jpg')
+        model.iter_previous.assert_called_once_with('zeta.jpg')
+        self.mod.preview_queue.retain.assert_called_once_with([nxt, prev])
+        self.mod.preview_queue.request.assert_called_once_with(
+            prev, 'prev.jpg', 80)
+
+    def test_photograph_prefetch_neighbours_ends(self):
+        """Ensure we can prefetch from the ends of the photo list."""
+        self.mod.fetch_thumbnail = Mock()
+        model = self.mod.Widgets.loaded_photos
+        model.iter_next.return_value = model.iter_previous.return_value = None
+        p = self.mod.Photograph('zeta.jpg')
+        p.iter = 'zeta.jpg'
+        p.prefetch_neighbours(80)
+        self.mod.preview_queue.retain.assert_called_once_with([])
+        self.assertEqual(self.mod.preview_queue.request.mock_calls, [])
 
     def test_photograph_update_liststore_summary(self):
         """Ensure we can update photo summaries when they change."""
@@ -364,7 +719,9 @@ class PhotosTestCase(BaseTestCase):
         self.mod.fetch_thumbnail = Mock()
         self.mod.Label = Mock()
         self.mod.modified = Mock()
+        self.mod.photo_index = Mock()
         p = self.mod.Photograph('theta.jpg')
+        self.mod.photo_index.add.assert_called_once_with(p)
         self.mod.Label.cache = [p]
         p.camera = Mock()
         p.iter = 'theta'
@@ -374,5 +731,12 @@ class PhotosTestCase(BaseTestCase):
         self.mod.Label.return_value.destroy.assert_called_once_with()
         p.camera.remove_photo.assert_called_once_with(p)
         self.mod.modified.discard.assert_called_once_with(p)
+        self.mod.photo_index.discard.assert_called_once_with(p)
+        self.mod.thumbnail_queue.cancel.assert_called_once_with(p)
+        self.mod.resize_queue.cancel.assert_called_once_with(p)
+        self.mod.thumbnail_memory.discard.assert_called_once_with(p)
+        self.mod.preview_queue.cancel.assert_called_once_with(p)
+        self.mod.large_previews.discard.assert_called_once_with(p)
         self.mod.Widgets.loaded_photos.remove.assert_called_once_with('theta')
+        self.assertIsNone(p.iter)
         self.assertNotIn('theta.jpg', self.mod.Photograph.cache)
@@ -0,0 +1,98 @@
+"""Test the classes and functions defined by gg/session.py"""
+
+from tempfile import TemporaryDirectory
+from os.path import exists, join
+from mock import Mock
+from json import load
+
+from tests import BaseTestCase
+
+
+class SessionTestCase(BaseTestCase):
+    filename = 'session'
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = TemporaryDirectory()
+        self.path = join(self.tmp.name, 'gottengeography', 'session.json')
+        self.session = self.mod.Session(self.path)
+        # Run the background writer synchronously, when it's started.
+        self.mod.Thread = Mock(
+            side_effect=lambda target, daemon: Mock(start=target))
+        self.state = self.mod.pack(
+            ['/gps/b.gpx', '/gps/a.gpx'],
+            ['/dcim/100/IMG_1.JPG', '/dcim/101/IMG_2.JPG',
+             '/dcim/100/IMG_3.JPG'],
+            {'/dcim/100/IMG_3.JPG': (1.5, 2.5, 3.5, False)})
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_pack_unpack(self):
+        """Ensure the session survives the trip through JSON."""
+        self.assertEqual(
+            self.state['photos'],
+            {'/dcim/100': ['IMG_1.JPG', 'IMG_3.JPG'],
+             '/dcim/101': ['IMG_2.JPG']})
+        tracks, photos, positions = self.mod.unpack(self.state)
+        self.assertEqual(tracks, ['/gps/b.gpx', '/gps/a.gpx'])
+        self.assertEqual(
+            sorted(photos),
+            ['/dcim/100/IMG_1.JPG', '/dcim/100/IMG_3.JPG',
+             '/dcim/101/IMG_2.JPG'])
+        self.assertEqual(
+            positions, {'/dcim/100/IMG_3.JPG': (1.5, 2.5, 3.5, False)})
+
+    def test_save_and_load(self):
+        """Ensure we can write a session and read it back."""
+        self.session.save(self.state)
+        self.assertEqual(self.mod.Thread.call_count, 1)
+        with open(self.path) as session:
+            self.assertEqual(load(session), self.state)
+        self.assertEqual(self.mod.Session(self.path).load(), self.state)
+
+    def test_save_unchanged(self):
+        """Ensure an unchanged session isn't written again."""
+        self.session.save(self.state)
+        self.session.save(self.mod.pack(*self.mod.unpack(self.state)))
+        self.assertEqual(self.mod.Thread.call_count, 1)
+
+    def test_save_while_writing(self):
+        """Ensure only the latest state is written after a busy writer."""
+        self.mod.Thread = Mock()
+        self.session.save(self.state)
+        self.session.save(self.mod.pack([], [], {}))
+        self.assertEqual(self.mod.Thread.call_count, 1)
+        self.session.work()
+        self.assertEqual(self.mod.Session(self.path).load()['photos'], {})
+        self.assertFalse(self.session.writing)
+
+    def test_save_foreground(self):
+        """Ensure the final save happens before returning."""
+        self.session.save(self.state, background=False)
+        self.assertEqual(self.mod.Thread.call_count, 0)
+        self.assertEqual(self.mod.Session(self.path).load(), self.state)
+
+    def test_discard(self):
+        """Ensure discarding cancels pending writes and removes the file."""
+        self.session.save(self.state)
+        self.mod.Thread = Mock()
+        self.session.save(self.mod.pack([], [], {}))
+        self.session.discard()
+        self.assertFalse(exists(self.path))
+        self.session.work()
+        self.assertFalse(exists(self.path))
+
+    def test_discard_stale_write(self):
+        """Ensure a write that was overtaken by a discard is dropped."""
+        self.session.write(self.session.generation - 1, self.state)
+        self.assertFalse(exists(self.path))
+
+    def test_load_invalid(self):
+        """Ensure unreadable sessions are ignored."""
+        self.assertIsNone(self.session.load())
+        self.session.save(dict(self.state, version=0))
+        self.assertIsNone(self.mod.Session(self.path).load())
+        with open(self.path, 'w') as session:
+            session.write('{"truncated": ')
+        self.assertIsNone(self.session.load())
@@ -0,0 +1,326 @@
+"""Test the classes and functions defined by gg/thumbnails.py"""
+
+from mock import Mock, call
+
+from tests import BaseTestCase
+
+
+class GError(Exception):
+    pass
+
+
+class ThumbnailsTestCase(BaseTestCase):
+    filename = 'thumbnails'
+
+    def setUp(self):
+        super().setUp()
+        self.mod.GObject.GError = GError
+        self.mod.GLib.get_user_cache_dir.return_value = '/home/me/.cache'
+        self.mod.GLib.filename_to_uri.return_value = 'file:///pics/a.jpg'
+        self.mod.stat = Mock(return_value=Mock(st_mtime=1420254516.7))
+        self.path = ('/home/me/.cache/thumbnails/large/'
+                     '2c0e4d4a79f3aa4eb29ebae13b4e8d0b.png')
+
+    def test_get_path(self):
+        """Ensure thumbnails are named after the MD5 of their URI."""
+        self.mod.md5 = Mock()
+        self.mod.md5.return_value.hexdigest.return_value = 'abc'
+        self.assertEqual(
+            self.mod.get_path('file:///pics/a.jpg', 'normal'),
+            '/home/me/.cache/thumbnails/normal/abc.png')
+        self.mod.md5.assert_called_once_with(b'file:///pics/a.jpg')
+
+    def test_scale_to_fit(self):
+        """Ensure we shrink pixbufs preserving the aspect ratio."""
+        pixbuf = Mock()
+        pixbuf.get_width.return_value = 256
+        pixbuf.get_height.return_value = 192
+        self.assertEqual(
+            self.mod.scale_to_fit(pixbuf, 200),
+            pixbuf.scale_simple.return_value)
+        pixbuf.scale_simple.assert_called_once_with(
+            200, 150, self.mod.GdkPixbuf.InterpType.BILINEAR)
+        self.assertIs(self.mod.scale_to_fit(pixbuf, 256), pixbuf)
+
+    def test_load_thumbnail(self):
+        """Ensure we can load valid thumbnails from the cache."""
+        self.mod.get_path = Mock(return_value=self.path)
+        self.mod.scale_to_fit = Mock()
+        new = self.mod.GdkPixbuf.Pixbuf.new_from_file
+        new.return_value.get_option.side_effect = {
+            self.mod.URI: 'file:///pics/a.jpg',
+            self.mod.MTIME: '1420254516'}.get
+        self.assertEqual(
+            self.mod.load_thumbnail('a.jpg', 200),
+            self.mod.scale_to_fit.return_value)
+        self.mod.get_path.assert_called_once_with(
+            'file:///pics/a.jpg', 'large')
+        new.assert_called_once_with(self.path)
+        self.mod.scale_to_fit.assert_called_once_with(new.return_value, 200)
+
+    def test_load_thumbnail_larger(self):
+        """Ensure we can use larger thumbnails made by other programs."""
+        self.mod.get_path = Mock(side_effect=lambda uri, flavor: flavor)
+        self.mod.scale_to_fit = Mock()
+        thumb = Mock()
+        thumb.get_option.side_effect = {
+            self.mod.URI: 'file:///pics/a.jpg',
+            self.mod.MTIME: '1420254516'}.get
+
+        def new_from_file(path):
+            if path != 'xx-large':
+                raise GError
+            return thumb
+        new = self.mod.GdkPixbuf.Pixbuf.new_from_file
+        new.side_effect = new_from_file
+        self.assertEqual(
+            self.mod.load_thumbnail('a.jpg', 100),
+            self.mod.scale_to_fit.return_value)
+        self.assertEqual(new.mock_calls, [
+            call('normal'), call('large'), call('x-large'), call('xx-large')])
+        self.mod.scale_to_fit.assert_called_once_with(thumb, 100)
+
+    def test_load_thumbnail_stale(self):
+        """Ensure we ignore thumbnails of files that have been modified."""
+        new = self.mod.GdkPixbuf.Pixbuf.new_from_file
+        new.return_value.get_option.side_effect = {
+            self.mod.URI: 'file:///pics/a.jpg',
+            self.mod.MTIME: '1234'}.get
+        self.assertIsNone(self.mod.load_thumbnail('a.jpg', 200))
+
+    def test_load_thumbnail_missing(self):
+        """Ensure we handle thumbnails that haven't been generated yet."""
+        self.mod.GdkPixbuf.Pixbuf.new_from_file.side_effect = GError
+        self.assertIsNone(self.mod.load_thumbnail('a.jpg', 200))
+        self.assertIsNone(self.mod.load_thumbnail('a.jpg', 5000))
+
+    def test_save_thumbnail(self):
+        """Ensure thumbnails are written atomically with the right metadata."""
+        self.mod.get_path = Mock(return_value=self.path)
+        for name in ('chmod', 'makedirs', 'rename'):
+            setattr(self.mod, name, Mock())
+        self.mod.getpid = Mock(return_value=42)
+        thumb = Mock()
+        self.mod.save_thumbnail('a.jpg', thumb, 'large')
+        temp = self.path + '.42.tmp'
+        self.mod.makedirs.assert_called_once_with(
+            '/home/me/.cache/thumbnails/large', 0o700, exist_ok=True)
+        thumb.savev.assert_called_once_with(
+            temp, 'png', [self.mod.URI, self.mod.MTIME],
+            ['file:///pics/a.jpg', '1420254516'])
+        self.mod.chmod.assert_called_once_with(temp, 0o600)
+        self.mod.rename.assert_called_once_with(temp, self.path)
+
+    def test_save_thumbnail_failure(self):
+        """Ensure we don't care if the thumbnail can't be saved."""
+        self.mod.makedirs = Mock(side_effect=OSError)
+        self.mod.save_thumbnail('a.jpg', Mock(), 'large')
+
+    def test_save_thumbnail_cleanup(self):
+        """Ensure temporary files aren't left behind when saving fails."""
+        self.mod.get_path = Mock(return_value=self.path)
+        for name in ('makedirs', 'rename', 'unlink'):
+            setattr(self.mod, name, Mock())
+        self.mod.chmod = Mock(side_effect=OSError)
+        self.mod.getpid = Mock(return_value=42)
+        self.mod.save_thumbnail('a.jpg', Mock(), 'large')
+        self.mod.unlink.assert_called_once_with(self.path + '.42.tmp')
+        self.assertEqual(self.mod.rename.mock_calls, [])
+
+    def test_get_placeholder(self):
+        """Ensure placeholder icons are only loaded once per size."""
+        theme = self.mod.Gtk.IconTheme.get_default.return_value
+        self.assertEqual(
+            self.mod.get_placeholder(17), theme.load_icon.return_value)
+        self.assertEqual(
+            self.mod.get_placeholder(17), theme.load_icon.return_value)
+        theme.load_icon.assert_called_once_with(
+            'image-x-generic', 17, self.mod.Gtk.IconLookupFlags.FORCE_SIZE)
+
+    def test_get_placeholder_missing(self):
+        """Ensure we can live without an icon theme."""
+        theme = self.mod.Gtk.IconTheme.get_default.return_value
+        theme.load_icon.side_effect = GError
+        self.assertIsNone(self.mod.get_placeholder(18))
+
+
+class ThumbnailQueueTestCase(BaseTestCase):
+    filename = 'thumbnails'
+
+    def setUp(self):
+        super().setUp()
+        self.mod.Thread = Mock()
+        self.loader = Mock(side_effect=lambda name, size: (name, size))
+        self.callback = Mock()
+        self.queue = self.mod.ThumbnailQueue(self.loader, self.callback, 2)
+
+    def test_request(self):
+        """Ensure requests start worker threads as needed."""
+        for name in 'abc':
+            self.queue.request(name, name + '.jpg', 100)
+        self.assertEqual(len(self.queue), 3)
+        self.assertEqual(len(self.queue.threads), 2)
+        self.mod.Thread.assert_called_with(
+            target=self.queue.work, daemon=True)
+        self.mod.Thread.return_value.start.assert_called_with()
+
+    def test_next_fifo(self):
+        """Ensure thumbnails are decoded in the order they were requested."""
+        for name in 'abc':
+            self.queue.request(name, name + '.jpg', 100)
+        self.queue.request('a', 'a.jpg', 200)
+        self.assertEqual(self.queue.next(), ('b', 'b.jpg', 100))
+        self.assertEqual(self.queue.next(), ('c', 'c.jpg', 100))
+        self.assertEqual(self.queue.next(), ('a', 'a.jpg', 200))
+
+    def test_next_visible(self):
+        """Ensure visible thumbnails are decoded first."""
+        for name in 'abcd':
+            self.queue.request(name, name + '.jpg', 100)
+        self.queue.prioritize(['z', 'c', 'b'])
+        self.assertEqual(self.queue.next()[0], 'c')
+        self.assertEqual(self.queue.next()[0], 'b')
+        self.assertEqual(self.queue.next()[0], 'a')
+
+    def test_work(self):
+        """Ensure workers hand decoded thumbnails back to the main thread."""
+        self.queue.next = Mock(side_effect=[
+            ('a', 'a.jpg', 100), ('b', 'b.jpg', 100), StopIteration])
+        with self.assertRaises(StopIteration):
+            self.queue.work()
+        self.assertEqual(self.loader.mock_calls,
+                         [call('a.jpg', 100), call('b.jpg', 100)])
+        self.mod.GLib.idle_add.assert_called_once_with(self.queue.flush)
+        self.assertEqual(self.queue.done, [('a', 100, ('a.jpg', 100)),
+                                           ('b', 100, ('b.jpg', 100))])
+
+    def test_work_invalid(self):
+        """Ensure workers survive files that can't be decoded."""
+        self.loader.side_effect = OSError
+        self.queue.next = Mock(
+            side_effect=[('a', 'a.jpg', 100), StopIteration])
+        with self.assertRaises(StopIteration):
+            self.queue.work()
+        self.assertEqual(self.queue.done, [('a', 100, None)])
+
+    def test_work_crashed(self):
+        """Ensure workers survive bugs in the loader."""
+        self.mod.print_exc = Mock()
+        self.loader.side_effect = [ValueError, ('b.jpg', 100)]
+        self.queue.next = Mock(side_effect=[
+            ('a', 'a.jpg', 100), ('b', 'b.jpg', 100), StopIteration])
+        with self.assertRaises(StopIteration):
+            self.queue.work()
+        self.mod.print_exc.assert_called_once_with()
+        self.assertEqual(self.queue.done, [('a', 100, None),
+                                           ('b', 100, ('b.jpg', 100))])
+
+    def test_flush(self):
+        """Ensure batches of thumbnails are delivered all at once."""
+        self.queue.finish = Mock()
+        self.queue.done = [('a', 100, 'x'), ('b', 100, 'y')]
+        self.queue.flushing = True
+        self.assertFalse(self.queue.flush())
+        self.assertEqual(self.queue.finish.mock_calls,
+                         [call('a', 100, 'x'), call('b', 100, 'y')])
+        self.assertEqual(self.queue.done, [])
+        self.assertFalse(self.queue.flushing)
+
+    def test_retain(self):
+        """Ensure we can drop requests that are no longer interesting."""
+        for name in 'abcd':
+            self.queue.request(name, name + '.jpg', 100)
+        self.queue.next()
+        self.queue.retain('bd')
+        self.assertEqual(list(self.queue.pending), ['b', 'd'])
+        self.assertEqual(self.queue.requested('a'), 100)
+        self.assertIsNone(self.queue.requested('c'))
+
+    def test_finish(self):
+        """Ensure finished thumbnails are delivered."""
+        self.queue.request('a', 'a.jpg', 100)
+        self.queue.next()
+        self.queue.finish('a', 100, 'thumb')
+        self.callback.assert_called_once_with('a', 'thumb')
+        self.assertEqual(len(self.queue), 0)
+
+    def test_finish_failed(self):
+        """Ensure thumbnails that can't be decoded are remembered."""
+        self.queue.request('a', 'a.jpg', 100)
+        self.queue.next()
+        self.queue.finish('a', 100, None)
+        self.assertEqual(self.callback.mock_calls, [])
+        self.assertEqual(self.queue.failed, {'a'})
+        self.queue.request('a', 'a.jpg', 200)
+        self.assertEqual(self.queue.failed, set())
+        self.queue.failed.add('a')
+        self.queue.cancel('a')
+        self.assertEqual(self.queue.failed, set())
+
+    def test_finish_cancelled(self):
+        """Ensure cancelled thumbnails are discarded."""
+        self.queue.request('a', 'a.jpg', 100)
+        self.queue.next()
+        self.queue.cancel('a')
+        self.queue.finish('a', 100, 'thumb')
+        self.assertEqual(self.callback.mock_calls, [])
+
+    def test_finish_replaced(self):
+        """Ensure outdated thumbnails are discarded."""
+        self.queue.request('a', 'a.jpg', 100)
+        self.queue.next()
+        self.queue.request('a', 'a.jpg', 200)
+        self.queue.finish('a', 100, 'thumb')
+        self.assertEqual(self.callback.mock_calls, [])
+        self.assertEqual(len(self.queue), 1)
+
+
+class ThumbnailMemoryTestCase(BaseTestCase):
+    filename = 'thumbnails'
+
+    def pixbuf(self, size):
+        return Mock(get_byte_length=Mock(return_value=size))
+
+    def test_add(self):
+        """Ensure shared pixbufs are only counted once."""
+        memory = self.mod.ThumbnailMemory()
+        pixbuf = self.pixbuf(100)
+        memory.add('a', pixbuf, pixbuf)
+        memory.add('b', pixbuf, self.pixbuf(10))
+        self.assertEqual(memory.total, 210)
+        memory.add('a', self.pixbuf(1))
+        self.assertEqual(memory.total, 111)
+        memory.discard('b')
+        memory.discard('c')
+        self.assertEqual(memory.total, 1)
+        self.assertEqual(len(memory), 1)
+
+    def test_evict(self):
+        """Ensure the stalest items are evicted first."""
+        memory = self.mod.ThumbnailMemory()
+        for name in 'abcde':
+            memory.add(name, self.pixbuf(10))
+        memory.protect('ab')
+        self.assertEqual(memory.evict(100), [])
+        self.assertEqual(memory.evict(25), ['c', 'd', 'e'])
+        self.assertEqual(memory.evict(0), [])
+        self.assertEqual(memory.total, 20)
+        memory.protect('')
+        self.assertEqual(memory.evict(10), ['a'])
+
+
+class PixbufCacheTestCase(BaseTestCase):
+    filename = 'thumbnails'
+
+    def test_lru(self):
+        """Ensure the least recently used pixbufs are forgotten first."""
+        cache = self.mod.PixbufCache(3)
+        for name in 'abc':
+            cache.add(name, name.upper())
+        self.assertEqual(cache.get('a'), 'A')
+        cache.add('d', 'D')
+        self.assertNotIn('b', cache)
+        self.assertEqual(list(cache.items), ['c', 'a', 'd'])
+        cache.discard('a')
+        cache.discard('z')
+        self.assertEqual(len(cache), 2)
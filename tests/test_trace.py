@@ -0,0 +1,124 @@
+"""Test the classes and functions defined by gg/trace.py"""
+
+import sys
+import json
+from io import StringIO
+from tempfile import TemporaryDirectory
+from os.path import join
+
+from tests import BaseTestCase
+
+
+class TraceTestCase(BaseTestCase):
+    filename = 'trace'
+
+    def setUp(self):
+        super().setUp()
+        # Other modules import gg.trace, so they mustn't see these tracers.
+        self.addCleanup(sys.modules.pop, 'gg.trace', None)
+        self.addCleanup(self.mod.disable)
+        self.tmp = TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.trace_file = join(self.tmp.name, 'trace.json')
+
+    def fake_clock(self, *times):
+        """Make the tracer see the given times, in milliseconds."""
+        times = [ms * 1000000 for ms in reversed(times)]
+        self.mod.perf_counter_ns = lambda: times.pop()
+
+    def test_disabled(self):
+        """Ensure nothing is recorded while tracing is off."""
+        self.assertFalse(self.mod.enabled())
+        self.assertIs(self.mod.span('a', x=1), self.mod.NULL_SPAN)
+        with self.mod.span('a'):
+            self.mod.count('b')
+        double = self.mod.traced('double')(lambda x: x * 2)
+        self.assertEqual(double(4), 8)
+
+    def test_spans(self):
+        """Ensure spans are recorded as complete events."""
+        self.fake_clock(0, 1, 3, 4, 7)
+        tracer = self.mod.enable(self.trace_file)
+        self.assertIs(self.mod.enable('other.json'), tracer)
+        with self.mod.span('parse', file='a.gpx'):
+            pass
+        with self.mod.span('parse'):
+            pass
+        self.assertEqual(tracer.spans['parse'], [2, 5000000, 3000000])
+        thread, first, second = tracer.events
+        self.assertEqual(thread['ph'], 'M')
+        self.assertEqual(first['ph'], 'X')
+        self.assertEqual((first['ts'], first['dur']), (1000, 2000))
+        self.assertEqual(first['args'], {'file': 'a.gpx'})
+        self.assertNotIn('args', second)
+
+    def test_traced(self):
+        """Ensure decorated functions are timed, and still work."""
+        tracer = self.mod.enable(self.trace_file)
+
+        @self.mod.traced('double')
+        def double(x):
+            """Double it."""
+            return x * 2
+
+        self.assertEqual(double(4), 8)
+        self.assertEqual(double.__doc__, 'Double it.')
+        self.assertEqual(tracer.spans['double'][0], 1)
+
+    def test_counters(self):
+        """Ensure counters are added up and recorded over time."""
+        tracer = self.mod.enable(self.trace_file)
+        self.mod.count('points', 10)
+        self.mod.count('points', 5)
+        self.assertEqual(tracer.counters['points'], 15)
+        self.assertEqual([event['args'] for event in tracer.events[1:]],
+                         [{'points': 10}, {'points': 15}])
+
+    def test_max_events(self):
+        """Ensure the summary is still complete when events are dropped."""
+        self.mod.MAX_EVENTS = 3
+        tracer = self.mod.enable(self.trace_file)
+        for i in range(5):
+            with self.mod.span('a'):
+                pass
+        self.assertEqual(len(tracer.events), 3)
+        self.assertEqual(tracer.dropped, 3)
+        self.assertEqual(tracer.spans['a'][0], 5)
+        self.assertIn('3 events were left out', tracer.summary())
+
+    def test_finish(self):
+        """Ensure the trace is written as JSON along with a summary."""
+        self.fake_clock(0, 0, 2, 2, 10, 11)
+        tracer = self.mod.enable(self.trace_file)
+        with self.mod.span('fast'):
+            pass
+        with self.mod.span('slow'):
+            pass
+        self.mod.count('lookups', 3)
+        out = StringIO()
+        tracer.finish(out)
+        with open(self.trace_file) as trace:
+            events = json.load(trace)['traceEvents']
+        self.assertEqual([event['name'] for event in events],
+                         ['thread_name', 'fast', 'slow', 'lookups'])
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0].split(),
+                         ['span', 'count', 'total', 'ms', 'mean', 'ms',
+                          'max', 'ms'])
+        self.assertEqual(lines[1].split(),
+                         ['slow', '1', '8.0', '8.00', '8.00'])
+        self.assertEqual(lines[2].split(),
+                         ['fast', '1', '2.0', '2.00', '2.00'])
+        self.assertEqual(lines[-1].split(), ['lookups', '3'])
+
+    def test_stall_detector(self):
+        """Ensure a main loop that is very late checking in is recorded."""
+        self.fake_clock(0, 0, 50, 100, 280)
+        tracer = self.mod.enable(self.trace_file)
+        check = self.mod.stall_detector(interval=50, threshold=100)
+        self.assertTrue(check())
+        self.assertTrue(check())
+        self.assertEqual(tracer.spans['mainloop.stall'], [0, 0, 0])
+        self.assertTrue(check())
+        self.assertEqual(tracer.spans['mainloop.stall'],
+                         [1, 130000000, 130000000])
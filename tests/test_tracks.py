@@ -0,0 +1,172 @@
+"""Test the classes and functions defined by gg/tracks.py"""
+
+import sys
+from mock import Mock
+from os.path import join
+from xml.parsers.expat import ExpatError
+
+from tests import BaseTestCase
+
+
+class TracksTestCase(BaseTestCase):
+    filename = 'tracks'
+
+    def setUp(self):
+        """Initialize mocks."""
+        super().setUp()
+        # Other modules import gg.tracks, so they mustn't see these mocks.
+        self.addCleanup(sys.modules.pop, 'gg.tracks', None)
+        self.normal_kml = join(self.data_dir, 'normal.kml')
+
+    def test_track_point_invalid_elevation(self):
+        """Ensure unusable elevations are stored as sea level."""
+        self.assertEqual(self.mod.track_point(1, 2, 'five'), (1, 2, 0.0))
+
+    def test_xmlsimpleparser_init(self):
+        """Ensure we can initialize the simple XML parser."""
+        self.mod.ParserCreate = Mock()
+        x = self.mod.XMLSimpleParser(self.normal_kml, 2, 3, 4, 5)
+        self.assertEqual(x.call_start, 4)
+        self.assertEqual(x.call_end, 5)
+        self.assertEqual(x.watchlist, 3)
+        self.assertEqual(x.rootname, 2)
+        self.assertIsNone(x.tracking)
+        self.assertIsNone(x.element)
+        self.mod.ParserCreate.assert_called_once_with()
+        self.assertEqual(
+            x.parser.ParseFile.mock_calls[0][1][0].name, self.normal_kml)
+        self.assertEqual(x.parser.StartElementHandler, x.element_root)
+
+    def test_xmlsimpleparser_init_failed(self):
+        """Ensure the simple XML parser fails correctly."""
+        self.mod.ParserCreate = Mock()
+        self.mod.ParserCreate.return_value.ParseFile.side_effect = ExpatError()
+        with self.assertRaises(OSError):
+            self.mod.XMLSimpleParser(self.normal_kml, 2, 3, 4, 5)
+
+    def test_xmlsimpleparser_element_root(self):
+        """Ensure the simple XML parser finds the correct root element."""
+        self.mod.ParserCreate = Mock()
+        x = self.mod.XMLSimpleParser(self.normal_kml, 2, 3, 4, 5)
+        self.assertEqual(x.parser.StartElementHandler, x.element_root)
+        x.element_root(2, 'five')
+        self.assertEqual(x.parser.StartElementHandler, x.element_start)
+
+    def test_xmlsimpleparser_element_root_failed(self):
+        """Ensure the XML parser fails to find the root element correctly."""
+        self.mod.ParserCreate = Mock()
+        x = self.mod.XMLSimpleParser(self.normal_kml, 2, 3, 4, 5)
+        self.assertEqual(x.parser.StartElementHandler, x.element_root)
+        with self.assertRaises(OSError):
+            x.element_root(3, 'five')
+        self.assertEqual(x.parser.StartElementHandler, x.element_root)
+
+    def test_xmlsimpleparser_element_start_ignored(self):
+        """Ensure the XML parser ignores the right starting elements."""
+        self.mod.ParserCreate = Mock()
+        x = self.mod.XMLSimpleParser(self.normal_kml, 2, [], 4, 5)
+        x.call_start = Mock()
+        x.element_start('foo', 'bar')
+        self.assertEqual(x.call_start.mock_calls, [])
+        self.assertIsNone(x.element)
+
+    def test_xmlsimpleparser_element_start_watching(self):
+        """Ensure the XML parser starts watching."""
+        self.mod.ParserCreate = Mock()
+        x = self.mod.XMLSimpleParser(self.normal_kml, 2, ['foo'], 4, 5)
+        x.call_start = Mock()
+        x.element_start('foo', dict(bar='grill'))
+        x.call_start.assert_called_once_with('foo', dict(bar='grill'))
+        self.assertEqual(x.tracking, 'foo')
+        self.assertEqual(x.element, 'foo')
+        self.assertEqual(x.parser.CharacterDataHandler, x.element_data)
+        self.assertEqual(x.parser.EndElementHandler, x.element_end)
+        self.assertEqual(x.state, dict(bar='grill'))
+
+    def test_xmlsimpleparser_element_data_empty(self):
+        """Ensure the XML parser handles empty data."""
+        self.mod.ParserCreate = Mock()
+        x = self.mod.XMLSimpleParser(self.normal_kml, 2, ['foo'], 4, 5)
+        self.assertEqual(x.state, {})
+        x.element_data('        ')
+        self.assertEqual(x.state, {})
+
+    def test_xmlsimpleparser_element_data_something(self):
+        """Ensure the XML parser handles data."""
+        self.mod.ParserCreate = Mock()
+        x = self.mod.XMLSimpleParser(self.normal_kml, 2, ['foo'], 4, 5)
+        x.element = 'neon'
+        self.assertEqual(x.state, {})
+        x.element_data('atomic number: 10')
+        self.assertEqual(x.state, dict(neon='atomic number: 10'))
+
+    def test_xmlsimpleparser_element_data_chunked(self):
+        """Ensure the XML parser handles chunked data."""
+        self.mod.ParserCreate = Mock()
+        x = self.mod.XMLSimpleParser(self.normal_kml, 2, ['foo'], 4, 5)
+        x.element = 'neon'
+        self.assertEqual(x.state, {})
+        x.element_data('atomic ')
+        x.element_data('number: 10')
+        self.assertEqual(x.state, dict(neon='atomic number: 10'))
+
+    def test_xmlsimpleparser_element_end(self):
+        """Ensure the XML parser closes tags correctly."""
+        self.mod.ParserCreate = Mock()
+        x = self.mod.XMLSimpleParser(self.normal_kml, 2, ['foo'], 4, 5)
+        x.call_end = Mock()
+        x.tracking = 'neon'
+        x.state = dict(neon='atomic number: 10')
+        x.element_end('neon')
+        x.call_end.assert_called_once_with('neon', x.state)
+        self.assertIsNone(x.tracking)
+        self.assertEqual(x.state, dict())
+        self.assertIsNone(x.parser.CharacterDataHandler)
+        self.assertIsNone(x.parser.EndElementHandler)
+
+    def test_xmlsimpleparser_element_end_ignored(self):
+        """Ensure the XML parser ignores the right end tags."""
+        self.mod.ParserCreate = Mock()
+        x = self.mod.XMLSimpleParser(self.normal_kml, 2, ['foo'], 4, 5)
+        x.call_end = Mock()
+        x.tracking = 'neon'
+        x.element_end('lithium')
+        self.assertEqual(x.call_end.mock_calls, [])
+        self.assertEqual(x.tracking, 'neon')
+
+    def test_read_track(self):
+        """Ensure we can read each kind of track without any user interface."""
+        for name, count in (('minimal.gpx', 3),
+                            ('sample.tcx', 9),
+                            ('normal.kml', 84),
+                            ('mytracks.csv', 100)):
+            tracks = self.mod.read_track(join(self.data_dir, name))
+            self.assertEqual(len(tracks), count)
+            for point in tracks.values():
+                self.assertIsInstance(point, self.mod.TrackPoint)
+
+    def test_read_track_kind(self):
+        """Ensure the kind of track can be given instead of sniffed."""
+        self.mod.sniff = Mock()
+        tracks = self.mod.read_track(join(self.data_dir, 'minimal.gpx'), 'GPX')
+        self.assertEqual(tracks[1287259751], (53.52263, -113.448979, 671.666))
+        self.assertEqual(self.mod.sniff.mock_calls, [])
+
+    def test_read_track_unsupported(self):
+        """Ensure files that aren't tracks are refused."""
+        with self.assertRaises(OSError):
+            self.mod.read_track(join(self.root_dir, 'README.md'))
+        with self.assertRaises(OSError):
+            self.mod.read_track(self.normal_kml, 'GPX')
+
+    def test_reader_segments(self):
+        """Ensure each segment gets its own append function."""
+        segment = Mock()
+        progress = Mock()
+        reader = self.mod.CSVReader(
+            join(self.data_dir, 'mytracks.csv'), segment, progress)
+        self.assertEqual(reader.segments, segment.call_count)
+        self.assertGreater(reader.segments, 0)
+        self.assertEqual(len(progress.mock_calls), 100)
+        for point in reader.tracks.values():
+            self.assertEqual(point, segment.return_value.return_value)
@@ -0,0 +1,250 @@
+"""Test the classes and functions defined by gg/watch.py"""
+
+import os
+import sys
+import json
+from io import StringIO
+from shutil import copy
+from unittest import skipIf
+from tempfile import TemporaryDirectory
+from mock import Mock
+from os.path import join
+
+from tests import BaseTestCase
+
+
+class Clock:
+    """A clock that only moves when told to."""
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class WatchTestCase(BaseTestCase):
+    filename = 'watch'
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(sys.modules.pop, 'gg.watch', None)
+        self.tmp = TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.inbox = self.tmp.name
+        self.clock = Clock()
+        self.photo = join(self.demo_dir, 'IMG_2411.JPG')
+        self.track = join(self.demo_dir, '2010 10 16.gpx')
+
+    def drop(self, filename, name=None):
+        """Put a file in the inbox, returning its new name."""
+        return copy(filename, join(self.inbox, name or os.path.basename(
+            filename)))
+
+    def make_daemon(self, **kwargs):
+        """Create a Daemon whose photos are never really saved."""
+        batch = sys.modules['gg.batch']
+        self.addCleanup(setattr, batch, 'geotag', batch.geotag)
+        batch.geotag = Mock(return_value=True)
+        self.results = []
+        job = batch.Job(self.mod.Timeline(), tzinfo=batch.parse_timezone(
+            '-6'), geocode=False)
+        return self.mod.Daemon(
+            Mock(), job, settle=2, report=self.results.append,
+            clock=self.clock, **kwargs)
+
+    def test_poll_watcher(self):
+        """Ensure new and changed files are found by listing folders."""
+        watcher = self.mod.PollWatcher([self.inbox])
+        self.assertEqual(watcher.scan(), [])
+        photo = self.drop(self.photo)
+        self.drop(self.photo, '.hidden.jpg')
+        self.drop(self.photo, 'IMG_2411.JPG.part')
+        self.assertEqual(watcher.scan(), [photo])
+        self.assertEqual(watcher.scan(), [])
+        with open(photo, 'ab') as appended:
+            appended.write(b'more')
+        self.assertEqual(watcher.scan(), [photo])
+
+    @skipIf(sys.platform != 'linux', 'inotify is only available on Linux')
+    def test_inotify_watcher(self):
+        """Ensure new files are found as soon as they are written."""
+        old = self.drop(self.photo, 'old.jpg')
+        libc = self.mod.load_inotify()
+        watcher = self.mod.InotifyWatcher([self.inbox], libc)
+        self.addCleanup(watcher.close)
+        self.assertEqual(watcher.wait(0), [old])
+        self.assertEqual(watcher.wait(0), [])
+
+        os.mkdir(join(self.inbox, 'day2'))
+        self.assertEqual(watcher.wait(1), [])
+        photo = self.drop(self.photo, 'day2/IMG_2411.JPG')
+        self.drop(self.photo, 'day2/IMG_2411.JPG.part')
+        changed = watcher.wait(1)
+        self.assertEqual(set(changed), {photo})
+
+    def test_make_watcher(self):
+        """Ensure polling can be chosen instead of inotify."""
+        watcher = self.mod.make_watcher([self.inbox], 1)
+        self.assertIsInstance(watcher, self.mod.PollWatcher)
+        self.assertEqual(watcher.interval, 1)
+        self.mod.load_inotify = Mock(return_value=None)
+        self.assertIsInstance(self.mod.make_watcher([self.inbox]),
+                              self.mod.PollWatcher)
+
+    def test_settled(self):
+        """Ensure files are only read once they stop changing."""
+        daemon = self.make_daemon()
+        photo = self.drop(self.photo)
+        daemon.notice([photo])
+        self.assertEqual(daemon.settled(), [])
+        self.clock.now += 1
+        with open(photo, 'ab') as appended:
+            appended.write(b'more')
+        self.assertEqual(daemon.settled(), [])
+        self.clock.now += 1.5
+        self.assertEqual(daemon.settled(), [])
+        self.clock.now += 0.5
+        self.assertEqual(daemon.settled(), [(photo, 100.0)])
+        self.assertEqual(daemon.pending, {})
+
+    def test_settled_handled(self):
+        """Ensure we ignore our own changes to files."""
+        daemon = self.make_daemon()
+        photo = self.drop(self.photo)
+        daemon.remember(photo)
+        daemon.notice([photo, join(self.inbox, 'gone.jpg')])
+        daemon.settled()
+        self.clock.now += 2
+        self.assertEqual(daemon.settled(), [])
+        self.assertEqual(daemon.pending, {})
+        self.assertEqual(daemon.handled, {})
+
+    def test_forget_missing(self):
+        """Ensure deleted files are forgotten."""
+        daemon = self.make_daemon()
+        photo = self.drop(self.photo)
+        daemon.remember(photo)
+        daemon.forget_missing()
+        self.assertIn(photo, daemon.handled)
+        os.remove(photo)
+        daemon.forget_missing()
+        self.assertEqual(daemon.handled, {})
+
+    def test_nothing_written(self):
+        """Ensure photos aren't remembered when they weren't changed."""
+        daemon = self.make_daemon()
+        daemon.job.sidecar = True
+        photo = self.drop(self.photo)
+        track = self.drop(self.track)
+        daemon.ingest([(track, 100.0), (photo, 100.0)])
+        self.assertEqual(self.results[0].status, 'tagged')
+        self.assertEqual(list(daemon.handled), [track])
+
+    def test_pool_reused(self):
+        """Ensure workers are only restarted when new tracks arrive."""
+        self.addCleanup(setattr, self.mod, 'make_pool', self.mod.make_pool)
+        self.addCleanup(setattr, self.mod, 'run', self.mod.run)
+        self.mod.make_pool = Mock()
+        self.mod.run = Mock(return_value=[])
+        daemon = self.make_daemon(jobs=2)
+        daemon.load_tracks([self.drop(self.track)])
+        photos = {'a.jpg': 100.0, 'b.jpg': 100.0}
+        daemon.geotag(photos)
+        daemon.geotag(photos)
+        self.mod.make_pool.assert_called_once_with(daemon.job, 2)
+        pool = self.mod.make_pool.return_value
+        self.mod.run.assert_called_with(daemon.job, list(photos), 2, pool)
+
+        daemon.load_tracks([join(self.data_dir, 'minimal.gpx')])
+        pool.shutdown.assert_called_once_with()
+        self.assertIsNone(daemon.pool)
+
+    def test_photos_wait_for_tracks(self):
+        """Ensure photos are geotagged once their track arrives."""
+        daemon = self.make_daemon()
+        photo = self.drop(self.photo)
+        daemon.ingest([(photo, 100.0)])
+        self.assertEqual(daemon.waiting, {photo: 100.0})
+        self.assertEqual(self.results, [])
+
+        self.clock.now = 130.0
+        track = self.drop(self.track)
+        daemon.ingest([(track, 120.0)])
+        self.assertEqual(daemon.waiting, {})
+        result, = self.results
+        self.assertEqual(result.status, 'tagged')
+        self.assertAlmostEqual(result.fix.lat, 53.52996, 5)
+        self.assertIn(photo, daemon.handled)
+        self.assertIn(track, daemon.handled)
+
+        snapshot = daemon.snapshot()
+        self.assertEqual(snapshot['photos'], {'tagged': 1})
+        self.assertEqual(snapshot['tracks'], 1)
+        self.assertEqual(snapshot['track_points'], 374)
+        self.assertEqual(snapshot['latency']['p50'], 30.0)
+
+    def test_photos_outside_tracks(self):
+        """Ensure photos that the tracks don't cover keep waiting."""
+        daemon = self.make_daemon()
+        daemon.load_tracks([join(self.data_dir, 'minimal.gpx')])
+        photo = self.drop(self.photo)
+        daemon.ingest([(photo, 100.0)])
+        self.assertEqual(daemon.waiting, {photo: 100.0})
+        self.assertEqual(self.results[0].status, self.mod.UNTRACKED)
+
+    def test_bad_track(self):
+        """Ensure unreadable tracks are reported."""
+        daemon = self.make_daemon()
+        track = self.drop(join(self.data_dir, 'minimal.gpx'), 'bad.gpx')
+        with open(track, 'w') as bad:
+            bad.write('<gpx><trkseg>' * 20)
+        daemon.ingest([(track, 100.0)])
+        self.assertEqual(self.results[0].status, self.mod.FAILED)
+        self.assertEqual(daemon.metrics.tracks, 0)
+
+    def test_metrics(self):
+        """Ensure throughput only counts recent photos."""
+        metrics = self.mod.Metrics(self.clock)
+        for latency in (1, 2, 3, 10):
+            metrics.record('tagged', latency)
+        self.clock.now += 30
+        metrics.record('failed', 4)
+        self.clock.now += 45
+        snapshot = metrics.snapshot(waiting=0)
+        self.assertEqual(snapshot['per_minute'], 1.0)
+        self.assertEqual(snapshot['photos'], {'tagged': 4, 'failed': 1})
+        self.assertEqual(snapshot['latency'], dict(p50=3, p95=10, max=10))
+
+    def test_write_snapshot(self):
+        """Ensure metrics are written as JSON."""
+        filename = join(self.inbox, 'metrics.json')
+        self.mod.write_snapshot(filename, dict(uptime=1.5))
+        with open(filename) as metrics:
+            self.assertEqual(json.load(metrics), dict(uptime=1.5))
+        self.assertEqual(os.listdir(self.inbox), ['metrics.json'])
+
+    def test_run(self):
+        """Ensure the daemon stops cleanly and reports when it does."""
+        daemon = self.make_daemon()
+        photo = self.drop(self.photo)
+        track = self.drop(self.track)
+
+        def wait(timeout):
+            self.clock.now += 1
+            if self.clock.now > 110:
+                daemon.stop()
+            return [photo, track] if self.clock.now == 101 else []
+        daemon.watcher.wait.side_effect = wait
+
+        stats = []
+        daemon.run(stats.append, 5)
+        self.assertEqual([s['uptime'] for s in stats], [5, 10, 11])
+        self.assertEqual(stats[-1]['photos'], {'tagged': 1})
+        daemon.watcher.close.assert_called_once_with()
+
+    def test_main_usage(self):
+        """Ensure watching something that isn't a folder is refused."""
+        out, err = StringIO(), StringIO()
+        self.assertEqual(
+            self.mod.main([self.photo], out, err), self.mod.EXIT_USAGE)
+        self.assertIn('Not a folder', err.getvalue())
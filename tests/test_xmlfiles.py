@@ -2,7 +2,6 @@
 
 from mock import Mock, call
 from os.path import join
-from xml.parsers.expat import ExpatError
 
 from tests import BaseTestCase
 
@@ -16,7 +15,6 @@ class XmlFilesTestCase(BaseTestCase):
         self.mod.Gst = Mock()
         self.mod.GSettings = Mock()
         self.mod.MapView = Mock()
-        self.normal_kml = join(self.data_dir, 'normal.kml')
 
     def test_gtkclutter_init(self):
         """Ensure GtkClutter.__init__() has been called."""
@@ -72,124 +70,14 @@ class XmlFilesTestCase(BaseTestCase):
         self.assertEqual(coord.ele, 0.0)
         p.add_node.assert_called_once_with(coord)
 
-    def test_xmlsimpleparser_init(self):
-        """Ensure we can initialize the simple XML parser."""
-        self.mod.ParserCreate = Mock()
-        x = self.mod.XMLSimpleParser(self.normal_kml, 2, 3, 4, 5)
-        self.assertEqual(x.call_start, 4)
-        self.assertEqual(x.call_end, 5)
-        self.assertEqual(x.watchlist, 3)
-        self.assertEqual(x.rootname, 2)
-        self.assertIsNone(x.tracking)
-        self.assertIsNone(x.element)
-        self.mod.ParserCreate.assert_called_once_with()
-        self.assertEqual(
-            x.parser.ParseFile.mock_calls[0][1][0].name, self.normal_kml)
-        self.assertEqual(x.parser.StartElementHandler, x.element_root)
-
-    def test_xmlsimpleparser_init_failed(self):
-        """Ensure the simple XML parser fails correctly."""
-        self.mod.ParserCreate = Mock()
-        self.mod.ParserCreate.return_value.ParseFile.side_effect = ExpatError()
-        with self.assertRaises(OSError):
-            self.mod.XMLSimpleParser(self.normal_kml, 2, 3, 4, 5)
-
-    def test_xmlsimpleparser_element_root(self):
-        """Ensure the simple XML parser finds the correct root element."""
-        self.mod.ParserCreate = Mock()
-        x = self.mod.XMLSimpleParser(self.normal_kml, 2, 3, 4, 5)
-        self.assertEqual(x.parser.StartElementHandler, x.element_root)
-        x.element_root(2, 'five')
-        self.assertEqual(x.parser.StartElementHandler, x.element_start)
-
-    def test_xmlsimpleparser_element_root_failed(self):
-        """Ensure the XML parser fails to find the root element correctly."""
-        self.mod.ParserCreate = Mock()
-        x = self.mod.XMLSimpleParser(self.normal_kml, 2, 3, 4, 5)
-        self.assertEqual(x.parser.StartElementHandler, x.element_root)
-        with self.assertRaises(OSError):
-            x.element_root(3, 'five')
-        self.assertEqual(x.parser.StartElementHandler, x.element_root)
-
-    def test_xmlsimpleparser_element_start_ignored(self):
-        """Ensure the XML parser ignores the right starting elements."""
-        self.mod.ParserCreate = Mock()
-        x = self.mod.XMLSimpleParser(self.normal_kml, 2, [], 4, 5)
-        x.call_start = Mock()
-        x.element_start('foo', 'bar')
-        self.assertEqual(x.call_start.mock_calls, [])
-        self.assertIsNone(x.element)
-
-    def test_xmlsimpleparser_element_start_watching(self):
-        """Ensure the XML parser starts watching."""
-        self.mod.ParserCreate = Mock()
-        x = self.mod.XMLSimpleParser(self.normal_kml, 2, ['foo'], 4, 5)
-        x.call_start = Mock()
-        x.element_start('foo', dict(bar='grill'))
-        x.call_start.assert_called_once_with('foo', dict(bar='grill'))
-        self.assertEqual(x.tracking, 'foo')
-        self.assertEqual(x.element, 'foo')
-        self.assertEqual(x.parser.CharacterDataHandler, x.element_data)
-        self.assertEqual(x.parser.EndElementHandler, x.element_end)
-        self.assertEqual(x.state, dict(bar='grill'))
-
-    def test_xmlsimpleparser_element_data_empty(self):
-        """Ensure the XML parser handles empty data."""
-        self.mod.ParserCreate = Mock()
-        x = self.mod.XMLSimpleParser(self.normal_kml, 2, ['foo'], 4, 5)
-        self.assertEqual(x.state, {})
-        x.element_data('        ')
-        self.assertEqual(x.state, {})
-
-    def test_xmlsimpleparser_element_data_something(self):
-        """Ensure the XML parser handles data."""
-        self.mod.ParserCreate = Mock()
-        x = self.mod.XMLSimpleParser(self.normal_kml, 2, ['foo'], 4, 5)
-        x.element = 'neon'
-        self.assertEqual(x.state, {})
-        x.element_data('atomic number: 10')
-        self.assertEqual(x.state, dict(neon='atomic number: 10'))
-
-    def test_xmlsimpleparser_element_data_chunked(self):
-        """Ensure the XML parser handles chunked data."""
-        self.mod.ParserCreate = Mock()
-        x = self.mod.XMLSimpleParser(self.normal_kml, 2, ['foo'], 4, 5)
-        x.element = 'neon'
-        self.assertEqual(x.state, {})
-        x.element_data('atomic ')
-        x.element_data('number: 10')
-        self.assertEqual(x.state, dict(neon='atomic number: 10'))
-
-    def test_xmlsimpleparser_element_end(self):
-        """Ensure the XML parser closes tags correctly."""
-        self.mod.ParserCreate = Mock()
-        x = self.mod.XMLSimpleParser(self.normal_kml, 2, ['foo'], 4, 5)
-        x.call_end = Mock()
-        x.tracking = 'neon'
-        x.state = dict(neon='atomic number: 10')
-        x.element_end('neon')
-        x.call_end.assert_called_once_with('neon', x.state)
-        self.assertIsNone(x.tracking)
-        self.assertEqual(x.state, dict())
-        self.assertIsNone(x.parser.CharacterDataHandler)
-        self.assertIsNone(x.parser.EndElementHandler)
-
-    def test_xmlsimpleparser_element_end_ignored(self):
-        """Ensure the XML parser ignores the right end tags."""
-        self.mod.ParserCreate = Mock()
-        x = self.mod.XMLSimpleParser(self.normal_kml, 2, ['foo'], 4, 5)
-        x.call_end = Mock()
-        x.tracking = 'neon'
-        x.element_end('lithium')
-        self.assertEqual(x.call_end.mock_calls, [])
-        self.assertEqual(x.tracking, 'neon')
-
     def test_trackfile_update_range(self):
         """Ensure the TrackFile can update its range."""
         self.mod.TrackFile.range = [9, 10]
         self.mod.TrackFile.instances = ['something']
         self.mod.points = [1, 2, 3]
+        self.mod.timeline = Mock()
         self.mod.TrackFile.update_range()
+        self.mod.timeline.load.assert_called_once_with(self.mod.points)
         self.mod.Widgets.empty_trackfile_list.hide.assert_called_once_with()
         self.assertEqual(self.mod.TrackFile.range, [1, 3])
 
@@ -197,6 +85,7 @@ class XmlFilesTestCase(BaseTestCase):
         """Ensure the TrackFile can update an empty range."""
         self.mod.TrackFile.range = [9, 10]
         self.mod.points = [1, 2, 3]
+        self.mod.timeline = Mock()
         self.mod.TrackFile.update_range()
         self.mod.Widgets.empty_trackfile_list.show.assert_called_once_with()
         self.assertEqual(self.mod.TrackFile.range, [])
@@ -242,7 +131,7 @@ class XmlFilesTestCase(BaseTestCase):
     def test_trackfile_load_from_file(self):
         """Ensure the TrackFile can load a file."""
         times = [2, 1]
-        self.mod.clock = lambda: times.pop()
+        self.mod.perf_counter = lambda: times.pop()
         self.mod.Camera = Mock()
         self.mod.GPXFile = Mock()
         self.mod.GPXFile.return_value.tracks = [1, 2, 3]
@@ -250,6 +139,9 @@ class XmlFilesTestCase(BaseTestCase):
         self.mod.TrackFile.get_bounding_box = Mock()
         self.mod.TrackFile.instances = Mock()
         self.mod.TrackFile.update_range = Mock()
+        self.mod.timeline = Mock()
+        self.mod.timeline.affected.return_value = (10, 20)
+        self.mod.photo_index = Mock()
         self.mod.TrackFile.load_from_file('foo.gpx')
         self.mod.GPXFile.assert_called_once_with('foo.gpx')
         self.mod.Widgets.status_message.assert_called_once_with(
@@ -263,6 +155,12 @@ class XmlFilesTestCase(BaseTestCase):
         self.mod.MapView.ensure_visible.assert_called_once_with(
             self.mod.TrackFile.get_bounding_box.return_value, False)
         self.mod.TrackFile.update_range.assert_called_once_with()
+        gpx = self.mod.GPXFile.return_value
+        self.mod.timeline.affected.assert_called_once_with(
+            gpx.alpha, gpx.omega)
+        self.mod.photo_index.between.assert_called_once_with(10, 20)
+        self.mod.timeline.correlate.assert_called_once_with(
+            self.mod.photo_index.between.return_value)
         self.mod.Camera.set_all_found_timezone.assert_called_once_with(
             self.mod.GPXFile.return_value.start.geotimezone)
 
@@ -284,24 +182,25 @@ class XmlFilesTestCase(BaseTestCase):
     def test_trackfile_init_first_no_points(self):
         """Ensure the TrackFile can load a track with no points."""
         self.mod.GSettings.return_value.get_string.return_value = ''
-        self.mod.TrackFile.parse = Mock()
+        self.mod.TrackFile.reader = Mock()
+        self.mod.TrackFile.reader.return_value.tracks = {}
         with self.assertRaisesRegexp(OSError, 'No points found'):
-            self.mod.TrackFile('/path/to/foo.gpx', 'a', 'b')
+            self.mod.TrackFile('/path/to/foo.gpx')
         self.mod.GSettings.assert_called_once_with('trackfile', 'foo.gpx')
         self.mod.Gst.get_value.assert_called_once_with('track-color')
         self.mod.GSettings.return_value.set_value.assert_called_once_with(
             'track-color', self.mod.Gst.get_value.return_value)
 
-    def test_trackfile_element_end(self):
-        """Ensure the TrackFile can end tracks."""
+    def test_trackfile_pulse(self):
+        """Ensure the TrackFile shows activity while loading."""
         events = [False, True, True]
         self.mod.Gtk.events_pending = lambda: events.pop()
-        self.mod.clock = Mock(return_value=5)
+        self.mod.perf_counter = Mock(return_value=5)
         self.mod.TrackFile.clock = 1
         self.mod.TrackFile.progress = Mock()
         self.mod.TrackFile.__init__ = lambda s: None
         tf = self.mod.TrackFile()
-        tf.element_end('foo', 'bar')
+        tf.pulse()
         self.assertEqual(
             self.mod.Gtk.main_iteration.mock_calls,
             [call(), call()])
@@ -311,6 +210,9 @@ class XmlFilesTestCase(BaseTestCase):
         """Ensure the TrackFile can destroy itself."""
         other_tf = Mock()
         self.mod.points = Mock()
+        self.mod.timeline = Mock()
+        self.mod.timeline.affected.return_value = (1, 2)
+        self.mod.photo_index = Mock()
         self.mod.TrackFile.__init__ = lambda s: None
         self.mod.TrackFile.update_range = Mock()
         tf = self.mod.TrackFile()
@@ -319,7 +221,12 @@ class XmlFilesTestCase(BaseTestCase):
         tf.polygons = set(['poly'])
         tf.filename = 'foo.gpx'
         tf.cache = {'foo.gpx': 'contents'}
+        tf.alpha, tf.omega = 5, 6
         tf.destroy()
+        self.mod.timeline.affected.assert_called_once_with(5, 6)
+        self.mod.photo_index.between.assert_called_once_with(1, 2)
+        self.mod.timeline.correlate.assert_called_once_with(
+            self.mod.photo_index.between.return_value)
         self.mod.points.clear.assert_called_once_with()
         self.mod.points.update.assert_called_once_with(other_tf.tracks)
         tf.widgets.trackfile_settings.destroy.assert_called_once_with()